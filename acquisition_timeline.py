@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Describes an acquisition as a timeline of events, and compiles it into output buffers before it starts.
+
+A timeline is a list of (name, periods, overrides) events.  overrides is a dict of setting values which are changed from
+the current setting for that event.  periods counts revolutions of the event's setting (of the first one, in a
+sequence).  The planner may put several revolutions in one buffer, so an event which isn't a whole number of buffers
+ends with a shorter buffer of the revolutions that remain.  The event named 'stop' must be last: when the events before
+it have played, the acquisition stops and the output holds the stop event's setting.  Without a stop event the last
+event repeats until the acquisition is stopped by hand.
+
+The default timeline is the acquisition the Acquire button has always done: 100 periods with the "shutter closed" (the
+beam parked on a small circle), 100 periods with the current setting, then stop.
+
+compile_timeline() renders every event's buffer up front.  While the acquisition plays, the stream only steps through
+the compiled buffers, so nothing is allocated, computed or reconfigured inside the DAQ callback.
+"""
+from __future__ import division
+import threading
+import numpy as np
+from waveform_planner import WaveformPlan
+
+DEFAULT_TIMELINE=[
+    ('pre-roll',100,{'radius':.6,'alternate12':False,'alternate123':False}), # "closed shutter"
+    ('illumination',100,{}),
+    ('stop',0,{'frequency':0,'radius':.6,'alternate12':False,'alternate123':False})]
+
+
+class CompiledTimeline:
+    ''' The buffers of a timeline.  periods() yields them in order and sets finished when the timeline has played, if it
+    ends with a stop event.  segment and period say where the acquisition is.  settings is the setting of every buffer,
+    for the event log, if the buffers weren't made by the GalvoDriver's calculate().'''
+    def __init__(self,names,buffers,counts,stop_data,sample_rate,settings=None):
+        self.names=names
+        self.buffers=buffers
+        self.counts=np.array(counts,dtype=np.int64)
+        self.stop_data=stop_data # None if the timeline doesn't stop by itself
+        self.sample_rate=sample_rate
+        self.settings=settings
+        self.segment=0
+        self.period=0
+        self.finished=threading.Event()
+    def periods(self):
+        for self.segment in range(len(self.buffers)):
+            data=self.buffers[self.segment]
+            for self.period in range(self.counts[self.segment]):
+                yield data
+        if self.stop_data is None:
+            while True: # repeat the last event until the acquisition is stopped
+                yield data
+        self.finished.set()
+    def duration(self):
+        ''' How long the timeline plays before it stops, in seconds.'''
+        lengths=np.array([data.shape[1] for data in self.buffers])
+        return float(np.sum(lengths*self.counts))/self.sample_rate
+
+
+def event_settings(galvoDriver,overrides):
+    ''' Returns (sequence, settings): the indices and the settings galvoDriver.calculate() would output with overrides
+    applied to the current setting.  The settings themselves are left as they are.'''
+    s=galvoDriver.settings
+    current=dict(s.d[s.i],**overrides)
+    sequence=s.sequence(current)
+    return sequence,[current if i==s.i else s.d[i] for i in sequence]
+
+
+def render_event(galvoDriver,overrides,sample_rate=None,plan=None):
+    ''' Returns (data, plan) of the buffer galvoDriver.calculate() would make with overrides applied to the current
+    setting, without changing the setting or the buffer being output.'''
+    sequence,settings=event_settings(galvoDriver,overrides)
+    data,sampsPerPeriod,plan,edges,transition_times,lengths=galvoDriver.render(sequence,settings,sample_rate,plan)
+    return data,plan
+
+
+def compile_timeline(galvoDriver,events=DEFAULT_TIMELINE):
+    ''' Renders the buffer of every event with galvoDriver.render(), all at the sample rate of the first event.  An
+    event whose periods aren't a whole number of buffers also gets a buffer of the remaining revolutions.'''
+    names=[name for name,periods,overrides in events]
+    if 'stop' in names[:-1]:
+        raise ValueError("The 'stop' event has to be the last event of the timeline")
+    if len(events)==0 or names==['stop']:
+        raise ValueError('The timeline has nothing to play')
+    names=[]
+    buffers=[]
+    counts=[]
+    stop_data=None
+    sample_rate=None
+    for name,periods,overrides in events:
+        data,plan=render_event(galvoDriver,overrides,sample_rate)
+        if sample_rate is None:
+            sample_rate=galvoDriver.sample_rate if plan is None else plan.sample_rate
+        if name=='stop':
+            stop_data=data
+            continue
+        sequence,settings=event_settings(galvoDriver,overrides)
+        step=galvoDriver.camera.revolutionStep(settings[0]['frequency']) # a revolution of each setting of a sequence, or a camera frame
+        if periods%step:
+            raise ValueError('The {} event has to last a multiple of {} periods'.format(name,step))
+        revolutions=step if plan is None else plan.revolutions[0]
+        count,remainder=divmod(periods,revolutions)
+        names.append(name)
+        buffers.append(data)
+        counts.append(count)
+        if remainder: # only a single setting has buffers of several steps, so this is one setting's remaining revolutions
+            frequency=plan.requested[0]
+            partial=WaveformPlan(sample_rate,[frequency],[int(round(remainder*sample_rate/frequency))],[remainder],galvoDriver.camera)
+            names.append(name)
+            buffers.append(render_event(galvoDriver,overrides,plan=partial)[0])
+            counts.append(1)
+    return CompiledTimeline(names,buffers,counts,stop_data,sample_rate)
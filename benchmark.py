@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the waveform generation and of the GalvoDriver's update paths.  Runs headless against the SimulatedBackend
+from daq_backend.py, so neither the NI card nor Qt is needed.
+
+For every frequency in FREQUENCIES (0 Hz is the zero frequency fallback), every mode in MODES and every sample rate in
+SAMPLE_RATES ('planned' lets the WaveformPlanner choose), it measures:
+    render_ms       a WaveformEngine render of the whole sequence into an empty buffer
+    calculate_ms    GalvoDriver.calculate() with an empty waveform cache
+    cached_ms       GalvoDriver.calculate() when the buffer is in the cache
+    refresh_ms      GalvoDriver.refresh() after moving the radius, as a slider does
+    peak_kb         the peak memory allocated by one uncached calculate(), from tracemalloc
+    bytes           the bytes of the buffer each refresh hands to the DAQ
+It also measures the latency from posting a change to the UpdateScheduler, as a slider does, to the first sample of
+the new setting leaving the simulated device.
+
+    python benchmark.py                           runs everything and prints a table
+    python benchmark.py --output results.json     also saves the results
+    python benchmark.py --raw                     runs the driver with int16 DAC codes (see dac_codes.py)
+    python benchmark.py --compare old.json new.json
+                                                  prints the ratio new/old of every result, to spot regressions
+Times are the median of --repeat runs.
+"""
+from __future__ import division
+from __future__ import print_function
+import argparse
+import json
+import platform
+import sys
+import time
+import numpy as np
+try:
+    import tracemalloc # python 3.4 and above
+except ImportError:
+    tracemalloc=None
+from settings import Settings, default_setting
+from galvo_driver import GalvoDriver
+from daq_backend import SimulatedBackend
+from update_scheduler import UpdateScheduler
+from waveform_engine import WaveformEngine, BLUE_LASER
+from instrumentation import clock
+
+FREQUENCIES=[0,1,10,100,200,500]
+MODES=['single','alternate12','alternate123']
+SAMPLE_RATES=['planned',1000000,250000]
+LATENCY_FREQUENCIES=[10,200]
+METRICS=['render_ms','calculate_ms','cached_ms','refresh_ms','peak_kb','bytes','latency_ms']
+
+
+def make_settings(frequency,mode):
+    settings=Settings()
+    settings.d=[default_setting() for i in range(4)]
+    for i,setting in enumerate(settings.d):
+        setting['frequency']=frequency
+        setting['radius']=.5+.1*i # so that the settings of a sequence differ
+    if mode!='single':
+        settings.d[0][mode]=True
+    return settings
+
+
+def make_driver(frequency,mode,sample_rate,record_data=False,raw=False):
+    driver=GalvoDriver(make_settings(frequency,mode),SimulatedBackend(record_data=record_data))
+    driver.setRaw(raw)
+    if sample_rate!='planned':
+        with driver.lock:
+            driver.planner=None
+            driver.sample_rate=sample_rate
+            driver.waveform_cache.clear()
+            driver.refresh()
+    return driver
+
+
+def close_driver(driver):
+    with driver.lock:
+        driver.analog_output.clear()
+        driver.stopped=True
+
+
+def timed(function,repeat,setup=None):
+    ''' Returns the median time of function() in ms.'''
+    times=[]
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start=clock()
+        function()
+        times.append(clock()-start)
+    return float(np.median(times))*1000
+
+
+def peak_kb(function):
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        function()
+        current,peak=tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak/1024
+
+
+def bench_scenario(frequency,mode,sample_rate,repeat,raw=False):
+    driver=make_driver(frequency,mode,sample_rate,raw=raw)
+    try:
+        s=driver.settings
+        settings=[s.d[i] for i in s.sequence()]
+        engine=WaveformEngine(driver.sample_rate)
+        def render():
+            engine.lengths=None # forget what the buffer holds, so every channel is written
+            engine.render(settings,plan=driver.plan if driver.planner is not None else None)
+        def uncached():
+            driver.waveform_cache.clear()
+            driver.engine.lengths=None
+        result={'render_ms':timed(render,repeat)}
+        result['calculate_ms']=timed(driver.calculate,repeat,uncached)
+        driver.calculate()
+        result['cached_ms']=timed(driver.calculate,repeat)
+        radius=[s['radius']]
+        def move_slider():
+            radius[0]+=.001 # a new value every time, so the waveform cache misses like it does while dragging
+            for i in s.sequence():
+                s.d[i]['radius']=radius[0]
+            driver.refresh()
+        result['refresh_ms']=timed(move_slider,repeat)
+        uncached()
+        result['peak_kb']=peak_kb(driver.calculate)
+        result['bytes']=int(driver.data.nbytes)
+        result['sample_rate']=driver.sample_rate
+        return result
+    finally:
+        close_driver(driver)
+
+
+def output_time(task,value,since):
+    ''' Returns the time the first sample of a write made after since, in which the blue laser channel is value, leaves the simulated device, or None if it hasn't been written yet.'''
+    for write in list(task.writes):
+        if write['time']<since:
+            continue
+        indices=np.nonzero(np.abs(write['data'][BLUE_LASER]-value)<.001)[0] # within an LSB, for the int16 path
+        if len(indices):
+            return task.start_time+(write['sample']+indices[0])/task.sample_rate
+    return None
+
+
+def bench_latency(frequency,repeat,timeout=5,raw=False):
+    ''' The time from UpdateScheduler.post() to the first sample of the new setting being output, in ms.'''
+    driver=make_driver(frequency,'single','planned',record_data=True,raw=raw)
+    scheduler=UpdateScheduler(driver)
+    try:
+        driver.settings['blue_laser']=True
+        driver.refresh()
+        latencies=[]
+        for i in range(repeat):
+            value=1.+i%2 # alternate between two powers, so every post changes the output
+            task=driver.analog_output
+            del task.writes[:]
+            time.sleep(.05) # don't post on the heels of the last update, which the scheduler would hold back for its interval
+            posted=clock()
+            scheduler.post({'blue_laser_power':value})
+            deadline=posted+timeout
+            output=None
+            while output is None and clock()<deadline:
+                time.sleep(.001)
+                output=output_time(task,value,posted)
+            if output is None:
+                raise RuntimeError('The change posted to the scheduler never reached the output')
+            while clock()<output: # the sample is written, wait until it is actually output
+                time.sleep(.001)
+            latencies.append(output-posted)
+        return {'latency_ms':float(np.median(latencies))*1000,'latency_max_ms':float(np.max(latencies))*1000}
+    finally:
+        scheduler.close()
+        close_driver(driver)
+
+
+def run(repeat=5,frequencies=FREQUENCIES,modes=MODES,sample_rates=SAMPLE_RATES,raw=False):
+    results=dict()
+    for sample_rate in sample_rates:
+        for mode in modes:
+            for frequency in frequencies:
+                name='{} {} Hz @ {}'.format(mode,frequency,sample_rate)
+                results[name]=bench_scenario(frequency,mode,sample_rate,repeat,raw)
+                print_result(name,results[name])
+    for frequency in LATENCY_FREQUENCIES:
+        name='latency {} Hz'.format(frequency)
+        results[name]=bench_latency(frequency,repeat,raw=raw)
+        print_result(name,results[name])
+    return results
+
+
+def print_result(name,result):
+    values=[]
+    for metric in METRICS:
+        if result.get(metric) is not None:
+            values.append('{}={:.4g}'.format(metric,result[metric]))
+    print('{:<36} {}'.format(name,'  '.join(values)))
+    sys.stdout.flush()
+
+
+def save(results,filename):
+    info={'time':time.strftime('%Y-%m-%d %H:%M:%S'),'python':platform.python_version(),'numpy':np.__version__,'platform':platform.platform()}
+    with open(filename,'w') as f:
+        json.dump({'info':info,'results':results},f,indent=1,sort_keys=True)
+
+
+def compare(old_file,new_file):
+    ''' Prints new/old for every metric of every scenario in both files.  Above 1 means slower or bigger.'''
+    with open(old_file) as f:
+        old=json.load(f)['results']
+    with open(new_file) as f:
+        new=json.load(f)['results']
+    for name in sorted(set(old)&set(new)):
+        ratios=[]
+        for metric in METRICS:
+            a=old[name].get(metric)
+            b=new[name].get(metric)
+            if a and b is not None:
+                ratios.append('{}={:.2f}x'.format(metric,b/a))
+        print('{:<36} {}'.format(name,'  '.join(ratios)))
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Benchmarks the waveform generation and the update paths of the GalvoDriver against a simulated DAQ.')
+    parser.add_argument('--repeat',type=int,default=5,help='how many times each measurement is repeated')
+    parser.add_argument('--raw',action='store_true',help='runs the driver with int16 DAC codes instead of float64 volts')
+    parser.add_argument('--output',help='saves the results to this json file')
+    parser.add_argument('--compare',nargs=2,metavar=('OLD','NEW'),help='compares two saved results instead of running')
+    args=parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+    else:
+        results=run(args.repeat,raw=args.raw)
+        if args.output:
+            save(results,args.output)
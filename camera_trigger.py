@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+When the camera is triggered.
+
+The camera takes one frame per TTL pulse.  Originally there was one pulse at the start of every revolution, so the frame
+rate was the galvo frequency: too fast for the camera at high frequencies, and slower than it could go at low ones.
+CameraTrigger decouples them:
+    CameraTrigger('revolution', every=N)        a frame every N revolutions, so each exposure integrates N revolutions
+    CameraTrigger('multiple', per_revolution=M) M frames per revolution, evenly spaced
+    CameraTrigger('frame_rate', frame_rate=F)   F frames per second.  The galvo frequency of each setting is moved to the
+                                                nearest whole number of revolutions per frame, so each exposure holds
+                                                whole revolutions
+pulse_width is how long the TTL stays high, in seconds.  By default it is one sample, as it always was.
+
+Every segment of the output buffer holds a whole number of frames, so the pulses are evenly spaced in each segment.
+The WaveformPlan reports the frame rate and the number of revolutions per frame which result.
+"""
+from __future__ import division
+
+MODES=('revolution','multiple','frame_rate')
+
+
+class CameraTrigger:
+    def __init__(self,mode='revolution',every=1,per_revolution=1,frame_rate=None,pulse_width=None):
+        if mode not in MODES:
+            raise ValueError('The camera trigger mode has to be one of {}'.format(', '.join(MODES)))
+        if int(every)!=every or every<1 or int(per_revolution)!=per_revolution or per_revolution<1:
+            raise ValueError('every and per_revolution have to be whole numbers of at least 1')
+        if mode=='frame_rate' and not (frame_rate is not None and frame_rate>0):
+            raise ValueError('The frame_rate mode needs a frame rate above 0')
+        if pulse_width is not None and pulse_width<=0:
+            raise ValueError('The pulse width has to be above 0')
+        self.mode=mode
+        self.every=int(every)
+        self.per_revolution=int(per_revolution)
+        self.frame_rate=frame_rate
+        self.pulse_width=pulse_width
+    def key(self):
+        ''' Everything that changes the output, for use in cache keys.'''
+        return (self.mode,self.every,self.per_revolution,self.frame_rate,self.pulse_width)
+    def isDefault(self):
+        ''' True if this is one pulse of one sample per revolution, as the output always was.'''
+        return self.mode=='revolution' and self.every==1 and self.pulse_width is None
+    def revolutionsPerFrame(self,frequency):
+        if self.mode=='revolution':
+            return self.every
+        elif self.mode=='multiple':
+            return 1/self.per_revolution
+        elif frequency==0: # the beam stands still for one frame
+            return 1
+        return max(1,int(round(frequency/self.frame_rate)))
+    def galvoFrequencies(self,frequencies):
+        ''' The frequency each setting is output at.  Only the frame_rate mode changes them.  A setting with a frequency of 0
+        gets one frame of 1/frame_rate seconds, which is planned as one revolution at frame_rate.'''
+        if self.mode!='frame_rate':
+            return list(frequencies)
+        return [self.revolutionsPerFrame(f)*self.frame_rate for f in frequencies]
+    def revolutionStep(self,frequency):
+        ''' A segment has to hold a whole number of frames, so its number of revolutions is a multiple of this.'''
+        return max(1,int(round(self.revolutionsPerFrame(frequency))))
+    def triggers(self,revolutions,frequency):
+        ''' The number of pulses in a segment of revolutions revolutions.'''
+        return max(1,int(round(revolutions/self.revolutionsPerFrame(frequency))))
+    def pulseSamples(self,sample_rate):
+        if self.pulse_width is None:
+            return 1
+        return max(1,int(round(self.pulse_width*sample_rate)))
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Which analog output drives what.
+
+The WaveformEngine computes one row per role: the sine and the cosine for the galvos, the camera TTL and the two laser
+controls.  The channel map says which physical channels output each role, so that a second galvo pair or a second card
+is a matter of configuration.  It is loaded from ~/.ShadowlessTIRF/channels.json if that file exists, which holds a
+list like
+
+    [{"channel": "Dev2/ao2", "role": "sin", "min": -10, "max": 10},
+     {"channel": "Dev2/ao3", "role": "cos", "min": -10, "max": 10},
+     {"channel": "Dev3/ao0", "role": "sin", "min": -10, "max": 10}, ...]
+
+Several channels can have the same role.  Channels are grouped by device, in the order the devices first appear; the
+first device is the master whose sample clock and start trigger the others follow (see SynchronizedTask in
+daq_backend.py).  The output buffer has one row per channel, device after device, and is made from the engine's rows
+with a single take, so each device's buffer is a contiguous block of rows.
+"""
+from __future__ import division
+import json
+import os
+from os.path import expanduser
+import numpy as np
+from daq_backend import AO_CHANNELS
+
+ROLES=('sin','cos','camera_ttl','blue_laser','green_laser') # the rows of the WaveformEngine output, in order
+CHANNEL_MAP_FILE=os.path.join(expanduser("~"),'.ShadowlessTIRF','channels.json')
+DEFAULT_CHANNELS=[{'channel':name,'role':role,'min':minimum,'max':maximum} for (name,minimum,maximum),role in zip(AO_CHANNELS,ROLES)]
+
+
+class ChannelMap:
+    ''' channels is a list of dicts with the keys 'channel' (like 'Dev2/ao2'), 'role' (one of ROLES), 'min' and 'max' (the
+    voltage range).  self.channels holds them in the order of the rows of the output buffer.'''
+    def __init__(self,channels=DEFAULT_CHANNELS):
+        if len(channels)==0:
+            raise ValueError('The channel map has no channels')
+        self.devices=[] # device names, the master first
+        by_device=dict()
+        names=set()
+        for channel in channels:
+            name=channel['channel']
+            if channel['role'] not in ROLES:
+                raise ValueError('The role of {} is {!r}, which is not one of {}'.format(name,channel['role'],', '.join(ROLES)))
+            if '/' not in name:
+                raise ValueError('{!r} is not a physical channel like Dev2/ao2'.format(name))
+            if name in names:
+                raise ValueError('{} is in the channel map twice'.format(name))
+            if not channel['min']<channel['max']:
+                raise ValueError('The voltage range of {} is empty'.format(name))
+            names.add(name)
+            device=name.split('/')[0]
+            if device not in by_device:
+                self.devices.append(device)
+                by_device[device]=[]
+            by_device[device].append(dict(channel))
+        self.channels=[channel for device in self.devices for channel in by_device[device]]
+        self.by_device=by_device
+        self.rows=np.array([ROLES.index(channel['role']) for channel in self.channels]) # the engine row of every channel
+    def __len__(self):
+        return len(self.channels)
+    def deviceChannels(self):
+        ''' Returns [(device, [(physical channel, min, max), ...]), ...], which is what the backends create tasks from.'''
+        return [(device,[(c['channel'],float(c['min']),float(c['max'])) for c in self.by_device[device]]) for device in self.devices]
+    def expand(self,data):
+        ''' Returns a new (channels x samples) output buffer for the engine's (roles x samples) data.'''
+        return np.take(data,self.rows,axis=0)
+
+
+def load_channel_map(filename=CHANNEL_MAP_FILE):
+    ''' Returns the ChannelMap in filename, or the default one if there is no such file.'''
+    try:
+        with open(filename) as f:
+            channels=json.load(f)
+    except IOError:
+        return ChannelMap()
+    return ChannelMap(channels)
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the GalvoDriver without the GUI, behind a command server on a local TCP socket, so that acquisition software
+(MetaMorph macros, Python scripts) can switch angles and lasers without anyone clicking.
+
+    python control_server.py [--port 8765] [--simulate]
+
+The protocol is one JSON request per line, answered by one JSON response per line.  A request is a command, or a list
+of commands which is applied atomically: every setting change in the list goes out in a single hardware update, and
+nothing is changed if any command in the list is invalid.  Values outside the ranges in SETTING_RANGES are invalid, and
+so are frequencies between 0 and 1Hz, as in the GUI.
+    {"cmd": "set", "values": {"radius": 1.2, "blue_laser": true}}    changes the current setting
+    {"cmd": "recall", "index": 2}                                    makes stored setting 1, 2 or 3 the current setting
+    {"cmd": "store", "index": 2}                                     stores the current setting, like the 'Save' buttons
+    {"cmd": "camera", "mode": "frame_rate", "frame_rate": 30}        changes the camera trigger (see camera_trigger.py). The
+                                                                     other keys are every, per_revolution and pulse_width
+    {"cmd": "start"}                                                 starts free running
+    {"cmd": "stop"}                                                  stops free running, or the acquisition
+    {"cmd": "acquire"}                                               starts an acquisition
+    {"cmd": "sweep", "grid": {"radius": [0.5, 0.6]}, "dwell": 0.1, "index": "sweep.txt"}
+                                                                     plays a calibration sweep (see sweep.py) and writes
+                                                                     the parameters of every frame to index, if it is given
+    {"cmd": "status"}                                                returns the state of the driver and the current setting
+The response is {"ok": true, "results": [one result per command], "ms": time taken by the server} or
+{"ok": false, "error": message}.
+
+ControlClient is a small client for Python scripts, which also measures the round trip time of every request.
+"""
+from __future__ import division
+from __future__ import print_function
+import json
+import numbers
+import socket
+import sys
+import threading
+if sys.version_info.major==2:
+    import SocketServer as socketserver
+else:
+    import socketserver
+from settings import Settings, default_setting
+from galvo_driver import GalvoDriver
+from camera_trigger import CameraTrigger
+from sweep import Sweep
+from instrumentation import clock
+
+HOST='127.0.0.1' # only local clients can connect
+PORT=8765
+SETTING_NAMES=frozenset(default_setting())
+BOOLEAN_SETTINGS=frozenset(['alternate12','alternate123','blue_laser','green_laser'])
+CAMERA_KEYS=frozenset(['mode','every','per_revolution','frame_rate','pulse_width'])
+SETTING_RANGES={'frequency':(0,500),'radius':(0,10),'ellipticity':(0,2.5),'phase':(-90,90),'x_shift':(-10000,10000),
+                'y_shift':(-10000,10000),'blue_laser_power':(-10,10),'green_laser_power':(-10,10)} # the GUI's sliders, but every voltage may use the +-10V output range
+
+
+class ControlError(Exception):
+    pass
+
+
+def check_value(key,value):
+    ''' Raises ControlError if value isn't a number within SETTING_RANGES[key].'''
+    if isinstance(value,bool) or not isinstance(value,numbers.Real):
+        raise ControlError('{} has to be a number'.format(key))
+    low,high=SETTING_RANGES[key]
+    if not low<=value<=high: # also false for nan
+        raise ControlError('{} has to be between {} and {}, not {}'.format(key,low,high,value))
+    if key=='frequency' and 0<value<1:
+        raise ControlError('frequency has to be 0, or between 1 and {}'.format(high))
+
+
+class Controller:
+    ''' Executes commands on a GalvoDriver.  Requests from every connection are serialized on the driver's lock.'''
+    def __init__(self,galvoDriver):
+        self.galvoDriver=galvoDriver
+        self.actions={'store':self.store,'start':self.start,'stop':self.stop,'acquire':self.acquire,'sweep':self.sweep,'status':self.status}
+    def execute(self,request):
+        ''' request is a command dict or a list of them.  Returns the list of results, one per command.'''
+        if isinstance(request,dict):
+            request=[request]
+        if not isinstance(request,list):
+            raise ControlError('A request is a command or a list of commands')
+        for command in request: # check everything before changing anything
+            self.validate(command)
+        s=self.galvoDriver.settings
+        results=[]
+        with self.galvoDriver.lock:
+            changes=dict()
+            camera=None
+            for command in request:
+                name=command['cmd']
+                if name=='set':
+                    changes.update(command['values'])
+                    results.append(None)
+                elif name=='recall':
+                    changes.update(s.d[command['index']])
+                    results.append(None)
+                elif name=='camera':
+                    camera=self.camera(command)
+                    results.append(None)
+                else:
+                    self.apply(changes,camera) # the action sees every change made before it in the request
+                    changes=dict()
+                    camera=None
+                    results.append(self.actions[name](command))
+            self.apply(changes,camera)
+        return results
+    def validate(self,command):
+        if not isinstance(command,dict) or 'cmd' not in command:
+            raise ControlError('A command is a dict with a "cmd" key: {!r}'.format(command))
+        name=command['cmd']
+        if name=='set':
+            values=command.get('values')
+            if not isinstance(values,dict):
+                raise ControlError('"set" needs a dict of "values"')
+            for key,value in values.items():
+                if key not in SETTING_NAMES:
+                    raise ControlError('Unknown setting {!r}'.format(key))
+                if key in BOOLEAN_SETTINGS:
+                    if not isinstance(value,bool):
+                        raise ControlError('{} has to be true or false'.format(key))
+                else:
+                    check_value(key,value)
+        elif name=='camera':
+            unknown=set(command)-CAMERA_KEYS-set(['cmd'])
+            if unknown:
+                raise ControlError('Unknown camera trigger parameters: {}'.format(', '.join(sorted(unknown))))
+            try:
+                self.camera(command)
+            except (ValueError,TypeError) as e:
+                raise ControlError(str(e))
+        elif name=='sweep':
+            grid=command.get('grid')
+            if not isinstance(grid,dict) or not all(isinstance(values,list) and all(isinstance(v,numbers.Real) and not isinstance(v,bool) for v in values) for values in grid.values()):
+                raise ControlError('"sweep" needs a "grid" of {setting: [values]}')
+            try:
+                Sweep(grid,command.get('dwell',0))
+            except (ValueError,TypeError) as e:
+                raise ControlError(str(e))
+            for key,values in grid.items():
+                for value in values:
+                    check_value(key,value)
+        elif name in ('recall','store'):
+            index=command.get('index')
+            if index not in (1,2,3) or isinstance(index,bool):
+                raise ControlError('"{}" needs an "index" of 1, 2 or 3'.format(name))
+        elif name not in self.actions:
+            raise ControlError('Unknown command {!r}'.format(name))
+    def apply(self,changes,camera=None):
+        ''' Writes the changes into the current setting, then updates the output once.  If that fails, the setting and
+        the camera trigger are put back as they were.'''
+        if not changes and camera is None:
+            return
+        s=self.galvoDriver.settings
+        saved=dict(s.d[s.i])
+        saved_camera=self.galvoDriver.camera
+        try:
+            for key,value in changes.items():
+                s[key]=value
+            if camera is not None:
+                self.galvoDriver.camera=camera
+            self.galvoDriver.refresh()
+        except Exception:
+            s.d[s.i].clear()
+            s.d[s.i].update(saved)
+            self.galvoDriver.camera=saved_camera
+            raise
+    def camera(self,command):
+        parameters=dict((str(key),value) for key,value in command.items() if key!='cmd')
+        return CameraTrigger(**parameters)
+    def store(self,command):
+        s=self.galvoDriver.settings
+        s.d[command['index']]=s.d[0].copy()
+        s.save()
+    def start(self,command):
+        if self.galvoDriver.stopped:
+            self.galvoDriver.startstop()
+    def stop(self,command):
+        if self.galvoDriver.acquiring:
+            self.galvoDriver.stopAcquiring()
+        elif not self.galvoDriver.stopped:
+            self.galvoDriver.startstop()
+    def acquire(self,command):
+        if not self.galvoDriver.acquiring:
+            self.galvoDriver.acquire()
+    def sweep(self,command):
+        sweep=Sweep(command['grid'],command['dwell'])
+        if self.galvoDriver.acquiring:
+            self.galvoDriver.stopAcquiring()
+        self.galvoDriver.sweep(sweep,command.get('index'))
+        return {'points':len(sweep),'frames':sweep.frames(),'seconds':sweep.duration()}
+    def status(self,command):
+        d=self.galvoDriver
+        plan=d.plan if d.planner is not None else None
+        status={'running':not d.stopped,'acquiring':d.acquiring,'playing':d.player is not None,'setting':dict(d.settings.d[0]),'sample_rate':d.sample_rate}
+        if plan is not None:
+            status['achieved_frequency']=plan.achieved
+            status['error_ppm']=plan.error_ppm
+            status['frame_rate']=sum(plan.triggers)*plan.sample_rate/d.sampsPerPeriod # transitions lengthen the buffer
+            status['revolutions_per_frame']=plan.revolutions_per_frame
+        status['transition_ms']=[t*1000 for t in d.transition_times]
+        status['camera']=dict(zip(('mode','every','per_revolution','frame_rate','pulse_width'),d.camera.key()))
+        timeline=d.timeline
+        if timeline is not None:
+            status['timeline']={'event':timeline.names[timeline.segment],'period':int(timeline.period)}
+        return status
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    ''' Answers the requests of one connection, one line at a time.'''
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1) # send every response as soon as it is written
+    def handle(self):
+        while True:
+            line=self.rfile.readline()
+            if not line:
+                return
+            if not line.strip():
+                continue
+            start=clock()
+            try:
+                results=self.server.controller.execute(json.loads(line.decode('utf-8')))
+                response={'ok':True,'results':results}
+            except (ControlError,ValueError) as e: # json raises ValueError on a malformed line
+                response={'ok':False,'error':str(e)}
+            except Exception as e: # the driver failed, e.g. a sweep while not streaming or a DAQ error. The connection stays open
+                response={'ok':False,'error':'{}: {}'.format(type(e).__name__,e)}
+            response['ms']=(clock()-start)*1000
+            self.wfile.write((json.dumps(response)+'\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class ControlServer(socketserver.ThreadingMixIn,socketserver.TCPServer):
+    ''' Serves a Controller on (host, port).  Every connection gets its own thread.'''
+    daemon_threads=True
+    allow_reuse_address=True
+    def __init__(self,controller,host=HOST,port=PORT):
+        self.controller=controller
+        socketserver.TCPServer.__init__(self,(host,port),ControlHandler)
+    def start(self):
+        ''' Serves from a background thread.  Returns the thread.'''
+        thread=threading.Thread(target=self.serve_forever)
+        thread.daemon=True
+        thread.start()
+        return thread
+
+
+class ControlClient:
+    ''' Sends requests to a ControlServer.  latency holds the round trip time of the last request, in seconds.'''
+    def __init__(self,host=HOST,port=PORT,timeout=10):
+        self.socket=socket.create_connection((host,port),timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        self.file=self.socket.makefile('rb')
+        self.latency=None
+    def request(self,request):
+        ''' Sends a command or a list of commands, and returns the list of results.'''
+        start=clock()
+        self.socket.sendall((json.dumps(request)+'\n').encode('utf-8'))
+        line=self.file.readline()
+        self.latency=clock()-start
+        if not line:
+            raise ControlError('The server closed the connection')
+        response=json.loads(line.decode('utf-8'))
+        if not response['ok']:
+            raise ControlError(response['error'])
+        return response['results']
+    def set(self,**values):
+        self.request({'cmd':'set','values':values})
+    def recall(self,index):
+        self.request({'cmd':'recall','index':index})
+    def store(self,index):
+        self.request({'cmd':'store','index':index})
+    def start(self):
+        self.request({'cmd':'start'})
+    def stop(self):
+        self.request({'cmd':'stop'})
+    def acquire(self):
+        self.request({'cmd':'acquire'})
+    def sweep(self,grid,dwell,index=None):
+        ''' Returns the number of points and frames of the sweep and how long it lasts.'''
+        command={'cmd':'sweep','grid':dict((name,[float(v) for v in values]) for name,values in grid.items()),'dwell':dwell}
+        if index is not None:
+            command['index']=index
+        return self.request(command)[0]
+    def camera(self,mode='revolution',**parameters):
+        parameters.update(cmd='camera',mode=mode)
+        self.request(parameters)
+    def status(self):
+        return self.request({'cmd':'status'})[0]
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+if __name__=='__main__':
+    import argparse
+    parser=argparse.ArgumentParser(description='Runs the galvo driver without the GUI, controlled through a local TCP socket.')
+    parser.add_argument('--host',default=HOST)
+    parser.add_argument('--port',type=int,default=PORT)
+    parser.add_argument('--simulate',action='store_true',help='runs against a simulated DAQ instead of the NI card')
+    parser.add_argument('--raw',action='store_true',help='writes int16 DAC codes instead of float64 volts')
+    args=parser.parse_args()
+    backend=None
+    if args.simulate:
+        from daq_backend import SimulatedBackend
+        backend=SimulatedBackend(record_data=False)
+    galvoDriver=GalvoDriver(Settings(),backend)
+    if args.raw:
+        galvoDriver.setRaw(True)
+    server=ControlServer(Controller(galvoDriver),args.host,args.port)
+    print('Listening on {}:{}'.format(args.host,args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if not galvoDriver.stopped:
+            galvoDriver.startstop()
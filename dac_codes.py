@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Converts output buffers from volts to the DAC's native int16 codes.
+
+WriteAnalogF64 takes 8 bytes per sample, and DAQmx scales every sample to a DAC code on the host each time it is written.
+WriteBinaryI16 takes the codes themselves, 2 bytes per sample.  Buffers are converted once, when they are computed, with
+the calibration of each channel: DAQmx_AO_DevScalingCoeff, the coefficients of the polynomial
+    code = c[0] + c[1]*V + c[2]*V**2 + ...
+so the cached buffers and everything streamed to the card are 4 times smaller.
+
+    python dac_codes.py     checks that the codes of random settings match the float64 path within one LSB
+"""
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+
+INT16_MIN=-32768
+INT16_MAX=32767
+
+
+def exact_codes(volts,coefficients,out=None):
+    ''' Evaluates the calibration polynomial of one channel on a row of volts, without rounding.'''
+    if out is None:
+        out=np.empty(len(volts))
+    out.fill(coefficients[-1])
+    for c in coefficients[-2::-1]: # Horner's method, in place
+        out*=volts
+        out+=c
+    return out
+
+
+def to_codes(data,coefficients,out=None):
+    ''' data is a (channels x samples) array of volts and coefficients holds the calibration polynomial of every channel.
+    Returns the int16 codes, rounded to the nearest code and clipped to the range of the DAC.'''
+    if out is None:
+        out=np.empty(data.shape,dtype=np.int16)
+    scratch=np.empty(data.shape[1])
+    for row,c in enumerate(coefficients):
+        exact_codes(data[row],c,scratch)
+        np.rint(scratch,out=scratch)
+        np.clip(scratch,INT16_MIN,INT16_MAX,out=scratch)
+        out[row]=scratch
+    return out
+
+
+def to_volts(codes,coefficients):
+    ''' The inverse of to_codes() for linear calibrations (only c[0] and c[1] are used).'''
+    out=np.empty(codes.shape)
+    for row,c in enumerate(coefficients):
+        np.subtract(codes[row],c[0],out=out[row])
+        out[row]/=c[1]
+    return out
+
+
+def error_lsb(data,codes,coefficients):
+    ''' The largest difference, in LSB, between codes and the exact code of every sample of data.  Samples which are
+    outside the range of the DAC, and so are clipped by both paths, are ignored.'''
+    worst=0.
+    exact=np.empty(data.shape[1])
+    for row,c in enumerate(coefficients):
+        exact_codes(data[row],c,exact)
+        inside=(exact>=INT16_MIN)&(exact<=INT16_MAX)
+        if np.any(inside):
+            worst=max(worst,float(np.max(np.abs(codes[row][inside]-exact[inside]))))
+    return worst
+
+
+def check(n_settings=200,seed=0):
+    ''' Renders random settings with the float64 path, converts them, and compares the voltages the simulated DAQ outputs
+    on both paths.  Returns the largest difference in LSB.'''
+    from waveform_engine import WaveformEngine
+    from daq_backend import SimulatedBackend
+    from settings import default_setting
+    rng=np.random.RandomState(seed)
+    task=SimulatedBackend().createTask()
+    coefficients=task.scalingCoefficients()
+    engine=WaveformEngine(1000000)
+    worst=0.
+    for i in range(n_settings):
+        setting=default_setting()
+        setting.update(frequency=rng.uniform(1,500),radius=rng.uniform(0,.6),ellipticity=rng.uniform(0,2.5),phase=rng.uniform(-90,90),
+                       x_shift=rng.uniform(-1,1),y_shift=rng.uniform(-1,1),blue_laser=rng.rand()<.5,green_laser=rng.rand()<.5,
+                       blue_laser_power=rng.uniform(-.08,5),green_laser_power=rng.uniform(-.08,5))
+        data,n=engine.render([setting])
+        codes=to_codes(data,coefficients)
+        worst=max(worst,error_lsb(data,codes,coefficients))
+        output=to_volts(codes,coefficients) # what the DAC outputs for the codes
+        for row,c in enumerate(coefficients):
+            worst=max(worst,float(np.max(np.abs(output[row]-data[row])))*c[1])
+    return worst
+
+
+if __name__=='__main__':
+    worst=check()
+    print('Largest difference between the int16 and the float64 paths: {:.3f} LSB'.format(worst))
+    if worst>1:
+        raise SystemExit('The int16 path is more than one LSB away from the float64 path')
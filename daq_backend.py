@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+The interface between the GalvoDriver and the DAQ.
+
+A backend creates analog output tasks.  A task has the handful of operations the GalvoDriver needs:
+    configureClock(sample_rate, sampsPerChan, source)   continuous generation. sampsPerChan sets the size of the output buffer.
+                                                source is the terminal of the sample clock, '' for the device's own
+    setStartTrigger(source)                     start() arms the task, and it starts when the trigger on source fires
+    setRegeneration(allow)                      whether the DAQ loops over the buffer or expects to be fed new samples
+    write(data, sampsPerChan, timeout)          data is a (channels x samples) float64 array, in volts
+    writeRaw(data, sampsPerChan, timeout)       data is a (channels x samples) int16 array of DAC codes (see dac_codes.py)
+    scalingCoefficients()                       the calibration polynomial which turns volts into codes, for every channel
+    registerEveryNSamplesEvent(nSamples, callback)   callback() is called every nSamples transferred from the buffer
+    start(), stop(), clear()
+
+NIDAQmxBackend drives the real card through PyDAQmx.  SimulatedBackend is a software stand-in which consumes samples in
+real time and records every write and callback with timestamps, so the driver can be run and timed without the card.
+
+A task only has channels on one device.  SynchronizedTask runs one task per device behind the same interface, with every
+device on the sample clock and start trigger of the first one.
+"""
+from __future__ import division
+import threading
+import time
+from collections import deque
+from ctypes import byref
+import numpy as np
+from dac_codes import to_volts
+
+clock=getattr(time,'perf_counter',time.time) # a monotonic, high resolution clock where available
+
+AO_CHANNELS=[ # (physical channel, minimum voltage, maximum voltage), in the order of the rows of the output buffer
+    ('Dev2/ao2',-10.0,10.0), #On the NI PCI-6733, ao2 is pin 57 and ground is 56. This is the sine wave
+    ('Dev2/ao3',-10.0,10.0), #On the NI PCI-6733, ao3 is pin 25 and ground is 24. This is the cosine wave
+    ('Dev2/ao4',-10.0,10.0), #On the NI PCI-6733, ao4 is pin 60 and ground is 59. This is the camera ttl
+    ('Dev2/ao5',-10.0,10.0), #On the NI PCI-6733, ao5 is pin 28 and ground is 29. This is blue laser
+    ('Dev2/ao6',-10.0,10.0)] #On the NI PCI-6733, ao6 is pin 30 and ground is 31. This is green laser
+
+
+class DAQError(Exception):
+    pass
+
+
+class NIDAQmxBackend:
+    ''' Creates tasks on a National Instruments card through PyDAQmx.'''
+    def __init__(self):
+        import PyDAQmx # imported here so that the rest of the program runs on computers without NIDAQmx
+        self.daqmx=PyDAQmx
+    def createTask(self,channels=AO_CHANNELS):
+        return NIDAQmxTask(self.daqmx,channels)
+
+
+class NIDAQmxTask:
+    def __init__(self,daqmx,channels):
+        self.daqmx=daqmx
+        self.channels=channels
+        self.task=daqmx.Task()
+        for name,minimum,maximum in channels:
+            self.task.CreateAOVoltageChan(name,"",minimum,maximum,daqmx.DAQmx_Val_Volts,None)
+        self.read=daqmx.int32()
+    def configureClock(self,sample_rate,sampsPerChan,source=''):
+                        #  CfgSampClkTiming(source, rate, activeEdge, sampleMode, sampsPerChan)
+        self.task.CfgSampClkTiming(source,sample_rate,self.daqmx.DAQmx_Val_Rising,self.daqmx.DAQmx_Val_ContSamps,sampsPerChan)
+    def setStartTrigger(self,source):
+        self.task.CfgDigEdgeStartTrig(source,self.daqmx.DAQmx_Val_Rising)
+    def setRegeneration(self,allow):
+        self.task.SetWriteRegenMode(self.daqmx.DAQmx_Val_AllowRegen if allow else self.daqmx.DAQmx_Val_DoNotAllowRegen)
+    def write(self,data,sampsPerChan,timeout=-1):
+                        #  WriteAnalogF64(numSampsPerChan, autoStart, timeout, dataLayout, writeArray, sampsPerChanWritten, reserved)
+        self.task.WriteAnalogF64(sampsPerChan,0,timeout,self.daqmx.DAQmx_Val_GroupByChannel,data,byref(self.read),None)
+        return self.read.value
+    def writeRaw(self,data,sampsPerChan,timeout=-1):
+                        #  WriteBinaryI16(numSampsPerChan, autoStart, timeout, dataLayout, writeArray, sampsPerChanWritten, reserved)
+        self.task.WriteBinaryI16(sampsPerChan,0,timeout,self.daqmx.DAQmx_Val_GroupByChannel,data,byref(self.read),None)
+        return self.read.value
+    def scalingCoefficients(self):
+        coefficients=[]
+        for name,minimum,maximum in self.channels:
+            c=np.zeros(4) # the PCI-6733 uses two of them
+            self.task.GetAODevScalingCoeff(name,c,len(c))
+            coefficients.append(c)
+        return coefficients
+    def registerEveryNSamplesEvent(self,nSamples,callback):
+        def EveryNCallback_py(taskHandle,eventType,nSamples,callbackData):
+            callback()
+            return 0 # The function should return an integer
+        self.EveryNCallback=self.daqmx.DAQmxEveryNSamplesEventCallbackPtr(EveryNCallback_py) # a reference is kept so the callback isn't garbage collected
+        self.daqmx.DAQmxRegisterEveryNSamplesEvent(self.task.taskHandle,self.daqmx.DAQmx_Val_Transferred_From_Buffer,nSamples,0,self.EveryNCallback,None)
+    def start(self):
+        self.task.StartTask()
+    def stop(self):
+        self.task.StopTask()
+    def clear(self):
+        self.task.ClearTask()
+
+
+class SimulatedBackend:
+    ''' Creates SimulatedTasks.  max_sample_rate is the fastest clock the simulated device accepts, 1MHz like the PCI-6733.
+    If record_data is True, a copy of everything written is kept in task.writes.'''
+    def __init__(self,max_sample_rate=1000000,record_data=True):
+        self.max_sample_rate=max_sample_rate
+        self.record_data=record_data
+        self.tasks=[]
+        self.armed=dict() # {start trigger terminal: [tasks waiting for it]}
+    def createTask(self,channels=AO_CHANNELS):
+        task=SimulatedTask(channels,self.max_sample_rate,self.record_data,self)
+        self.tasks.append(task)
+        return task
+    def arm(self,terminal,task):
+        self.armed.setdefault(terminal,[]).append(task)
+    def disarm(self,task):
+        for tasks in self.armed.values():
+            if task in tasks:
+                tasks.remove(task)
+    def fire(self,terminal,source):
+        ''' Starts every task armed on terminal, at the start time of source, the task which fired.  A task which takes
+        its sample clock from source is clocked by it, so it outputs exactly as many samples.'''
+        for task in self.armed.pop(terminal,[]):
+            if task.clock_source=='/{}/ao/SampleClock'.format(source.device):
+                task.begin(source.start_time,source)
+            else:
+                task.begin(source.start_time)
+
+
+class SimulatedTask:
+    ''' Behaves like a continuous analog output task.  Once started, a background thread moves samples out of the buffer
+    at the sample rate, in real time, and fires the every N samples callback from that thread, as DAQmx does.  A task
+    which takes its sample clock from another task has no thread: the other task's thread moves its samples too.
+    It records:
+        writes      one dict per write: 'time', 'sample' (the index of the first sample of the write in the output), 'samples', 'data'
+        callbacks   one (time, sample) pair per callback. The callback was due at start_time+sample/sample_rate
+        underflows  the number of times the buffer ran empty while not regenerating. Like the card, the task stops.
+    '''
+    tick=.0005 # how long the generation thread sleeps between moving samples, in seconds
+    scaling_coefficients=(-1.5,3275.9) # a calibrated 16 bit DAC with a range of +-10V is a little off the nominal 0 and 3276.8 codes per volt
+    def __init__(self,channels,max_sample_rate=1000000,record_data=True,backend=None):
+        self.channels=channels
+        self.n_channels=len(channels)
+        self.device=channels[0][0].split('/')[0]
+        self.backend=backend # routes start triggers to the other tasks of the backend
+        self.clock_source=''
+        self.start_trigger=None
+        self.max_sample_rate=max_sample_rate
+        self.record_data=record_data
+        self.sample_rate=None
+        self.buffer_size=0
+        self.regenerate=True
+        self.condition=threading.Condition()
+        self.regeneration_buffer=None
+        self.queue=deque() # blocks waiting to be output when not regenerating, as [array, index of the next sample]
+        self.queued=0
+        self.written=0 # samples written since the task was started
+        self.transferred=0 # samples output since the task was started
+        self.nSamples=None
+        self.callback=None
+        self.running=False
+        self.generation=0 # incremented by stop(), so that a write which was waiting for space when the task stopped is dropped
+        self.thread=None
+        self.followers=[] # the tasks clocked by this one
+        self.clock_master=None # the task this one is clocked by
+        self.start_time=None
+        self.last_sample=np.zeros(self.n_channels) # the voltage each channel holds
+        self.writes=[]
+        self.callbacks=[]
+        self.underflows=0
+    def configureClock(self,sample_rate,sampsPerChan,source=''):
+        if sample_rate>self.max_sample_rate:
+            raise DAQError('Sample rate {} is above the maximum of {}'.format(sample_rate,self.max_sample_rate))
+        with self.condition:
+            self.sample_rate=sample_rate
+            self.buffer_size=sampsPerChan
+            self.clock_source=source # a task triggered by the task which owns this clock runs from the same start time, so it stays in step
+    def setStartTrigger(self,source):
+        self.start_trigger=source
+    def setRegeneration(self,allow):
+        self.regenerate=allow
+    def write(self,data,sampsPerChan,timeout=-1):
+        data=np.array(np.asarray(data,dtype=np.float64).reshape(self.n_channels,-1)[:,:sampsPerChan]) # the card copies the samples into its own buffer
+        with self.condition:
+            if self.regenerate:
+                self.regeneration_buffer=data
+                first_sample=self.transferred
+            else:
+                deadline=None if timeout<0 else clock()+timeout
+                generation=self.generation
+                while self.running and self.queued+sampsPerChan>self.buffer_size:
+                    remaining=None if deadline is None else deadline-clock()
+                    if remaining is not None and remaining<=0:
+                        raise DAQError('Timed out waiting for space in the output buffer')
+                    self.condition.wait(remaining)
+                if generation!=self.generation:
+                    return 0
+                first_sample=self.written
+                self.queue.append([data,0])
+                self.queued+=sampsPerChan
+                self.written+=sampsPerChan
+            self.writes.append({'time':clock(),'sample':first_sample,'samples':sampsPerChan,'data':data if self.record_data else None})
+        return sampsPerChan
+    def writeRaw(self,data,sampsPerChan,timeout=-1):
+        ''' Converts the codes to the voltages the DAC would output, which is what is recorded in writes.'''
+        data=np.asarray(data).reshape(self.n_channels,-1)[:,:sampsPerChan]
+        return self.write(to_volts(data,self.scalingCoefficients()),sampsPerChan,timeout)
+    def scalingCoefficients(self):
+        return [np.array(self.scaling_coefficients) for channel in self.channels]
+    def registerEveryNSamplesEvent(self,nSamples,callback):
+        self.nSamples=nSamples
+        self.callback=callback
+    def start(self):
+        with self.condition:
+            if self.sample_rate is None:
+                raise DAQError('The sample clock has not been configured')
+            if (self.regenerate and self.regeneration_buffer is None) or (not self.regenerate and self.queued==0):
+                raise DAQError('Generation cannot be started because the output buffer is empty')
+        if self.start_trigger is not None:
+            self.backend.arm(self.start_trigger,self)
+            return
+        self.begin(clock())
+        if self.backend is not None:
+            self.backend.fire('/{}/ao/StartTrigger'.format(self.device),self)
+    def begin(self,start_time,clock_master=None):
+        with self.condition:
+            self.transferred=0
+            self.running=True
+            self.start_time=start_time
+        if clock_master is not None:
+            self.clock_master=clock_master
+            clock_master.followers.append(self)
+            return
+        self.thread=threading.Thread(target=self.run)
+        self.thread.daemon=True
+        self.thread.start()
+    def stop(self):
+        if self.backend is not None:
+            self.backend.disarm(self)
+        with self.condition:
+            self.running=False
+            self.generation+=1
+            self.queue.clear() # unlike a regenerated buffer, samples which were queued are not output after a restart
+            self.queued=0
+            self.written=0
+            self.condition.notify_all()
+        if self.clock_master is not None:
+            if self in self.clock_master.followers:
+                self.clock_master.followers.remove(self)
+            self.clock_master=None
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread=None
+    def clear(self):
+        self.stop()
+    def run(self):
+        while self.running:
+            time.sleep(self.tick)
+            due=int((clock()-self.start_time)*self.sample_rate)
+            while self.running and self.transferred<due:
+                n=due-self.transferred
+                if self.callback is not None: # stop at the next callback boundary
+                    n=min(n,self.nSamples-self.transferred%self.nSamples)
+                if not self.transfer(n):
+                    return
+                for follower in list(self.followers): # they are clocked by this task, so they move on by the same samples
+                    follower.transfer(n)
+                if self.callback is not None and self.transferred%self.nSamples==0:
+                    self.callbacks.append((clock(),self.transferred))
+                    self.callback()
+    def transfer(self,n):
+        ''' Moves n samples out of the buffer.  Returns False if the buffer ran empty.'''
+        with self.condition:
+            if not self.running:
+                return False
+            if self.regenerate:
+                self.last_sample=self.regeneration_buffer[:,(self.transferred+n-1)%self.regeneration_buffer.shape[1]]
+                self.transferred+=n
+                return True
+            while n>0:
+                if not self.queue:
+                    self.underflows+=1
+                    self.running=False
+                    return False
+                block=self.queue[0]
+                data,position=block
+                m=min(n,data.shape[1]-position)
+                block[1]+=m
+                if block[1]==data.shape[1]:
+                    self.queue.popleft()
+                self.last_sample=data[:,position+m-1]
+                self.queued-=m
+                self.transferred+=m
+                n-=m
+            self.condition.notify_all()
+            return True
+
+
+class SynchronizedTask:
+    ''' Drives several devices as one task.  devices is a list of (device name, channels) pairs, and the rows of the data
+    written are split between the devices in that order.  The first device is the master: the other devices take their
+    sample clock and start trigger from it (on PCI cards, through the RTSI cable), and are armed before it starts, so
+    every channel starts on the same clock edge.  The every N samples event is the master's.'''
+    def __init__(self,backend,devices):
+        self.master=devices[0][0]
+        self.tasks=[backend.createTask(channels) for name,channels in devices]
+        self.rows=[]
+        start=0
+        for name,channels in devices:
+            self.rows.append((start,start+len(channels)))
+            start+=len(channels)
+        for task in self.tasks[1:]:
+            task.setStartTrigger('/{}/ao/StartTrigger'.format(self.master))
+    def configureClock(self,sample_rate,sampsPerChan,source=''):
+        self.tasks[0].configureClock(sample_rate,sampsPerChan,source)
+        for task in self.tasks[1:]:
+            task.configureClock(sample_rate,sampsPerChan,'/{}/ao/SampleClock'.format(self.master))
+    def setStartTrigger(self,source):
+        self.tasks[0].setStartTrigger(source)
+    def setRegeneration(self,allow):
+        for task in self.tasks:
+            task.setRegeneration(allow)
+    def write(self,data,sampsPerChan,timeout=-1):
+        for task,(start,stop) in zip(self.tasks,self.rows):
+            written=task.write(data[start:stop],sampsPerChan,timeout)
+        return written
+    def writeRaw(self,data,sampsPerChan,timeout=-1):
+        for task,(start,stop) in zip(self.tasks,self.rows):
+            written=task.writeRaw(data[start:stop],sampsPerChan,timeout)
+        return written
+    def scalingCoefficients(self):
+        return [c for task in self.tasks for c in task.scalingCoefficients()]
+    def registerEveryNSamplesEvent(self,nSamples,callback):
+        self.tasks[0].registerEveryNSamplesEvent(nSamples,callback)
+    def start(self):
+        for task in self.tasks[1:]+self.tasks[:1]: # the master last, since starting it fires the start trigger
+            task.start()
+    def stop(self):
+        for task in self.tasks:
+            task.stop()
+    def clear(self):
+        for task in self.tasks:
+            task.clear()
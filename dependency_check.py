@@ -1,14 +1,17 @@
 # -*- coding: utf-8 -*-
+"""
+Installs the dependencies which are missing.  Importing this module runs the check.
+
+Probing every dependency means importing it, which is slow.  Once every dependency has been found, a fingerprint of the
+environment (the python executable and version, and the modification times of the site-packages directories, which
+change whenever a package is installed or removed) is saved to ~/.ShadowlessTIRF/dependency_check.txt.  While the
+fingerprint is unchanged, the check is skipped without importing anything.
+"""
 import os
 from os.path import basename, expanduser
-import pip
 from sys import platform as _platform
 import sys
 from importlib import import_module
-if sys.version_info.major==2:
-    from urllib2 import Request, urlopen
-elif sys.version_info.major==3:
-    from urllib.request import Request, urlopen
 dependencies_pypi=['PyDAQmx']
 dependencies_gohlke=['PyQt4','numpy']
 
@@ -18,27 +21,50 @@ if is_64bits:
     fnames_suffix="-cp"+pyversion+"-none-win_amd64.whl"
 else:
     fnames_suffix="-cp"+pyversion+"-none-win32.whl"
-    
+
 dependency_fnames={
     'PyQt4':'PyQt4-4.11.4',
     'numpy':'numpy-1.9.2+mkl'}
 base_url='http://www.lfd.uci.edu/~gohlke/pythonlibs/3i673h27/'
-    
-old_cwd=os.getcwd()
+
 flika_dir=os.path.join(expanduser("~"),'.ShadowlessTIRF')
-if not os.path.exists(flika_dir):
-    os.makedirs(flika_dir)
-os.chdir(flika_dir)
-            
+fingerprint_file=os.path.join(flika_dir,'dependency_check.txt')
+
+def fingerprint():
+    ''' Returns a string which changes when the python installation or its installed packages change.'''
+    lines=[sys.executable,sys.version,_platform,' '.join(dependencies_gohlke+dependencies_pypi)]
+    for path in sys.path:
+        if basename(path) in ('site-packages','dist-packages') and os.path.isdir(path):
+            lines.append('{} {}'.format(path,os.stat(path).st_mtime))
+    return '\n'.join(lines)
+
+def fingerprint_matches(current):
+    try:
+        with open(fingerprint_file) as f:
+            return f.read()==current
+    except IOError:
+        return False
+
+def save_fingerprint(current):
+    if not os.path.exists(flika_dir):
+        os.makedirs(flika_dir)
+    with open(fingerprint_file,'w') as f:
+        f.write(current)
+
 def download_file(download_url):
+    if sys.version_info.major==2:
+        from urllib2 import Request, urlopen
+    else:
+        from urllib.request import Request, urlopen
     req = Request(download_url,headers={'User-Agent':"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/43.0.2357.132 Safari/537.36"})
     response = urlopen(req)
     file = open(basename(download_url), 'wb')
     the_page=response.read()
     file.write(the_page)
     file.close()
-    
+
 def install(dep):
+    import pip # slow to import, and only needed when something is missing
     try:
         pip.main(['install', dep])
     except IOError:
@@ -49,40 +75,61 @@ def install(dep):
             print('python dependency_check.py')
             print('\n\n\n')
             print('This should install all the dependencies.  You only need to do this once.')
-    
-if _platform != "win32":
-    print("This software has only been tested on Windows 7.  In order to run it on a different operating system, you'll need to manually install the dependencies.")
-    
-if _platform == 'win32':
-    for dep in dependencies_gohlke:
+
+def install_gohlke(dep):
+    ''' Downloads the wheel into ~/.ShadowlessTIRF and installs it.'''
+    old_cwd=os.getcwd()
+    if not os.path.exists(flika_dir):
+        os.makedirs(flika_dir)
+    os.chdir(flika_dir)
+    try:
+        fname=dependency_fnames[dep]+fnames_suffix
+        if not os.path.isfile(fname):
+            print('Downloading {}'.format(dep))
+            download_file(base_url+fname)
+        print('Installing {}'.format(dep))
+        install(fname)
         try:
             import_module(dep)
-        except ImportError:
-            
-            fname=dependency_fnames[dep]+fnames_suffix
-            if not os.path.isfile(fname):
-                print('Downloading {}'.format(dep))
-                download_file(base_url+fname)
-            print('Installing {}'.format(dep))
-            install(fname)
+            os.remove(fname) #if the installation was successful, remove the .whl file
+        except:
+            pass #if it wasn't successful, keep the .whl file.
+    finally:
+        os.chdir(old_cwd)
+
+def check():
+    ''' Installs the missing dependencies, unless the environment is the one which was last found to have them all.'''
+    current=fingerprint()
+    if fingerprint_matches(current):
+        return
+    if _platform != "win32":
+        print("This software has only been tested on Windows 7.  In order to run it on a different operating system, you'll need to manually install the dependencies.")
+
+    if _platform == 'win32':
+        for dep in dependencies_gohlke:
             try:
                 import_module(dep)
-                os.remove(fname) #if the installation was successful, remove the .whl file
-            except:
-                pass #if it wasn't successful, keep the .whl file.
-else:
-    print("I haven't yet coded how to install binaries for non-Windows systems")
+            except ImportError:
+                install_gohlke(dep)
+    else:
+        print("I haven't yet coded how to install binaries for non-Windows systems")
 
-for dep in dependencies_pypi:
-    try:
-        import_module(dep)
-    except ImportError as e:
-        if sys.version_info.major==2:
-            if e.message=='No module named {}'.format(dep):
-                install(dep)
-        elif sys.version_info.major==3:
-            if e.msg=="No module named '{}'".format(dep):
-                install(dep)
-        
+    for dep in dependencies_pypi:
+        try:
+            import_module(dep)
+        except ImportError as e:
+            if sys.version_info.major==2:
+                if e.message=='No module named {}'.format(dep):
+                    install(dep)
+            elif sys.version_info.major==3:
+                if e.msg=="No module named '{}'".format(dep):
+                    install(dep)
 
+    for dep in dependencies_gohlke+dependencies_pypi:
+        try:
+            import_module(dep)
+        except ImportError:
+            return # something is still missing, so check again next time
+    save_fingerprint(fingerprint()) # installing changed the site-packages directories, so the fingerprint is taken again
 
+check()
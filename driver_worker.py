@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the GalvoDriver in a worker process of its own.
+
+In one process, the DAQ's every N samples callback shares the interpreter with Qt: while a long redraw or a pickle of the
+settings holds the GIL, the callback which refills the device's buffer waits.  DriverProcess starts the GalvoDriver in
+a separate process, where nothing but the driver runs, and stands in for it in the GUI.  It has the settings, the
+callbacks and the methods the GUI and the UpdateScheduler use, and turns each call into a command sent over a pipe:
+    ('refresh', settings.d, settings.i)   ('startstop',)   ('acquire',)   ('stopAcquiring',)
+    ('setRaw', raw)   ('setCamera', camera)   ('setCompensator', compensator)   ('setTransitions', transitions)
+    ('sweep', sweep, index_file)   ('setEventLog', filename)   ('release',)   ('close',)
+Sending a command never waits for the worker, so the GUI can't stall the output, and the worker never waits for the GUI.
+The worker sends events back over the same pipe, which a thread of DriverProcess receives:
+    ('status', {...})       the state of the driver after every command: stopped, acquiring, sample_rate, coefficients,
+                            transition_times
+    ('settings', changes)   {(setting index, name): value} for the settings the driver changed itself, like stopping does
+    ('plan', plan)          a new WaveformPlan
+    ('data', shape, dtype)  a new output buffer is in the shared memory block, or doesn't fit in it if shape is None
+    ('finished',)           an acquisition finished
+    ('error', message)      a command failed
+
+Output buffers are megabytes, so they don't go through the pipe.  The worker copies each new one into a shared memory
+block and only sends its shape.  The receiving thread copies it out and hands the block back with ('release',); the
+worker only writes the block again once it has it back.  A buffer made while the block is out is held, and only the
+latest one is sent when the block comes back, so a slow GUI sees fewer buffers but never holds up the worker.
+
+    python driver_worker.py
+checks, against the SimulatedBackend, that commands reach the worker and events come back, and times a round trip.
+"""
+from __future__ import division
+from __future__ import print_function
+import multiprocessing
+import threading
+from functools import partial
+import numpy as np
+from daq_backend import SimulatedBackend
+from channel_map import load_channel_map
+from instrumentation import clock
+from event_log import EventLog, STOP
+from waveform_engine import SIN
+
+SHARED_BYTES=64*2**20 # a buffer of a million samples on 5 channels is 40 MB in volts
+
+
+def shared_array(shared,shape,dtype):
+    ''' Returns a numpy array of the given shape and dtype at the start of the shared memory block, without copying.'''
+    dtype=np.dtype(dtype)
+    size=int(np.prod(shape))
+    return np.frombuffer(shared,dtype=np.uint8)[:size*dtype.itemsize].view(dtype).reshape(shape)
+
+
+def run_worker(connection,shared,backend,channel_map,d,i):
+    ''' The worker process.  backend is a function which creates the backend, NIDAQmxBackend if it is None.'''
+    from settings import Settings
+    from galvo_driver import GalvoDriver
+    try:
+        settings=Settings()
+        settings.d=d
+        settings.i=i
+        driver=GalvoDriver(settings,backend() if backend is not None else None,channel_map)
+    except Exception as e:
+        connection.send(('error','The galvo driver could not be started: {}'.format(e)))
+        return
+    Worker(connection,shared,driver).run()
+
+
+class Worker:
+    ''' Executes the commands which arrive on connection on driver, and sends its events back.'''
+    def __init__(self,connection,shared,driver):
+        self.connection=connection
+        self.shared=shared
+        self.driver=driver
+        self.send_lock=threading.Lock() # events are sent from the command loop and from the driver's threads
+        self.block_lock=threading.Lock()
+        self.block_free=True # False while the GUI holds the shared memory block
+        self.held=None # the newest buffer which couldn't be sent because the block was out
+        self.commands={'refresh':self.refresh,'startstop':driver.startstop,'acquire':driver.acquire,'stopAcquiring':driver.stopAcquiring,
+                       'setRaw':driver.setRaw,'setCamera':driver.setCamera,'setCompensator':driver.setCompensator,
+                       'setTransitions':driver.setTransitions,'sweep':driver.sweep,'setEventLog':self.setEventLog,'release':self.release}
+        driver.plan_callbacks.append(lambda plan: self.send(('plan',plan)))
+        driver.data_callbacks.append(self.publish)
+        driver.finished_acquire_callbacks.append(self.finished)
+        driver.error_callbacks.append(self.failed)
+        if driver.plan is not None:
+            self.send(('plan',driver.plan))
+        self.publish(driver.data)
+        self.sendStatus()
+    def send(self,event):
+        with self.send_lock:
+            self.connection.send(event)
+    def sendStatus(self):
+        d=self.driver
+        self.send(('status',{'stopped':d.stopped,'acquiring':d.acquiring,'sample_rate':d.sample_rate,'coefficients':d.coefficients,'transition_times':d.transition_times}))
+    def refresh(self,d,i):
+        with self.driver.lock:
+            self.driver.settings.d=d
+            self.driver.settings.i=i
+            self.driver.refresh()
+    def setEventLog(self,filename):
+        ''' The log is opened here, in the worker, which is where the output is.'''
+        self.driver.setEventLog(EventLog(filename) if filename is not None else None)
+    def publish(self,data):
+        with self.block_lock:
+            if not self.block_free:
+                self.held=data
+                return
+            if data is None or data.nbytes>len(self.shared):
+                self.send(('data',None,None))
+                return
+            shared_array(self.shared,data.shape,data.dtype)[...]=data
+            self.block_free=False
+            self.send(('data',data.shape,data.dtype.str))
+    def release(self):
+        with self.block_lock:
+            self.block_free=True
+            data=self.held
+            self.held=None
+        if data is not None:
+            self.publish(data)
+    def finished(self):
+        self.sendStatus()
+        self.send(('finished',))
+    def failed(self,error):
+        self.sendStatus()
+        self.send(('error','The output stopped: {}'.format(error)))
+    def settingsChanges(self,before):
+        d=self.driver.settings.d
+        return dict(((i,name),value) for i in range(len(d)) for name,value in d[i].items() if before[i].get(name)!=value)
+    def run(self):
+        while True:
+            try:
+                command=self.connection.recv()
+            except EOFError: # the GUI has gone
+                command=('close',)
+            if command[0]=='close':
+                with self.driver.lock:
+                    self.driver.logEvent(STOP)
+                    self.driver.analog_output.stop()
+                    self.driver.analog_output.clear()
+                return
+            before=[dict(setting) for setting in self.driver.settings.d]
+            try:
+                self.commands[command[0]](*command[1:])
+            except Exception as e:
+                self.send(('error','{} failed: {}'.format(command[0],e)))
+            if command[0]=='release':
+                continue
+            changes=self.settingsChanges(before)
+            if changes and command[0]!='refresh': # a refresh only applies settings the GUI already has
+                self.send(('settings',changes))
+            self.sendStatus()
+
+
+class DriverProcess:
+    ''' Stands in for a GalvoDriver which runs in a worker process.  backend is a function which creates the backend in
+    the worker, like partial(SimulatedBackend, record_data=False); by default it is the NIDAQmxBackend.  The constructor
+    returns once the worker is outputting, like the GalvoDriver's.  The callbacks are called from the thread which
+    receives the worker's events.'''
+    def __init__(self,settings,backend=None,channel_map=None,shared_bytes=SHARED_BYTES,timeout=30):
+        self.settings=settings
+        if channel_map is None:
+            channel_map=load_channel_map()
+        self.channel_map=channel_map
+        self.lock=threading.RLock() # held while the settings are changed, as with the GalvoDriver's
+        self.send_lock=threading.Lock()
+        self.plan=None
+        self.data=None # a copy of the buffer the worker is outputting
+        self.coefficients=None
+        self.sample_rate=None
+        self.transition_times=[]
+        self.stopped=False
+        self.acquiring=False
+        self.plan_callbacks=[]
+        self.data_callbacks=[]
+        self.finished_acquire_callbacks=[]
+        self.error_callbacks=[] # called with the message of every command which failed in the worker
+        self.last_status=None # the time the last status arrived, from clock()
+        self.status_event=threading.Event()
+        self.shared=multiprocessing.RawArray('b',shared_bytes)
+        self.connection,child=multiprocessing.Pipe()
+        self.process=multiprocessing.Process(target=run_worker,args=(child,self.shared,backend,channel_map,settings.d,settings.i))
+        self.process.daemon=True
+        self.process.start()
+        child.close()
+        self.error=None
+        self.receiver=threading.Thread(target=self.receive)
+        self.receiver.daemon=True
+        self.receiver.start()
+        if not self.status_event.wait(timeout):
+            raise RuntimeError('The galvo driver worker did not start within {} seconds'.format(timeout))
+        if self.error is not None:
+            raise RuntimeError(self.error)
+    def send(self,command):
+        with self.send_lock:
+            self.connection.send(command)
+    def receive(self):
+        while True:
+            try:
+                event=self.connection.recv()
+            except (EOFError,IOError):
+                self.status_event.set()
+                return
+            kind=event[0]
+            if kind=='status':
+                for name,value in event[1].items():
+                    setattr(self,name,value)
+                self.last_status=clock()
+                self.status_event.set()
+            elif kind=='settings':
+                with self.lock:
+                    for (i,name),value in event[1].items():
+                        self.settings.d[i][name]=value
+            elif kind=='plan':
+                self.plan=event[1]
+                for callback in self.plan_callbacks:
+                    callback(self.plan)
+            elif kind=='data':
+                shape,dtype=event[1:]
+                if shape is not None:
+                    self.data=shared_array(self.shared,shape,dtype).copy()
+                    self.send(('release',))
+                else:
+                    self.data=None
+                for callback in self.data_callbacks:
+                    callback(self.data)
+            elif kind=='finished':
+                for callback in self.finished_acquire_callbacks:
+                    callback()
+            elif kind=='error':
+                if not self.status_event.is_set(): # the worker failed to start
+                    self.error=event[1]
+                    self.status_event.set()
+                    return
+                print('Galvo driver: {}'.format(event[1]))
+                for callback in self.error_callbacks:
+                    callback(event[1])
+    def refresh(self):
+        with self.lock:
+            self.send(('refresh',self.settings.d,self.settings.i))
+    def startstop(self):
+        self.stopped=not self.stopped
+        self.send(('startstop',))
+    def acquire(self):
+        self.acquiring=True
+        self.send(('acquire',))
+    def stopAcquiring(self):
+        self.send(('stopAcquiring',))
+    def setRaw(self,raw):
+        self.send(('setRaw',raw))
+    def setCamera(self,camera):
+        self.send(('setCamera',camera))
+    def setCompensator(self,compensator):
+        self.send(('setCompensator',compensator))
+    def setTransitions(self,transitions):
+        self.send(('setTransitions',transitions))
+    def sweep(self,sweep,index_file=None):
+        self.acquiring=True
+        self.send(('sweep',sweep,index_file))
+    def setEventLog(self,filename):
+        ''' Unlike the GalvoDriver's, this takes the name of the file the worker logs to (see event_log.py), or None.'''
+        self.send(('setEventLog',filename))
+    def close(self,timeout=5):
+        ''' Stops the output and the worker.'''
+        try:
+            self.send(('close',))
+        except IOError:
+            pass
+        self.process.join(timeout)
+
+
+def check(repeat=50):
+    ''' Runs a DriverProcess against the SimulatedBackend, and prints the time from sending a refresh to the status of the
+    worker coming back, which is the round trip of a command.  Returns True if every command was answered, the buffer
+    which came back has the last radius, and the worker stopped.'''
+    from settings import Settings
+    settings=Settings()
+    driver=DriverProcess(settings,partial(SimulatedBackend,record_data=False))
+    print('Worker started, sample rate {}, buffer {}'.format(driver.sample_rate,None if driver.data is None else driver.data.shape))
+    times=[]
+    answered=0
+    for i in range(repeat):
+        driver.status_event.clear()
+        start=clock()
+        with driver.lock:
+            settings['radius']=.5+.01*(i%10)
+            driver.refresh()
+        answered+=bool(driver.status_event.wait(5))
+        times.append(clock()-start)
+    print('Refresh round trip: median {:.2f} ms, max {:.2f} ms, {} of {} answered'.format(np.median(times)*1000,np.max(times)*1000,answered,repeat))
+    radius=None if driver.data is None else np.ptp(driver.data[list(driver.channel_map.rows).index(SIN)])/2
+    print('Radius of the buffer which came back: {}, of the last refresh: {}'.format(radius,settings['radius']))
+    output=radius is not None and abs(radius-settings['radius'])<1e-6
+    driver.status_event.clear()
+    driver.startstop()
+    answered+=bool(driver.status_event.wait(5))
+    stopped=driver.stopped
+    print('Stopped: {}, frequency is now {}'.format(stopped,settings['frequency']))
+    driver.close()
+    return answered==repeat+1 and output and stopped and driver.process.exitcode==0
+
+
+if __name__=='__main__':
+    if not check():
+        raise SystemExit('The worker did not answer every command, or did not output the settings it was sent')
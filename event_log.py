@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+An append-only log of everything the GalvoDriver outputs, to find out afterwards which setting each camera frame was
+taken with.
+
+With alternate12 or alternate123 at hundreds of Hz, or during a sweep, a timeline or a protocol, the setting changes
+many times a second, and Settings.save() only keeps the last one.  An EventLog records, as they happen:
+    START       the output starts, or the log is attached to a running output.  value is the sample rate, and buffer
+                the number of samples queued ahead of the hardware
+    STOP        the output is stopped
+    PARAMETER   a parameter of a setting changed: segment is the index of the setting in Settings.d, key the parameter
+                (see PARAMETER_KEYS), value its new value
+    BUFFER      a new output buffer was made.  buffer is its number, key its number of segments, value its length
+    SEGMENT     one setting in that buffer: segment is its place in the buffer, key the index of the setting in
+                Settings.d it was made from (NO_INDEX for transitions, sweeps and protocols), sample where it starts
+                and value its length.  A SETTING record follows for each of the parameters it was output with, with
+                its key and value, which for an acquisition include the timeline's overrides
+    TRIGGER     the camera is triggered at sample of that buffer, in segment
+    PERIOD      a different buffer starts being written to the DAQ, at sample.  buffer is 0 if it wasn't logged
+    MARK        the same buffer is still being written, at sample.  One is written every mark_interval seconds, so the
+                log always says how far the output has got
+    ACQUIRE     an acquisition (key is TIMELINE) or a sweep (key is SWEEP) starts, lasting value seconds
+    ACQUIRED    the acquisition stopped
+    OPEN        the log was opened by a new process, whose samples count from 0 again
+Every record also holds sample, the number of samples the driver had streamed when it was logged, and wall, the time
+from time.time().
+
+Every record is the same 32 bytes, and the log is a file mapped into memory: appending a record writes its fields in
+place, and the file grows by a block of records when it is full.  Nothing is written while the output runs unchanged
+but one PERIOD per buffer change and one MARK a second, so a log left on for hours grows by about 120 kB an hour, plus
+what changing the settings adds.  The operating system writes the mapped pages to the file, so the log survives a crash
+of the program.
+
+EventLogReader works out every camera trigger in a log from the PERIOD records and the triggers of each buffer, and
+setting(i) returns the setting which was output at the i-th trigger.  The sample of a trigger is exact.  When the
+output stops, the blocks queued ahead of the hardware may or may not have been output, and the reader leaves their
+triggers out.  The wall time of a trigger is estimated from the PERIOD and MARK records and the sample rate, to about a
+block (1 ms).  Only streaming mode is logged.
+
+    python event_log.py
+runs alternate12 on the SimulatedBackend with a log, and fails unless the triggers the reader finds, and their settings,
+match the output.
+"""
+from __future__ import division
+from __future__ import print_function
+import os
+import threading
+import time
+import weakref
+import numpy as np
+from waveform_cache import WAVEFORM_KEYS
+
+MAGIC=b'STIRFLOG'
+VERSION=1
+RECORD=np.dtype([('kind','u1'),('segment','u1'),('key','u2'),('buffer','u4'),('sample','i8'),('wall','f8'),('value','f8')])
+HEADER=np.dtype([('magic','S8'),('version','u4'),('record_size','u4'),('reserved','u8',2)])
+EMPTY,START,STOP,PARAMETER,BUFFER,SEGMENT,SETTING,TRIGGER,PERIOD,MARK,ACQUIRE,ACQUIRED,OPEN=range(13)
+KIND_NAMES=('empty','start','stop','parameter','buffer','segment','setting','trigger','period','mark','acquire','acquired','open')
+PARAMETER_KEYS=WAVEFORM_KEYS+('alternate12','alternate123')
+NO_INDEX=0xffff
+PROGRESS=(MARK,PARAMETER,BUFFER,ACQUIRE,ACQUIRED) # the records whose sample is how far the stream had got
+in1d=getattr(np,'in1d',None) or np.isin # numpy 1.9 has no isin, and numpy 2.4 no longer has in1d
+TIMELINE,SWEEP=range(2)
+
+
+def rising_edges(row):
+    ''' The samples at which the periodic TTL row goes high.  row can be volts or DAC codes.'''
+    low,high=row.min(),row.max()
+    if high==low:
+        return np.zeros(0,dtype=np.int64)
+    on=row>(low+high)/2
+    return np.flatnonzero(on&~np.roll(on,1))
+
+
+def read_event_log(filename):
+    ''' Returns the records of the log as an array of RECORD.'''
+    with open(filename,'rb') as f:
+        header=np.fromfile(f,dtype=HEADER,count=1)
+        if len(header)==0 or header['magic'][0]!=MAGIC or header['record_size'][0]!=RECORD.itemsize:
+            raise ValueError('{} is not an event log'.format(filename))
+        records=np.fromfile(f,dtype=RECORD)
+    empty=np.flatnonzero(records['kind']==EMPTY)
+    return records[:empty[0]] if len(empty) else records
+
+
+class EventLog:
+    ''' Appends records to filename, after the ones already in it.  The file grows by grow records at a time.'''
+    def __init__(self,filename,grow=2**16,mark_interval=1.):
+        self.filename=filename
+        self.grow=grow
+        self.mark_interval=mark_interval
+        self.lock=threading.Lock() # records are appended from the DAQ callback and from the threads changing the settings
+        existing=os.path.exists(filename) and os.path.getsize(filename)>0
+        self.next_buffer=1
+        count=0
+        if existing:
+            records=read_event_log(filename)
+            count=len(records)
+            numbers=records['buffer'][records['kind']==BUFFER]
+            if len(numbers):
+                self.next_buffer=int(numbers.max())+1 # buffer numbers stay unique in the whole file
+            self.file=open(filename,'r+b')
+        else:
+            self.file=open(filename,'w+b')
+            header=np.zeros(1,dtype=HEADER)
+            header['magic']=MAGIC
+            header['version']=VERSION
+            header['record_size']=RECORD.itemsize
+            header.tofile(self.file)
+            self.file.flush()
+        self.capacity=0
+        self.extend(count+grow)
+        self.count=count
+        self.buffers=dict() # {id(buffer): (weak reference to the buffer, its number)}
+        self.last=None # the buffer of the last PERIOD record
+        self.current=0 # its number
+        self.next_mark=0
+        self.mark_samples=1
+        self.logged=None # the settings as the last PARAMETER records left them
+        self.append(OPEN,0)
+    def extend(self,capacity):
+        ''' Grows the file to hold capacity records, and maps it again.'''
+        self.file.truncate(HEADER.itemsize+capacity*RECORD.itemsize)
+        self.records=np.memmap(self.file,dtype=RECORD,mode='r+',offset=HEADER.itemsize,shape=(capacity,))
+        self.capacity=capacity
+        # a view of each field, so appending assigns into the map without building a record
+        self.kind=self.records['kind']
+        self.segment=self.records['segment']
+        self.key=self.records['key']
+        self.buffer_number=self.records['buffer']
+        self.sample=self.records['sample']
+        self.wall=self.records['wall']
+        self.value=self.records['value']
+    def append(self,kind,sample,buffer=0,segment=0,key=0,value=0.):
+        with self.lock:
+            i=self.count
+            if i==self.capacity:
+                self.records.flush()
+                self.extend(self.capacity+self.grow)
+            self.segment[i]=segment
+            self.key[i]=key
+            self.buffer_number[i]=buffer
+            self.sample[i]=sample
+            self.wall[i]=time.time()
+            self.value[i]=value
+            self.kind[i]=kind # last, so a reader never sees a record which is half written
+            self.count=i+1
+    def start(self,sample,sample_rate,queued):
+        ''' The output starts at sample, with queued samples written ahead of the hardware.'''
+        self.last=None # the first period is logged even if it is the buffer which was playing
+        self.mark_samples=max(1,int(self.mark_interval*sample_rate))
+        self.append(START,sample,queued,value=sample_rate)
+    def period(self,data,sample):
+        ''' Called by the PeriodStream every time a period starts, at sample.  Only logs a change of buffer, or a MARK.'''
+        if data is self.last:
+            if sample>=self.next_mark:
+                self.append(MARK,sample,self.current)
+                self.next_mark=sample+self.mark_samples
+            return
+        self.last=data
+        entry=self.buffers.get(id(data))
+        self.current=entry[1] if entry is not None and entry[0]() is data else 0
+        self.append(PERIOD,sample,self.current,value=data.shape[1])
+        self.next_mark=sample+self.mark_samples
+    def registered(self,data):
+        entry=self.buffers.get(id(data))
+        return entry is not None and entry[0]() is data
+    def buffer(self,data,triggers,settings,lengths,indices,sample=0):
+        ''' Logs a new buffer: the setting of each of its segments, which are lengths long, and the samples at which it
+        triggers the camera.  indices are the indices of the settings in Settings.d, or None.  A buffer which is already
+        logged isn't logged again.  Returns its number.'''
+        key=id(data)
+        entry=self.buffers.get(key)
+        if entry is not None and entry[0]() is data:
+            return entry[1]
+        number=self.next_buffer
+        self.next_buffer+=1
+        self.buffers[key]=(weakref.ref(data,lambda ref: self.forget(key,ref)),number)
+        starts=np.cumsum([0]+list(lengths))
+        self.append(BUFFER,sample,number,key=len(lengths),value=data.shape[1])
+        for j,(setting,start,length,index) in enumerate(zip(settings,starts,lengths,indices)):
+            self.append(SEGMENT,start,number,j,NO_INDEX if index is None else index,length)
+            if setting is not None:
+                for k,name in enumerate(PARAMETER_KEYS):
+                    if name in setting:
+                        self.append(SETTING,start,number,j,k,float(setting[name]))
+        segments=np.searchsorted(starts,triggers,'right')-1
+        for trigger,j in zip(triggers,segments):
+            self.append(TRIGGER,trigger,number,j)
+        return number
+    def forget(self,key,ref):
+        entry=self.buffers.get(key)
+        if entry is not None and entry[0] is ref:
+            del self.buffers[key]
+    def settings(self,d,sample=0):
+        ''' Logs every parameter of the settings d which changed since the last call, or all of them the first time.'''
+        for i,setting in enumerate(d):
+            before=self.logged[i] if self.logged is not None and i<len(self.logged) else dict()
+            for k,name in enumerate(PARAMETER_KEYS):
+                if name in setting and before.get(name)!=setting[name]:
+                    self.append(PARAMETER,sample,segment=i,key=k,value=float(setting[name]))
+        self.logged=[dict(setting) for setting in d]
+    def flush(self):
+        self.records.flush()
+    def close(self):
+        with self.lock:
+            self.records.flush()
+            del self.records,self.kind,self.segment,self.key,self.buffer_number,self.sample,self.wall,self.value
+            self.file.close()
+
+
+class EventLogReader:
+    ''' Works out every camera trigger of a log.  Trigger i was at trigger_samples[i] (in samples since the process opened
+    the log) and trigger_times[i] (from time.time()), in segment trigger_segments[i] of buffer trigger_buffers[i].
+    buffers holds, for each buffer number, its 'length', the 'starts', 'indices' and 'settings' of its segments, and the
+    'triggers' and 'trigger_segments' of its camera pulses.'''
+    def __init__(self,filename):
+        self.records=r=read_event_log(filename)
+        self.buffers=dict()
+        for record in r[r['kind']==BUFFER]:
+            self.buffers[int(record['buffer'])]={'length':int(record['value']),'starts':[],'indices':[],'settings':[],'triggers':[],'trigger_segments':[]}
+        for record in r[in1d(r['kind'],(SEGMENT,SETTING,TRIGGER))]:
+            b=self.buffers[int(record['buffer'])]
+            if record['kind']==SEGMENT:
+                b['starts'].append(int(record['sample']))
+                b['indices'].append(None if record['key']==NO_INDEX else int(record['key']))
+                b['settings'].append(dict())
+            elif record['kind']==SETTING:
+                b['settings'][record['segment']][PARAMETER_KEYS[record['key']]]=float(record['value'])
+            else:
+                b['triggers'].append(int(record['sample']))
+                b['trigger_segments'].append(int(record['segment']))
+        for b in self.buffers.values():
+            b['triggers']=np.array(b['triggers'],dtype=np.int64)
+            b['trigger_segments']=np.array(b['trigger_segments'],dtype=np.int64)
+        self.runs=[] # (record index of the PERIOD, first sample, end sample, buffer number) of every stretch of one buffer
+        pieces=[]
+        run=None
+        rate=np.nan
+        queued=0
+        for i in np.flatnonzero(in1d(r['kind'],(START,STOP,PERIOD,OPEN)+PROGRESS)):
+            record=r[i]
+            kind=record['kind']
+            if kind in PROGRESS:
+                if run is not None:
+                    run[1].append((record['sample'],record['wall']))
+                continue
+            if run is not None:
+                if kind==PERIOD:
+                    end=record['sample']
+                elif kind==OPEN: # the process ended without stopping the output
+                    end=max(sample for sample,wall in run[1])-queued
+                else:
+                    end=record['sample']-queued # the samples queued ahead of the hardware were never output
+                pieces.append(self.triggers(run[0],run[1],end,rate,queued))
+                run=None
+            if kind==START:
+                rate=record['value']
+                queued=int(record['buffer'])
+            elif kind==PERIOD:
+                run=(i,[(record['sample'],record['wall'])])
+        if run is not None:
+            pieces.append(self.triggers(run[0],run[1],max(sample for sample,wall in run[1])-queued,rate,queued))
+        pieces=[piece for piece in pieces if piece is not None]
+        columns=list(zip(*pieces)) if pieces else [[np.zeros(0,dtype=np.int64)]]*5
+        self.trigger_samples,self.trigger_times,self.trigger_buffers,self.trigger_segments,self.trigger_records=[np.concatenate(column) for column in columns]
+    def triggers(self,i,marks,end,rate,queued):
+        ''' The triggers of the buffer of PERIOD record i, repeated from its sample to end.  marks are the (sample, wall)
+        of that record and of the PROGRESS records after it.'''
+        number=int(self.records[i]['buffer'])
+        start=marks[0][0]
+        self.runs.append((i,start,end,number))
+        b=self.buffers.get(number)
+        if b is None or len(b['triggers'])==0 or end<=start:
+            return None
+        periods=-(-(end-start)//b['length'])
+        samples=(start+np.arange(periods)[:,None]*b['length']+b['triggers']).ravel()
+        segments=np.tile(b['trigger_segments'],periods)
+        keep=samples<end
+        samples=samples[keep]
+        marks=sorted((sample,wall) for sample,wall in marks if sample>=start) # a record logged while the period was being cut can be behind it
+        mark_samples=np.array([sample for sample,wall in marks],dtype=np.int64)
+        mark_walls=np.array([wall for sample,wall in marks])
+        j=np.searchsorted(mark_samples,samples,'right')-1
+        times=mark_walls[j]+(samples-mark_samples[j]+queued)/rate # the record was written when its sample was queued
+        return samples,times,np.full(len(samples),number,dtype=np.int64),segments[keep],np.full(len(samples),i,dtype=np.int64)
+    def __len__(self):
+        return len(self.trigger_samples)
+    def setting(self,trigger):
+        ''' The setting output at camera trigger number trigger, the first trigger of the log being 0: a dict of its
+        parameters, plus 'index' (the index of the setting in Settings.d, or None), 'buffer', 'segment', 'sample' and
+        'time'.'''
+        b=self.buffers[int(self.trigger_buffers[trigger])]
+        j=int(self.trigger_segments[trigger])
+        setting=dict(b['settings'][j])
+        setting.update(index=b['indices'][j],buffer=int(self.trigger_buffers[trigger]),segment=j,
+                       sample=int(self.trigger_samples[trigger]),time=float(self.trigger_times[trigger]))
+        return setting
+    def events(self,kind):
+        ''' The records of one kind, like PARAMETER or ACQUIRE.'''
+        return self.records[self.records['kind']==kind]
+    def acquisitionStarts(self):
+        ''' The number of the first trigger of every acquisition and sweep, which is the first camera frame it took.'''
+        positions=np.flatnonzero(self.records['kind']==ACQUIRE)
+        return np.searchsorted(self.trigger_records,positions)
+
+
+def check(seconds=1.):
+    ''' Runs alternate12 on the SimulatedBackend with a log, changes a setting halfway, and checks that the reader finds
+    every camera pulse which was output, and the setting each belongs to.  Returns True if it does.'''
+    import tempfile
+    from settings import Settings, default_setting
+    from galvo_driver import GalvoDriver
+    from daq_backend import SimulatedBackend
+    from instrumentation import clock
+    from waveform_engine import SIN, CAMERA_TTL
+    filename=os.path.join(tempfile.gettempdir(),'event_log_check.log')
+    if os.path.exists(filename):
+        os.remove(filename)
+    settings=Settings()
+    settings.d=[default_setting() for i in range(4)]
+    settings.d[1]['radius']=.5
+    settings.d[2]['radius']=.8
+    settings['alternate12']=True
+    backend=SimulatedBackend()
+    driver=GalvoDriver(settings,backend)
+    log=EventLog(filename)
+    driver.setEventLog(log)
+    time.sleep(seconds/2)
+    with driver.lock:
+        settings.d[2]['radius']=.7
+        driver.refresh()
+    time.sleep(seconds/2)
+    driver.startstop()
+    time.sleep(.1)
+    task=driver.analog_output
+    with task.condition:
+        writes=[(w['sample'],w['data']) for w in task.writes]
+        transferred=task.transferred
+    rows=list(driver.channel_map.rows)
+    out=np.concatenate([data for sample,data in writes],axis=1)[:,:transferred]
+    ttl=out[rows.index(CAMERA_TTL)]
+    output=np.flatnonzero((ttl>2.5)&~(np.append(0,ttl[:-1])>2.5)) # the sample of every camera pulse
+    start=clock()
+    n=100000
+    for i in range(n): # after the STOP record, so these MARKs don't add triggers
+        log.period(log.last,log.next_mark)
+    print('Appending a record: {:.2f} us'.format((clock()-start)/n*1e6))
+    log.close()
+    start=clock()
+    reader=EventLogReader(filename)
+    print('{} records, {} bytes in the file, read in {:.1f} ms'.format(len(reader.records),os.path.getsize(filename),(clock()-start)*1000))
+    radii=[reader.setting(i)['radius'] for i in range(len(reader))]
+    output=output[(output>=reader.runs[0][1])&(output<reader.runs[-1][2])] # the output started before the log, and the reader leaves out the blocks queued at the stop
+    same=np.array_equal(output,reader.trigger_samples)
+    print('Camera pulses output since the log started: {}, found in the log: {}, at the same samples: {}'.format(len(output),len(reader),same))
+    print('Radius of the first triggers: {}, of the last: {}'.format(radii[:4],radii[-4:]))
+    if not same or len(output)<3:
+        return False
+    sin=out[rows.index(SIN)]
+    amplitudes=np.array([np.ptp(sin[a:b])/2 for a,b in zip(output[:-1],output[1:])]) # of the revolution which follows each pulse
+    ratios=amplitudes/np.array(radii[:-1])
+    mapped=np.ptp(ratios)<=1e-3*np.max(ratios)
+    print('Amplitude output after each pulse over the radius of its setting in the log: {:.4f} to {:.4f}'.format(ratios.min(),ratios.max()))
+    return mapped
+
+
+if __name__=='__main__':
+    if not check():
+        raise SystemExit('The log does not match the camera pulses which were output')
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-compensation of the dynamics of the galvos.
+
+A galvo is a low-pass system: as the ring frequency rises, the mirror lags the drive signal and swings less than it is
+told to, so the circle shrinks, turns and becomes an ellipse (the two galvos are never quite the same).  The ellipticity
+and phase sliders correct this by hand for one frequency.  Instead, the sine and cosine can be passed through the
+inverse of the galvo's transfer function before they are output.  The output buffer is looped, so it is one period of a
+periodic signal, and the inverse filter is exact in the frequency domain: the rfft of the row is divided by the response
+at each harmonic and transformed back.  This also sharpens the steps between the settings of a sequence.  The gain of
+the inverse is capped at max_gain, so harmonics far above the bandwidth aren't amplified without bound, and the result
+is clamped to the +-10 V output range.
+
+The response is loaded from ~/.ShadowlessTIRF/galvo_response.json if that file exists, either as a fitted model
+    {"bandwidth": 2500, "damping": 0.7, "delay": 0.00005}
+where bandwidth is the natural frequency in Hz and delay is in seconds, or as a measured table
+    {"frequencies": [10, 100, 500, ...], "gain": [1.0, 0.98, 0.8, ...], "phase": [-0.5, -5, -30, ...]}
+where gain is the amplitude of the mirror over that of the drive and phase is the lag in degrees.  Either can be given
+per galvo, as {"sin": {...}, "cos": {...}}.
+
+Filtering a million sample row takes tens of milliseconds, so every compensated row is cached, keyed on the parameters
+which change it (see Compensator.rowKey()).  Toggling a laser or moving the other galvo doesn't filter it again.
+
+    python galvo_compensation.py
+checks, with a made up response, that the compensated drive comes out of the galvo as the uncompensated one should.
+"""
+from __future__ import division
+from __future__ import print_function
+import json
+import os
+from os.path import expanduser
+import numpy as np
+from waveform_cache import WaveformCache, WAVEFORM_KEYS
+from waveform_engine import SIN, COS, CHANNELS_AFFECTED_BY
+
+GALVO_ROWS=(SIN,COS)
+ROW_NAMES={SIN:'sin',COS:'cos'}
+MAX_VOLTAGE=10
+RESPONSE_FILE=os.path.join(expanduser("~"),'.ShadowlessTIRF','galvo_response.json')
+
+
+class ModelResponse:
+    ''' A second order low-pass with a delay: H(f)=exp(-2i*pi*f*delay)/(1-(f/bandwidth)**2+2i*damping*f/bandwidth).'''
+    def __init__(self,bandwidth,damping=.7,delay=0.):
+        if bandwidth<=0 or damping<=0 or delay<0:
+            raise ValueError('The bandwidth and the damping have to be above 0, and the delay can not be negative')
+        self.bandwidth=float(bandwidth)
+        self.damping=float(damping)
+        self.delay=float(delay)
+    def key(self):
+        return ('model',self.bandwidth,self.damping,self.delay)
+    def response(self,frequencies):
+        r=np.asarray(frequencies)/self.bandwidth
+        return np.exp(-2j*np.pi*np.asarray(frequencies)*self.delay)/(1-r*r+2j*self.damping*r)
+
+
+class MeasuredResponse:
+    ''' A measured response, interpolated linearly in gain and phase (degrees) between the measured frequencies.'''
+    def __init__(self,frequencies,gain,phase):
+        if not len(frequencies)==len(gain)==len(phase) or len(frequencies)==0:
+            raise ValueError('The measured response needs as many gains and phases as frequencies')
+        if np.any(np.diff(frequencies)<=0) or np.any(np.asarray(gain)<=0):
+            raise ValueError('The measured frequencies have to increase, and the gains have to be above 0')
+        self.frequencies=tuple(float(f) for f in frequencies)
+        self.gain=tuple(float(g) for g in gain)
+        self.phase=tuple(float(p) for p in phase)
+    def key(self):
+        return ('measured',self.frequencies,self.gain,self.phase)
+    def response(self,frequencies):
+        gain=np.interp(frequencies,self.frequencies,self.gain)
+        phase=np.interp(frequencies,self.frequencies,self.phase)*(np.pi/180)
+        return gain*np.exp(1j*phase)
+
+
+def make_response(description):
+    if 'frequencies' in description:
+        return MeasuredResponse(description['frequencies'],description['gain'],description['phase'])
+    return ModelResponse(description['bandwidth'],description.get('damping',.7),description.get('delay',0.))
+
+
+def load_galvo_response(filename=RESPONSE_FILE):
+    ''' Returns {row: response} for the rows in GALVO_ROWS from filename, or None if there is no such file.'''
+    try:
+        with open(filename) as f:
+            description=json.load(f)
+    except IOError:
+        return None
+    if 'sin' in description or 'cos' in description:
+        return dict((row,make_response(description[ROW_NAMES[row]])) for row in GALVO_ROWS if ROW_NAMES[row] in description)
+    return dict((row,make_response(description)) for row in GALVO_ROWS)
+
+
+def inverse_filter(response,n,sample_rate,max_gain):
+    ''' The rfft coefficients of the inverse of response for a periodic signal of n samples, with a gain of at most max_gain.'''
+    h=response.response(np.fft.rfftfreq(n,1/sample_rate))
+    inverse=1/h
+    gain=np.abs(inverse)
+    too_much=gain>max_gain
+    inverse[too_much]*=max_gain/gain[too_much]
+    return inverse
+
+
+def compensate(row,response,sample_rate,max_gain=4.,limit=MAX_VOLTAGE):
+    ''' Returns (the drive which makes the galvo follow row, the number of samples which were clamped to +-limit).'''
+    spectrum=np.fft.rfft(row)
+    spectrum*=inverse_filter(response,len(row),sample_rate,max_gain)
+    out=np.fft.irfft(spectrum,len(row))
+    clamped=int(np.count_nonzero(np.abs(out)>limit))
+    np.clip(out,-limit,limit,out=out)
+    return out,clamped
+
+
+class Compensator:
+    ''' Compensates the galvo rows of the WaveformEngine's output.  responses is {row: response} as returned by
+    load_galvo_response(); rows without a response are output as they are.'''
+    def __init__(self,responses,max_gain=4.,max_bytes=64*2**20):
+        self.responses=responses
+        self.max_gain=max_gain
+        self.cache=WaveformCache(max_bytes)
+        self.clamped=dict() # the number of samples of each row which had to be clamped to the output range, for the last buffer
+    def key(self):
+        return (self.max_gain,tuple((row,self.responses[row].key()) for row in sorted(self.responses)))
+    def rowKey(self,row,contents,lengths,sample_rate,extra=None):
+        ''' Everything that row of the engine's output depends on.  contents and lengths are those of the engine after
+        render(), and extra is the key of anything else which changed the buffer, like transitions.'''
+        segments=tuple((tuple(value for key,value in zip(WAVEFORM_KEYS,setting) if row in CHANNELS_AFFECTED_BY[key]),revolutions) for setting,revolutions,triggers in contents)
+        return (row,sample_rate,tuple(lengths),segments,extra)
+    def row(self,data,row,contents,lengths,sample_rate,extra=None):
+        ''' Returns the compensated row of data, the (N_CHANNELS x samples) output of the engine.  The result is shared with the cache, so it must not be modified.'''
+        if row not in self.responses:
+            return data[row]
+        key=self.rowKey(row,contents,lengths,sample_rate,extra)
+        cached=self.cache.get(key)
+        if cached is None:
+            cached=compensate(data[row],self.responses[row],sample_rate,self.max_gain)
+            self.cache.put(key,cached)
+        self.clamped[row]=cached[1]
+        return cached[0]
+    def apply(self,out,data,rows,contents,lengths,sample_rate,extra=None):
+        ''' Replaces the galvo rows of out, the output buffer made from data, by their compensated versions.  rows is the
+        row of data each row of out was taken from (see ChannelMap.rows).'''
+        for i,row in enumerate(rows):
+            if row in self.responses:
+                out[i]=self.row(data,int(row),contents,lengths,sample_rate,extra)
+
+
+def check(frequencies=(50,200,500,1000,2000)):
+    ''' Plans and renders a ring at each frequency, compensates it, and passes it through the response it was compensated
+    for.  Prints the largest difference between that and the ring which was asked for, with and without compensation.'''
+    from settings import default_setting
+    from waveform_engine import WaveformEngine
+    from waveform_planner import WaveformPlanner
+    response=ModelResponse(bandwidth=1500,damping=.6,delay=50e-6)
+    planner=WaveformPlanner()
+    for frequency in frequencies:
+        setting=default_setting()
+        setting['frequency']=frequency
+        plan=planner.plan([frequency])
+        sample_rate=plan.sample_rate
+        data,n=WaveformEngine(sample_rate).render([setting],plan=plan)
+        wanted=data[SIN].copy()
+        h=response.response(np.fft.rfftfreq(n,1/sample_rate))
+        plain=np.fft.irfft(np.fft.rfft(wanted)*h,n)
+        drive,clamped=compensate(wanted,response,sample_rate)
+        followed=np.fft.irfft(np.fft.rfft(drive)*h,n)
+        print('{:>5} Hz: error {:.4f} V without compensation, {:.2e} V with it, {} samples clamped'.format(frequency,np.abs(plain-wanted).max(),np.abs(followed-wanted).max(),clamped))
+
+
+if __name__=='__main__':
+    check()
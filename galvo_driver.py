@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+"""
+The GalvoDriver computes the signal which controls the two galvos, the camera and the lasers, and sends it to the DAQ.
+
+It doesn't depend on Qt or on NIDAQmx, so it can be run headless.  The DAQ is reached through a backend from
+daq_backend.py: the NIDAQmx backend by default, or the SimulatedBackend to run the driver without the card.
+"""
+from __future__ import division
+import threading
+import time
+import numpy as np
+from waveform_cache import WaveformCache, normalize_setting
+from waveform_engine import WaveformEngine, CAMERA_TTL
+from streaming import PeriodStream
+from sequence_player import SequencePlayer
+from waveform_planner import WaveformPlanner
+from camera_trigger import CameraTrigger
+from acquisition_timeline import DEFAULT_TIMELINE, compile_timeline
+from sweep import compile_sweep
+from instrumentation import Trace, CALLBACK, WRITE, REFRESH, CALCULATE, clock
+from daq_backend import NIDAQmxBackend, SynchronizedTask
+from channel_map import load_channel_map
+from dac_codes import to_codes
+from galvo_compensation import Compensator, load_galvo_response
+from transitions import edges
+from event_log import rising_edges, STOP, ACQUIRE, ACQUIRED, TIMELINE, SWEEP
+
+
+class GalvoDriver:
+    ''' This class sends creates the signal which will control the two galvos and the lasers, and sends it to the DAQ.
+    Every function in finished_acquire_callbacks is called when an acquisition finishes.  They may be called from a
+    thread other than the one which called acquire().  Every function in plan_callbacks is called with the WaveformPlan
+    (achieved frequency and buffer size) whenever calculate() makes a new buffer, and every function in data_callbacks
+    with the new output buffer whenever self.data changes.  If a write fails in the DAQ callback, the output is stopped
+    and every function in error_callbacks is called with the exception.  channel_map (see channel_map.py) says
+    which channels output what, and is loaded from the configuration if it isn't given.'''
+    def __init__(self,settings,backend=None,channel_map=None):
+        self.settings=settings
+        if backend is None:
+            backend=NIDAQmxBackend()
+        self.backend=backend
+        if channel_map is None:
+            channel_map=load_channel_map()
+        self.channel_map=channel_map
+        self.sample_rate=1000000 # Maximum for the NI PCI-6733 is 1MHz.
+        self.output_rate=None # the sample rate the task's clock is configured with
+        self.sampsPerPeriod=1 #dummy variable
+        self.planner=WaveformPlanner(max_sample_rate=self.sample_rate,max_duration=.02) # set this to None to always use self.sample_rate and one revolution per setting
+        self.plan=None
+        self.plan_callbacks=[]
+        self.data_callbacks=[]
+        self.camera=CameraTrigger() # when the camera is triggered. Change it with setCamera()
+        self.transitions=None # if set to a Transitions from transitions.py, the galvos move smoothly from one setting to the next. Change it with setTransitions()
+        self.transition_times=[] # how long each transition of the current buffer takes, in seconds
+        self.edges=None # edges() of the current buffer in the engine's rows, which the lead-in to the next buffer starts from
+        self.lengths=None # the number of samples of each setting (and transition) in the current buffer
+        self.event_log=None # if set to an EventLog from event_log.py, every change and buffer is logged. Change it with setEventLog()
+        self.waveform_cache=WaveformCache()
+        responses=load_galvo_response()
+        self.compensator=Compensator(responses) if responses else None # pre-compensates the dynamics of the galvos (see galvo_compensation.py). Change it with setCompensator()
+        self.engine=WaveformEngine(self.sample_rate)
+        self.raw=False # When True, buffers are converted once to the DAC's int16 codes and written with WriteBinaryI16. Set it with setRaw().
+        self.coefficients=None # the calibration of every channel, which converts volts to codes
+        self.streaming=True # When True, the DAQ doesn't regenerate the buffer. Blocks are streamed to it, so settings change without stopping the task.
+        self.stream=PeriodStream(block_size=1000,n_channels=len(self.channel_map)) # 1 ms at 1MHz, and at most one revolution, since the planner gives every revolution at least 1000 samples
+        self.stream_depth=2 # how many blocks are queued ahead of the hardware. A new buffer is output at most 2 blocks, so 2 periods, after the buffer being played ends. Keep writeBlock() cheap rather than making this deeper
+        self.write_error=None # the exception of a write which failed in the DAQ callback since the output was started
+        self.error_callbacks=[] # called with that exception, once the output has been stopped
+        self.player=None
+        self.timeline=None # the CompiledTimeline of the acquisition being played
+        self.finished_acquire_callbacks=[]
+        self.lock=threading.RLock() # held by everything that reconfigures the task, since acquisitions are stopped from another thread
+        self.trace=Trace() # timing of every callback, write, refresh and calculate
+        self.calculate()
+        self.createTask()
+    def createTask(self):
+        devices=self.channel_map.deviceChannels()
+        if len(devices)==1:
+            self.analog_output=self.backend.createTask(devices[0][1])
+        else:
+            self.analog_output=SynchronizedTask(self.backend,devices)
+        if self.streaming:
+            self.analog_output.registerEveryNSamplesEvent(self.stream.block_size,self.writeBlock)
+            self.stream.setData(self.data)
+            self.startStream()
+        else:
+            self.configureClock(self.sampsPerPeriod)
+            self.write(self.data,self.sampsPerPeriod)
+            self.analog_output.start()
+        self.stopped=False
+        self.acquiring=False
+    def configureClock(self,sampsPerChan):
+        self.analog_output.configureClock(self.sample_rate,sampsPerChan)
+        self.output_rate=self.sample_rate
+    def startStream(self):
+        ''' Queues the first blocks of the stream and starts the task.  For a continuous task, sampsPerChan sets the size of the output buffer.'''
+        self.stream.reset()
+        self.write_error=None
+        self.configureClock(self.stream_depth*self.stream.block_size)
+        if self.event_log is not None:
+            self.event_log.start(self.stream.samples,self.sample_rate,self.stream_depth*self.stream.block_size)
+            self.logSettings()
+        self.analog_output.setRegeneration(False)
+        for i in range(self.stream_depth):
+            self.write(self.stream.nextBlock(),self.stream.block_size,10.0)
+        self.trace.expected_interval=self.stream.block_size/self.sample_rate
+        self.analog_output.start()
+    def writeBlock(self):
+        ''' Called by the DAQ every time a block has been transferred to the device.  Replaces it with the next block.'''
+        if self.write_error is not None:
+            return
+        start=clock()
+        try:
+            self.write(self.stream.nextBlock(),self.stream.block_size,10.0)
+        except Exception as e: # raised into the DAQ's callback, it would be lost, and the output would stop unnoticed
+            self.write_error=e
+            stopper=threading.Thread(target=self.writeFailed,args=(e,)) # the task can't be stopped from inside its callback
+            stopper.daemon=True
+            stopper.start()
+            return
+        self.trace.record(CALLBACK,start,clock()-start)
+    def writeFailed(self,error):
+        ''' Stops the output after a write failed in the DAQ callback, and calls error_callbacks.'''
+        print('Writing to the DAQ failed, so the output was stopped: {}'.format(error))
+        with self.lock:
+            if self.write_error is not error: # the output was restarted since
+                return
+            if not self.stopped:
+                self.logEvent(STOP)
+                self.analog_output.stop()
+                self.stopped=True
+        for callback in self.error_callbacks:
+            callback(error)
+    def write(self,data,sampsPerChan,timeout=-1):
+        start=clock()
+        if self.raw:
+            self.analog_output.writeRaw(data,sampsPerChan,timeout)
+        else:
+            self.analog_output.write(data,sampsPerChan,timeout)
+        self.trace.record(WRITE,start,clock()-start)
+    def cacheKey(self,sequence,settings,sample_rate=None,plan=None):
+        ''' The key under which the output of render() is stored in the waveform cache.  It holds everything render() reads: how the sample rate is chosen, which settings are output, and their values.'''
+        if plan is not None:
+            rate=(plan.sample_rate,tuple(plan.lengths),tuple(plan.revolutions))
+        elif self.planner is None:
+            rate=self.sample_rate
+        else:
+            rate=(self.planner.key(),sample_rate,self.preferredRate() if sample_rate is None else None)
+        compensation=self.compensator.key() if self.compensator is not None else None
+        transitions=self.transitions.key() if self.transitions is not None else None
+        return (rate,self.raw,self.camera.key(),compensation,transitions,tuple(sequence),tuple(normalize_setting(setting) for setting in settings))
+    def sourceRate(self):
+        ''' The sample rate of the player or timeline being streamed, which calculate() has to keep, or None.'''
+        if self.stream.source is None:
+            return None
+        if self.timeline is not None:
+            return self.timeline.sample_rate
+        return self.player.sample_rate
+    def preferredRate(self):
+        ''' The sample rate the planner keeps if it can, since changing it restarts a streamed output.'''
+        return self.output_rate if self.streaming else None
+    def render(self,sequence,settings,sample_rate=None,plan=None):
+        ''' Returns (data, sampsPerPeriod, plan, edges, transition_times, lengths) of the buffer of settings, the settings
+        at the indices sequence, without making it the buffer being output.  The planner chooses the sample rate, unless
+        sample_rate is given or a plan is given to render to.  The result is cached and must not be modified.'''
+        key=self.cacheKey(sequence,settings,sample_rate,plan)
+        cached=self.waveform_cache.get(key)
+        if cached is not None:
+            return cached
+        if plan is None and self.planner is None:
+            self.engine.setSampleRate(self.sample_rate) # which an earlier plan may have changed
+            data,sampsPerPeriod=self.engine.render(settings,camera=self.camera)
+        else:
+            if plan is None:
+                plan=self.planner.plan([setting['frequency'] for setting in settings],sample_rate,self.camera,self.preferredRate())
+            data,sampsPerPeriod=self.engine.render(settings,plan=plan,camera=self.camera)
+        rate=self.sample_rate if plan is None else plan.sample_rate
+        lengths=self.engine.lengths
+        transition_times=[]
+        if self.transitions is not None and len(settings)>1:
+            data,lengths=self.transitions.insert(data,lengths,rate)
+            sampsPerPeriod=data.shape[1]
+            transition_times=self.transitions.times
+        output=self.channel_map.expand(data) # a new array: the engine's buffer is overwritten by the next render, but the output may still be being streamed
+        if self.compensator is not None:
+            self.compensator.apply(output,data,self.channel_map.rows,self.engine.contents,lengths,rate,self.transitions.key() if self.transitions is not None else None)
+        if self.raw:
+            output=to_codes(output,self.coefficients)
+        cached=(output,sampsPerPeriod,plan,edges(data),transition_times,lengths)
+        self.waveform_cache.put(key,cached)
+        return cached
+    def calculate(self,sample_rate=None):
+        ''' Computes self.data for the current settings.  The planner chooses the sample rate, unless sample_rate is given.'''
+        start=clock()
+        previous=getattr(self,'data',None)
+        s=self.settings
+        sequence=s.sequence()
+        self.data,self.sampsPerPeriod,plan,self.edges,self.transition_times,self.lengths=self.render(sequence,[s.d[i] for i in sequence],sample_rate)
+        if self.event_log is not None:
+            indices=list(sequence)
+            if len(self.lengths)>len(indices): # a transition follows every setting
+                indices=[i for index in sequence for i in (index,None)]
+            self.logBuffer(self.data,[None if i is None else s.d[i] for i in indices],self.lengths,indices)
+        if plan is not None:
+            self.sample_rate=plan.sample_rate
+            if plan is not self.plan:
+                self.plan=plan
+                for callback in self.plan_callbacks:
+                    callback(plan)
+        if self.data is not previous:
+            for callback in self.data_callbacks:
+                callback(self.data)
+        self.trace.record(CALCULATE,start,clock()-start)
+    def startstop(self):
+        with self.lock:
+            if self.stopped:
+                if self.streaming:
+                    self.stopped=False
+                    self.calculate(self.sourceRate())
+                    self.stream.setData(self.data)
+                    self.startStream()
+                else:
+                    self.analog_output.start()
+                    self.stopped=False
+                    self.refresh()
+            else:
+                self.settings.d[0]['frequency']=0
+                self.settings.d[0]['radius']=.6
+                self.settings.d[0]['alternate']=False
+                self.refresh()
+                self.logEvent(STOP)
+                self.analog_output.stop()
+                self.stopped=True
+    def leadIn(self,previous,previous_edges):
+        ''' Returns the stream's lead-in from the buffer previous, whose edges are previous_edges, to self.data, or None if there are no transitions.'''
+        if self.transitions is None or previous is None or previous is self.data:
+            return None
+        data=self.channel_map.expand(self.transitions.segment(previous_edges,self.edges,self.sample_rate))
+        if self.raw:
+            data=to_codes(data,self.coefficients)
+        return (previous,data)
+    def refresh(self):
+        with self.lock:
+            self.logSettings()
+            if self.stopped is False:
+                start=clock()
+                previous,previous_edges=self.data,self.edges
+                self.calculate(self.sourceRate()) # a player or timeline keeps the rate its buffers were rendered at
+                if self.streaming and self.sample_rate==self.output_rate:
+                    self.stream.setData(self.data,self.leadIn(previous,previous_edges)) # takes over at the next period boundary
+                elif self.streaming: # the planner changed the sample rate, which can only be done by restarting the task
+                    self.analog_output.stop()
+                    self.stream.setData(self.data)
+                    self.startStream()
+                else:
+                    self.analog_output.stop()
+                    self.configureClock(self.sampsPerPeriod)
+                    self.write(self.data,self.sampsPerPeriod)
+                    self.analog_output.start()
+                self.trace.record(REFRESH,start,clock()-start)
+    def setCamera(self,camera):
+        ''' Changes when the camera is triggered (see camera_trigger.py).  The output is refreshed.'''
+        with self.lock:
+            self.camera=camera
+            self.refresh()
+    def setTransitions(self,transitions):
+        ''' Turns smooth transitions between settings (see transitions.py) on, or off if transitions is None.  The output is refreshed.'''
+        with self.lock:
+            self.transitions=transitions
+            self.refresh()
+    def setCompensator(self,compensator):
+        ''' Changes the Compensator from galvo_compensation.py which pre-compensates the galvos, or turns it off if it is None.  The output is refreshed.'''
+        with self.lock:
+            self.compensator=compensator
+            self.refresh()
+    def setEventLog(self,event_log):
+        ''' Starts logging the output to an EventLog from event_log.py, or stops if event_log is None.  The output is refreshed.'''
+        with self.lock:
+            self.event_log=event_log
+            self.refresh() # logs the settings and the buffer before the stream logs it being played
+            if event_log is not None and self.streaming and not self.stopped:
+                event_log.start(self.stream.samples,self.output_rate,self.stream_depth*self.stream.block_size)
+            self.stream.on_period=event_log.period if event_log is not None else None
+    def logSettings(self):
+        if self.event_log is not None:
+            self.event_log.settings(self.settings.d,self.stream.samples)
+    def logBuffer(self,data,settings,lengths,indices):
+        ''' Logs the buffer data, unless it already is: the setting of each of its segments, and where it triggers the camera.'''
+        if self.event_log is None or self.event_log.registered(data):
+            return
+        rows=np.flatnonzero(self.channel_map.rows==CAMERA_TTL)
+        triggers=rising_edges(data[rows[0]]) if len(rows) else np.zeros(0,dtype=np.int64)
+        self.event_log.buffer(data,triggers,settings,lengths,indices,self.stream.samples)
+    def logEvent(self,kind,key=0,value=0.):
+        if self.event_log is not None:
+            self.event_log.append(kind,self.stream.samples,key=key,value=value)
+    def setRaw(self,raw):
+        ''' Switches between writing float64 volts and int16 DAC codes.  If the output is running, it is restarted.'''
+        with self.lock:
+            if raw==self.raw:
+                return
+            if self.acquiring:
+                raise RuntimeError('The output format cannot be changed during an acquisition')
+            running=not self.stopped
+            if running:
+                self.analog_output.stop()
+            self.player=None # its buffers are in the old format
+            self.raw=raw
+            self.coefficients=self.analog_output.scalingCoefficients() if raw else None
+            self.waveform_cache.clear()
+            stream=PeriodStream(self.stream.block_size,len(self.channel_map),np.int16 if raw else np.float64)
+            stream.samples=self.stream.samples # the event log counts samples from the start
+            stream.on_period=self.stream.on_period
+            self.stream=stream
+            self.calculate()
+            self.stream.setData(self.data)
+            if running:
+                if self.streaming:
+                    self.startStream()
+                else:
+                    self.configureClock(self.sampsPerPeriod)
+                    self.write(self.data,self.sampsPerPeriod)
+                    self.analog_output.start()
+    def play(self,protocol):
+        ''' Streams a Protocol from sequence_player.py, starting at the next period boundary.  When a protocol which
+        doesn't loop ends, the output goes back to the current setting.'''
+        if not self.streaming:
+            raise RuntimeError('Protocols can only be played in streaming mode')
+        with self.lock:
+            if self.stopped:
+                self.calculate() # chooses the rate the output starts at
+            rate=self.sample_rate if self.stopped else self.output_rate
+            self.player=SequencePlayer(protocol,rate,self.waveform_cache,self.coefficients,self.channel_map,self.compensator) # every setting is rendered here, before the first period is played
+            for data,setting in zip(self.player.buffers,protocol.settings):
+                self.logBuffer(data,[setting],[data.shape[1]],[None])
+            self.stream.setSource(self.player.periods())
+            if self.stopped:
+                self.stopped=False
+                self.stream.setData(self.data)
+                self.startStream()
+    def stopPlaying(self):
+        with self.lock:
+            self.stream.setSource(None)
+            self.player=None
+    def acquire(self,timeline=DEFAULT_TIMELINE):
+        ''' Plays an acquisition timeline (see acquisition_timeline.py).  In streaming mode the whole timeline is compiled
+        here, before it starts.'''
+        with self.lock:
+            print('Acquiring')
+            self.acquiring=True
+            if self.streaming:
+                compiled=compile_timeline(self,timeline)
+                self.logEvent(ACQUIRE,TIMELINE,compiled.duration())
+                self.playTimeline(compiled)
+                return
+            self.counter=0
+            self.tic=time.time()
+            radius=self.settings.d[0]['radius']; alternate12=self.settings.d[0]['alternate12']; alternate123=self.settings.d[0]['alternate123']
+            self.settings['radius']=.6
+            self.settings['alternate12']=False
+            self.settings['alternate123']=False
+            self.calculate()
+            self.settings['radius']=radius; self.settings['alternate12']=alternate12; self.settings['alternate123']=alternate123
+            if self.stopped is False:
+                self.analog_output.stop()
+            self.nSamples=int(self.sampsPerPeriod)
+            self.analog_output.registerEveryNSamplesEvent(self.nSamples,self.EveryNCallback_py)
+            self.configureClock(self.sampsPerPeriod)
+            self.write(self.data,self.sampsPerPeriod)
+            self.analog_output.start()
+            self.stopped=False
+    def playTimeline(self,timeline):
+        ''' Streams a CompiledTimeline, starting at the next period boundary.'''
+        self.timeline=timeline
+        if timeline.settings is not None:
+            for data,setting in zip(timeline.buffers,timeline.settings):
+                self.logBuffer(data,[setting],[data.shape[1]],[None])
+        if timeline.stop_data is not None:
+            self.stream.setData(timeline.stop_data) # held from the end of the timeline until the task is stopped
+            watcher=threading.Thread(target=self.waitForTimeline,args=(timeline,)) # so the task isn't stopped from inside the DAQ callback
+            watcher.daemon=True
+            watcher.start()
+        self.stream.setSource(timeline.periods())
+        if self.stopped or timeline.sample_rate!=self.output_rate:
+            if not self.stopped:
+                self.analog_output.stop()
+            self.sample_rate=timeline.sample_rate
+            self.stopped=False
+            self.startStream()
+    def sweep(self,sweep,index_file=None):
+        ''' Plays a calibration Sweep (see sweep.py) like an acquisition: every point of its grid for its dwell, then
+        the output stops.  If index_file is given, the parameters of every camera frame are written to it first.'''
+        if not self.streaming:
+            raise RuntimeError('Sweeps can only be played in streaming mode')
+        with self.lock:
+            timeline=compile_sweep(self,sweep)
+            if index_file is not None:
+                sweep.writeIndex(index_file)
+            self.acquiring=True
+            self.logEvent(ACQUIRE,SWEEP,timeline.duration())
+            self.playTimeline(timeline)
+    def waitForTimeline(self,timeline):
+        timeline.finished.wait()
+        # the stream has only cut the timeline's last samples; stream_depth blocks are still queued ahead of the hardware
+        end=self.stream.samples+(self.stream_depth+1)*self.stream.block_size
+        while self.timeline is timeline and not self.stopped and self.stream.samples<end:
+            time.sleep(self.stream.block_size/self.output_rate)
+        if self.timeline is timeline:
+            print('Stopped Acquiring because the timeline finished')
+            self.stopAcquiring()
+    def EveryNCallback_py(self):
+        start=clock()
+        self.counter+=1
+        if self.counter==100:
+            self.calculate()
+            self.analog_output.stop()
+            self.configureClock(self.sampsPerPeriod)
+            self.write(self.data,self.sampsPerPeriod)
+            self.analog_output.start()
+            print('Opened "shutter" because counter reached {}'.format(self.counter))
+        if self.counter==200:
+            self.stopAcquiring()
+            print('Stopped Acquiring because counter reached {}'.format(self.counter))
+        self.trace.record(CALLBACK,start,clock()-start)
+    def stopAcquiring(self):
+        with self.lock:
+            if self.acquiring is False: # the acquisition was already stopped by the user before the timeline finished
+                return
+            self.logEvent(ACQUIRED)
+            if self.timeline is not None:
+                self.stream.setSource(None)
+                timeline=self.timeline
+                self.timeline=None
+                timeline.finished.set() # releases the thread waiting for it
+            self.settings.d[0]['frequency']=0
+            self.settings.d[0]['radius']=.6
+            self.settings.d[0]['alternate12']=False
+            self.settings.d[0]['alternate123']=False
+            self.calculate()
+            if not self.streaming:
+                self.createTask()
+            self.startstop()
+            self.acquiring=False
+        for callback in self.finished_acquire_callbacks:
+            callback()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+An always-on timing trace of the GalvoDriver.
+
+Every DAQ callback, hardware write, refresh and calculate records its start time and duration into preallocated numpy
+arrays used as a ring buffer.  Recording is three array assignments, so it is cheap enough to leave on; the statistics
+are only computed when someone asks for them:
+
+    galvoDriver.trace.summary()            percentiles of the duration of each kind of event, and of the callback jitter
+    galvoDriver.trace.dump('trace.npz')    saves the trace for offline analysis
+
+Times are in seconds from a monotonic clock.
+"""
+from __future__ import division
+import itertools
+import numpy as np
+from daq_backend import clock
+
+CALLBACK,WRITE,REFRESH,CALCULATE=range(4)
+EVENT_NAMES=('callback','write','refresh','calculate')
+
+
+def percentiles_ms(values,percentiles):
+    return dict((p,float(v)*1000) for p,v in zip(percentiles,np.percentile(values,percentiles)))
+
+
+class Trace:
+    ''' Keeps the last capacity events.'''
+    def __init__(self,capacity=2**16):
+        self.capacity=capacity
+        self.event=np.zeros(capacity,dtype=np.uint8)
+        self.start=np.zeros(capacity)
+        self.duration=np.zeros(capacity)
+        self.counter=itertools.count() # next() on a count is atomic, so events from several threads never share a slot
+        self.count=0 # how many events have been recorded, including the ones which have been overwritten
+        self.expected_interval=None # if set, the time callbacks are supposed to be apart, used to report their jitter
+    def record(self,event,start,duration):
+        i=next(self.counter)
+        j=i%self.capacity
+        self.event[j]=event
+        self.start[j]=start
+        self.duration[j]=duration
+        self.count=i+1
+    def events(self):
+        ''' Returns (event, start, duration) arrays of the events in the buffer, oldest first.'''
+        count=self.count
+        if count<=self.capacity:
+            order=np.arange(count)
+        else:
+            order=np.arange(count,count+self.capacity)%self.capacity
+        return self.event[order],self.start[order],self.duration[order]
+    def summary(self,percentiles=(50,90,99,100)):
+        ''' Returns a dict with, for each kind of event, the number recorded and percentiles of their durations in ms.
+        'callback_interval' holds percentiles of the time between callbacks, and 'callback_jitter' the percentiles of how
+        far that is from expected_interval, both in ms.'''
+        event,start,duration=self.events()
+        result=dict()
+        for code,name in enumerate(EVENT_NAMES):
+            durations=duration[event==code]
+            if len(durations)==0:
+                continue
+            result[name]={'count':len(durations),'ms':percentiles_ms(durations,percentiles)}
+        intervals=np.diff(start[event==CALLBACK])
+        if len(intervals)>0:
+            result['callback_interval']={'count':len(intervals),'ms':percentiles_ms(intervals,percentiles)}
+            if self.expected_interval is not None:
+                jitter=np.abs(intervals-self.expected_interval)
+                result['callback_jitter']={'count':len(jitter),'ms':percentiles_ms(jitter,percentiles)}
+        return result
+    def dump(self,filename):
+        ''' Saves the trace as a .npz file with the arrays event, start and duration, and the names of the event codes.'''
+        event,start,duration=self.events()
+        np.savez(filename,event=event,start=start,duration=duration,event_names=np.array(EVENT_NAMES))
+    def clear(self):
+        self.counter=itertools.count()
+        self.count=0
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Reduces an output buffer to the few thousand points the preview panel draws.
+
+A buffer can be millions of samples long, far more than the panel has pixels.  The timelines (camera TTL and lasers) are
+reduced with min/max decimation: the buffer is cut into one bin per pixel, and the minimum and maximum of each bin are
+kept, so a one sample camera pulse still shows up.  The trajectory of the beam (sine against cosine) is a closed curve
+which is traced over and over, so it is reduced by keeping evenly spaced samples.  Both are a handful of numpy
+operations over the buffer, and only the reduced points are converted to volts when the buffer holds DAC codes.
+"""
+from __future__ import division
+import numpy as np
+
+TIMELINE_ROLES=('camera_ttl','blue_laser','green_laser')
+
+
+def role_rows(channel_map):
+    ''' Returns {role: the first row of the output buffer with that role}.'''
+    rows=dict()
+    for i,channel in enumerate(channel_map.channels):
+        rows.setdefault(channel['role'],i)
+    return rows
+
+
+def minmax(y,bins):
+    ''' Returns (x, y) of a polyline through the minimum and the maximum of each of bins equal parts of y.  x is in samples.'''
+    n=len(y)
+    if n<=2*bins:
+        return np.arange(n,dtype=np.float64),np.asarray(y,dtype=np.float64)
+    starts=(np.arange(bins)*n)//bins
+    points=np.empty((bins,2))
+    points[:,0]=np.minimum.reduceat(y,starts)
+    points[:,1]=np.maximum.reduceat(y,starts)
+    x=np.repeat(starts,2).astype(np.float64)
+    x[1::2]=np.append(starts[1:],n)-1 # the last sample of each bin
+    return x,points.ravel()
+
+
+def volts(values,coefficients):
+    ''' Converts DAC codes back to volts, or returns values if coefficients is None.'''
+    if coefficients is None:
+        return values
+    return (values-coefficients[0])/coefficients[1]
+
+
+class Preview:
+    ''' The reduced curves of an output buffer: the trajectory (x, y) and, for each role in TIMELINE_ROLES which is output,
+    a (sample, volts) polyline in timelines.  coefficients is the calibration of every channel if data holds DAC codes.'''
+    def __init__(self,data,channel_map,coefficients=None,points=2000,bins=500):
+        rows=role_rows(channel_map)
+        def row(role,values):
+            if coefficients is None:
+                return values
+            return volts(values,coefficients[rows[role]])
+        self.samples=data.shape[1]
+        step=max(1,self.samples//points)
+        self.x=row('sin',data[rows['sin'],::step].astype(np.float64)) if 'sin' in rows else np.zeros(0)
+        self.y=row('cos',data[rows['cos'],::step].astype(np.float64)) if 'cos' in rows else np.zeros(0)
+        self.timelines=dict()
+        for role in TIMELINE_ROLES:
+            if role in rows:
+                x,y=minmax(data[rows[role]],bins)
+                self.timelines[role]=(x,row(role,y))
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Plays long multi-setting protocols.
+
+A Protocol is a list of settings (illumination states) and a step table.  Each row of the step table is
+(setting index, repeats): output that setting for that many periods, then go to the next row.  For example
+
+    Protocol([angle_a, angle_b_blue], [(0, 10), (1, 3)], loop=True)
+
+outputs 10 revolutions at angle A, then 3 revolutions at angle B with the blue laser on, over and over.
+
+The SequencePlayer renders one period of every setting once, up front, and then yields those period buffers in the order
+the step table gives.  The PeriodStream cuts them into blocks for the DAQ as they are needed, so the protocol is never
+built in memory: the memory used is one period per setting, however long the protocol runs.
+"""
+from __future__ import division
+import numpy as np
+from waveform_cache import WaveformCache, normalize_setting
+from waveform_engine import WaveformEngine, sequence_periods
+from dac_codes import to_codes
+
+
+class Protocol:
+    ''' settings is a list of setting dicts.  steps is a sequence of (setting index, repeats) pairs.  If loop is True, the
+    protocol starts over after the last step, until it is stopped.'''
+    def __init__(self,settings,steps,loop=False):
+        self.settings=[dict(setting) for setting in settings]
+        self.steps=np.array(steps,dtype=np.int64).reshape(-1,2)
+        self.loop=loop
+        if len(self.steps)==0:
+            raise ValueError('A protocol needs at least one step')
+        if self.steps[:,0].min()<0 or self.steps[:,0].max()>=len(self.settings):
+            raise ValueError('The step table refers to a setting which is not in the protocol')
+        if self.steps[:,1].min()<1:
+            raise ValueError('Every step has to be repeated at least once')
+    def periods(self):
+        ''' The period of each setting.  As in calculate(), a setting with a frequency of 0 adopts the period of the first setting which has one.'''
+        return sequence_periods(self.settings)
+    def duration(self):
+        ''' How long one pass through the protocol lasts, in seconds.'''
+        periods=np.array(self.periods())
+        return float(np.sum(periods[self.steps[:,0]]*self.steps[:,1]))
+
+
+class SequencePlayer:
+    ''' Renders one period buffer per setting of the protocol, and yields them from periods() in the order of the step table.
+    step and repeat say where the player is in the protocol.  If channel_map is given, the buffers have its channels
+    instead of the engine's rows.  If coefficients (the calibration of every channel) is given, the buffers are int16 DAC
+    codes instead of volts.  If a Compensator from galvo_compensation.py is given, the galvo rows are pre-compensated.'''
+    def __init__(self,protocol,sample_rate,cache=None,coefficients=None,channel_map=None,compensator=None):
+        self.protocol=protocol
+        self.sample_rate=sample_rate
+        if cache is None:
+            cache=WaveformCache()
+        engine=WaveformEngine(sample_rate)
+        self.buffers=[]
+        for setting,period in zip(protocol.settings,protocol.periods()):
+            key=(sample_rate,period,coefficients is not None,compensator.key() if compensator is not None else None,normalize_setting(setting))
+            cached=cache.get(key)
+            if cached is None:
+                rendered,n=engine.render([setting],[period])
+                if channel_map is None:
+                    data=rendered.copy()
+                else:
+                    data=channel_map.expand(rendered)
+                if compensator is not None:
+                    rows=channel_map.rows if channel_map is not None else range(len(data))
+                    compensator.apply(data,rendered,rows,engine.contents,engine.lengths,sample_rate)
+                if coefficients is not None:
+                    data=to_codes(data,coefficients)
+                cached=(data,n)
+                cache.put(key,cached)
+            self.buffers.append(cached[0])
+        self.step=0
+        self.repeat=0
+        self.passes=0 # how many times the whole protocol has been played
+    def periods(self):
+        steps=self.protocol.steps
+        while True:
+            for self.step in range(len(steps)):
+                data=self.buffers[steps[self.step,0]]
+                for self.repeat in range(steps[self.step,1]):
+                    yield data
+            self.passes+=1
+            if not self.protocol.loop:
+                return
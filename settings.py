@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+The settings of the galvo driver.  settings.d[0] is always the current setting and settings.d[1], d[2] and d[3] are the
+settings stored with the 'Save' buttons.
+"""
+import os
+import sys
+if sys.version_info.major==2:
+    import cPickle as pickle # pickle serializes python objects so they can be saved persistantly.  It converts a python object into a savable data structure
+else:
+    import pickle
+from os.path import expanduser
+
+
+def default_setting():
+    a=dict()
+    a['frequency']=200 #Hz
+    a['radius']=.93 #in volts.  Max amplitude is 10 volts
+    a['ellipticity']=.49
+    a['phase']=-.001
+    a['x_shift']=.04
+    a['y_shift']=-.028
+    a['alternate12']=False # When this is true, settings 1 and 2 are alternated every cycle.
+    a['alternate123']=False # When this is true, settings 1,2 and 3 are cycled through.
+    a['blue_laser']=False
+    a['green_laser']=False
+    a['green_laser_power']=5 #in volts
+    a['blue_laser_power']=5 #in volts
+    return a
+
+
+class Settings:
+    ''' This class saves all the settings as you adjust them.  This way, when you close the program and reopen it, all your settings will automatically load as they were just after the last adjustement'''
+    def __init__(self):
+        self.i=0
+        self.config_file=os.path.join(expanduser("~"),'.ShadowlessTIRF','config.p')
+        try:
+            self.d=pickle.load(open(self.config_file, "rb" ))
+        except IOError:
+            a=default_setting()
+            self.d=[a,a.copy(),a.copy(),a.copy()]
+    def __getitem__(self, item):
+        return self.d[self.i][item]
+    def __setitem__(self,key,item):
+        self.d[self.i][key]=item
+    def save(self):
+        '''save to a config file.'''
+        if not os.path.exists(os.path.dirname(self.config_file)):
+            os.makedirs(os.path.dirname(self.config_file))
+        pickle.dump(self.d, open(self.config_file, "wb" ))
+    def keys(self):
+        return self.d[self.i].keys()
+    def sequence(self,setting=None):
+        ''' Returns the indices of the settings which are output one after another, one period each, when setting (by
+        default the current setting) is the current setting.'''
+        if setting is None:
+            setting=self.d[self.i]
+        if setting['alternate12']:
+            return [1,2]
+        elif setting['alternate123']:
+            return [1,2,3]
+        else:
+            return [self.i]
@@ -38,238 +38,25 @@ Blue laser is active high
 Blue laser requires "Digital:Power" mode in 'Coherent Connection' software to be operated via ttl pulse.
 """
 from __future__ import division
+import startup_report
 import os
 os.chdir(os.path.split(os.path.realpath(__file__))[0])
 import dependency_check
-from PyDAQmx import *
-from PyDAQmx.DAQmxCallBack import *
-import numpy as np
+startup_report.mark('dependency check')
+from settings import Settings
+from galvo_driver import GalvoDriver
+from update_scheduler import UpdateScheduler
+from instrumentation import clock
+startup_report.mark('import driver')
 from PyQt4.QtGui import * # Qt is Nokias GUI rendering code written in C++.  PyQt4 is a library in python which binds to Qt
 from PyQt4.QtCore import *
 from PyQt4.QtCore import pyqtSignal as Signal
 from PyQt4.QtCore import pyqtSlot  as Slot
 import sys
-if sys.version_info.major==2:
-    import cPickle as pickle # pickle serializes python objects so they can be saved persistantly.  It converts a python object into a savable data structure
-else:
-    import pickle
-import os, time
-from os.path import expanduser
+startup_report.mark('import Qt')
+from functools import partial
 
 
-class Settings:
-    ''' This class saves all the settings as you adjust them.  This way, when you close the program and reopen it, all your settings will automatically load as they were just after the last adjustement'''
-    def __init__(self):
-        self.i=0
-        self.config_file=os.path.join(expanduser("~"),'.ShadowlessTIRF','config.p')
-        try:
-            self.d=pickle.load(open(self.config_file, "rb" ))
-        except IOError:
-            a=dict()
-            a['frequency']=200 #Hz
-            a['radius']=.93 #in volts.  Max amplitude is 10 volts
-            a['ellipticity']=.49
-            a['phase']=-.001
-            a['x_shift']=.04
-            a['y_shift']=-.028
-            a['alternate12']=False # When this is true, settings 1 and 2 are alternated every cycle.
-            a['alternate123']=False # When this is true, settings 1,2 and 3 are cycled through.
-            a['blue_laser']=False
-            a['green_laser']=False
-            a['green_laser_power']=5 #in volts
-            a['blue_laser_power']=5 #in volts
-            self.d=[a,a.copy(),a.copy(),a.copy()]
-    def __getitem__(self, item):
-        return self.d[self.i][item]
-    def __setitem__(self,key,item):
-        self.d[self.i][key]=item
-    def save(self):
-        '''save to a config file.'''
-        if not os.path.exists(os.path.dirname(self.config_file)):
-            os.makedirs(os.path.dirname(self.config_file))
-        pickle.dump(self.d, open(self.config_file, "wb" ))
-    def keys(self):
-        return self.d[self.i].keys()
-        
-
-        
-class GalvoDriver(QWidget):
-    ''' This class sends creates the signal which will control the two galvos and the lasers, and sends it to the DAQ.'''
-    finished_acquire_sig=Signal()
-    def __init__(self,settings):
-        QWidget.__init__(self)
-        self.settings=settings
-        self.sample_rate=1000000 # Maximum for the NI PCI-6733 is 1MHz.
-        self.sampsPerPeriod=1 #dummy variable
-        self.calculate()
-        self.read = int32()
-        self.createTask()
-        self.hide()
-    def createTask(self):
-        self.analog_output = Task()
-        self.analog_output.CreateAOVoltageChan("Dev2/ao2","",-10.0,10.0,DAQmx_Val_Volts,None) #On the NI PCI-6733, ao2 is pin 57 and ground is 56
-        self.analog_output.CreateAOVoltageChan("Dev2/ao3","",-10.0,10.0,DAQmx_Val_Volts,None) #On the NI PCI-6733, ao3 is pin 25 and ground is 24
-        self.analog_output.CreateAOVoltageChan("Dev2/ao4","",-10.0,10.0,DAQmx_Val_Volts,None) #On the NI PCI-6733, ao4 is pin 60 and ground is 59
-        self.analog_output.CreateAOVoltageChan("Dev2/ao5","",-10.0,10.0,DAQmx_Val_Volts,None) #On the NI PCI-6733, ao5 is pin 28 and ground is 29. This is blue laser
-        self.analog_output.CreateAOVoltageChan("Dev2/ao6","",-10.0,10.0,DAQmx_Val_Volts,None) #On the NI PCI-6733, ao6 is pin 30 and ground is 31. This is green laser
-
-
-                        #  CfgSampClkTiming(source, rate, activeEdge, sampleMode, sampsPerChan)
-        self.analog_output.CfgSampClkTiming("",self.sample_rate,DAQmx_Val_Rising,DAQmx_Val_ContSamps,self.sampsPerPeriod)
-                        #  WriteAnalogF64(numSampsPerChan, autoStart, timeout, dataLayout, writeArray, sampsPerChanWritten, reserved)
-        self.analog_output.WriteAnalogF64(self.sampsPerPeriod,0,-1,DAQmx_Val_GroupByChannel,self.data,byref(self.read),None) 
-        self.analog_output.StartTask()
-        self.stopped=False
-        self.acquiring=False
-        
-        
-        
-        
-    def getSinCosTTL(self,frequency,radius,ellipticity,phase,x_shift,y_shift,blue_laser,green_laser,blue_laser_power,green_laser_power,period=.005):
-        ''' The period argument is only used when the value of the frequency is 0'''
-        if frequency==0:
-            t=np.arange(0,period,1/self.sample_rate)
-            sinwave=radius*np.sin(np.zeros(len(t)))+x_shift/1000
-            coswave=(ellipticity*radius*np.cos(np.zeros(len(t))+phase*(2*np.pi/360)))+(y_shift/1000)
-        else:
-            period=1/frequency
-            t=np.arange(0,period,1/self.sample_rate )
-            sinwave=radius*np.sin(frequency*(t*(2*np.pi)))+x_shift/1000
-            coswave=(ellipticity*radius*np.cos(frequency*t*2*np.pi+phase*(2*np.pi/360)))+(y_shift/1000)
-            camera_ttl=np.zeros(len(t))
-            camera_ttl[0]=5
-        camera_ttl=np.zeros(len(t))
-        camera_ttl[0]=5
-        if blue_laser:
-            blue_laser_ttl=blue_laser_power*np.ones(len(t))
-            #a=len(t)
-            #blue_laser_ttl[a/8:3*a/8]=blue_laser_power #right
-            #blue_laser_ttl[3*a/8:5*a/8]=blue_laser_power #bottom
-            #blue_laser_ttl[5*a/8:7*a/8]=blue_laser_power #left
-            #blue_laser_ttl[:a/8]=blue_laser_power; blue_laser_ttl[7*a/8:]=blue_laser_power #top
-            
-        else:
-            blue_laser_ttl=-.08*np.ones(len(t))
-        if green_laser:
-            green_laser_ttl=green_laser_power*np.ones(len(t)) #0V is on for green laser
-        else:
-            green_laser_ttl=-.08*np.ones(len(t)) #5V is off for green laser
-        return sinwave,coswave,camera_ttl, blue_laser_ttl, green_laser_ttl
-    def calculate(self):
-        s=self.settings
-        if s['alternate12'] is False and s['alternate123'] is False:
-            sinwave,coswave,camera_ttl,blue_laser_ttl, green_laser_ttl=self.getSinCosTTL(s['frequency'],s['radius'],s['ellipticity'],s['phase'],s['x_shift'],s['y_shift'],s['blue_laser'],s['green_laser'],s['blue_laser_power'],s['green_laser_power'])
-            self.data=np.concatenate((sinwave,coswave,camera_ttl,blue_laser_ttl,green_laser_ttl))
-            self.sampsPerPeriod=len(sinwave)
-        elif s['alternate12']:
-            f1=s.d[1]['frequency']
-            f2=s.d[2]['frequency']
-            if f1==0 and f2==0:
-                period1=.005; period2=.005; #Alternate every 5ms if there is the frequency for both setting #1 and setting #2 is 0
-            elif f1==0:
-                period1=1/f2; period2=period1 #Give adopt the period of setting #2 if the frequency for setting #1 is 0
-            elif f2==0:
-                period1=1/f1; period2=period1
-            else:
-                period1=1/f1; period2=1/f2
-            sinwave1,coswave1,camera_ttl1,blue_laser_ttl1,green_laser_ttl1=self.getSinCosTTL(f1,s.d[1]['radius'],s.d[1]['ellipticity'],s.d[1]['phase'],s.d[1]['x_shift'],s.d[1]['y_shift'],s.d[1]['blue_laser'],s.d[1]['green_laser'],s.d[1]['blue_laser_power'],s.d[1]['green_laser_power'],period1)
-            sinwave2,coswave2,camera_ttl2,blue_laser_ttl2,green_laser_ttl2=self.getSinCosTTL(f2,s.d[2]['radius'],s.d[2]['ellipticity'],s.d[2]['phase'],s.d[2]['x_shift'],s.d[2]['y_shift'],s.d[2]['blue_laser'],s.d[2]['green_laser'],s.d[2]['blue_laser_power'],s.d[2]['green_laser_power'],period2)
-            self.data=np.concatenate((sinwave1,sinwave2,coswave1,coswave2,camera_ttl1,camera_ttl2,blue_laser_ttl1,blue_laser_ttl2,green_laser_ttl1,green_laser_ttl2))
-            self.sampsPerPeriod=len(sinwave1)+len(sinwave2)
-        elif s['alternate123']:
-            f1=s.d[1]['frequency']
-            f2=s.d[2]['frequency']
-            f3=s.d[3]['frequency']
-            if f1==0 and f2==0 and f3==0:
-                period1=.005; period2=.005; period3=.005;
-            elif f1==0 and f2==0:
-                period3=1/f3; period2=period3; period1=period3;
-            elif f1==0 and f3==0:
-                period2=1/f2; period1=period2; period3=period2
-            elif f2==0 and f3==0:
-                period1=1/f1; period2=period1; period3=period1
-            elif f1==0:
-                period2=1/f2; period3=1/f3; period1=period2
-            elif f2==0:
-                period1=1/f1; period2=period1; period3=1/f3
-            elif f3==0:
-                period1=1/f1; period2=1/f2; period3=period1
-            else:
-                period1=1/f1; period2=1/f2; period3=1/f3
-            sinwave1,coswave1,camera_ttl1,blue_laser_ttl1,green_laser_ttl1=self.getSinCosTTL(f1,s.d[1]['radius'],s.d[1]['ellipticity'],s.d[1]['phase'],s.d[1]['x_shift'],s.d[1]['y_shift'],s.d[1]['blue_laser'],s.d[1]['green_laser'],s.d[1]['blue_laser_power'],s.d[1]['green_laser_power'],period1)
-            sinwave2,coswave2,camera_ttl2,blue_laser_ttl2,green_laser_ttl2=self.getSinCosTTL(f2,s.d[2]['radius'],s.d[2]['ellipticity'],s.d[2]['phase'],s.d[2]['x_shift'],s.d[2]['y_shift'],s.d[2]['blue_laser'],s.d[2]['green_laser'],s.d[2]['blue_laser_power'],s.d[2]['green_laser_power'],period2)
-            sinwave3,coswave3,camera_ttl3,blue_laser_ttl3,green_laser_ttl3=self.getSinCosTTL(f3,s.d[3]['radius'],s.d[3]['ellipticity'],s.d[3]['phase'],s.d[3]['x_shift'],s.d[3]['y_shift'],s.d[3]['blue_laser'],s.d[3]['green_laser'],s.d[3]['blue_laser_power'],s.d[3]['green_laser_power'],period3)
-            self.data=np.concatenate((sinwave1,sinwave2,sinwave3,coswave1,coswave2,coswave3,camera_ttl1,camera_ttl2,camera_ttl3,blue_laser_ttl1,blue_laser_ttl2,blue_laser_ttl3,green_laser_ttl1,green_laser_ttl2,green_laser_ttl3))
-            self.sampsPerPeriod=len(sinwave1)+len(sinwave2)+len(sinwave3)
-    def startstop(self):
-        if self.stopped:
-            self.analog_output.StartTask()
-            self.stopped=False
-            self.refresh()
-        else:
-            self.settings.d[0]['frequency']=0
-            self.settings.d[0]['radius']=.6
-            self.settings.d[0]['alternate']=False
-            self.refresh()
-            self.analog_output.StopTask()
-            self.stopped=True
-    def refresh(self):
-        if self.stopped is False:
-            self.calculate()
-            self.analog_output.StopTask()
-            self.analog_output.CfgSampClkTiming("",self.sample_rate,DAQmx_Val_Rising,DAQmx_Val_ContSamps,self.sampsPerPeriod)
-            self.analog_output.WriteAnalogF64(self.sampsPerPeriod,0,-1,DAQmx_Val_GroupByChannel,self.data,byref(self.read),None) 
-            self.analog_output.StartTask()
-    def acquire(self):
-        print('Acquiring')
-        self.acquiring=True
-        self.counter=0
-        self.tic=time.time()
-        radius=self.settings.d[0]['radius']; alternate12=self.settings.d[0]['alternate12']; alternate123=self.settings.d[0]['alternate123']
-        self.settings['radius']=.6
-        self.settings['alternate12']=False
-        self.settings['alternate123']=False
-        self.calculate()
-        self.settings['radius']=radius; self.settings['alternate12']=alternate12; self.settings['alternate123']=alternate123
-        if self.stopped is False:
-            self.analog_output.StopTask()
-        self.EveryNCallback = DAQmxEveryNSamplesEventCallbackPtr(self.EveryNCallback_py)
-        self.nSamples=int(self.sampsPerPeriod)
-        DAQmxRegisterEveryNSamplesEvent(self.analog_output.taskHandle,DAQmx_Val_Transferred_From_Buffer,self.nSamples,0,self.EveryNCallback,None)
-        self.analog_output.CfgSampClkTiming("",self.sample_rate,DAQmx_Val_Rising,DAQmx_Val_ContSamps,self.sampsPerPeriod)
-        self.analog_output.WriteAnalogF64(self.sampsPerPeriod,0,-1,DAQmx_Val_GroupByChannel,self.data,byref(self.read),None)         
-        self.analog_output.StartTask()
-        self.stopped=False
-        
-    def EveryNCallback_py(self,taskHandle, status, callbackData,sure):
-        self.counter+=1
-        if self.counter==100:
-            self.calculate()
-            self.analog_output.StopTask()
-            self.analog_output.CfgSampClkTiming("",self.sample_rate,DAQmx_Val_Rising,DAQmx_Val_ContSamps,self.sampsPerPeriod)
-            self.analog_output.WriteAnalogF64(self.sampsPerPeriod,0,-1,DAQmx_Val_GroupByChannel,self.data,byref(self.read),None)         
-            self.analog_output.StartTask()
-            print('Opened "shutter" because counter reached {}'.format(self.counter))
-        if self.counter==200:
-            self.stopAcquiring()
-            print('Stopped Acquiring because counter reached {}'.format(self.counter))
-        #print(time.time()-self.tic)
-        return 0 # The function should return an integer
-    def stopAcquiring(self):
-        self.settings.d[0]['frequency']=0
-        self.settings.d[0]['radius']=.6
-        self.settings.d[0]['alternate12']=False
-        self.settings.d[0]['alternate123']=False
-        self.calculate()
-        self.createTask()
-        self.startstop()
-        self.acquiring=False
-        self.finished_acquire_sig.emit()
-        #maingui.acquireButton.setStyleSheet("background-color: green");
-            
-        
-        
-
 ##############################################################################
 ####   GRAPHICAL USER INTERFACE ##############################################
 ##############################################################################
@@ -334,16 +121,86 @@ class CheckBox(QCheckBox):
     def setValue(self,value):
         self.setChecked(value)
 
+class PreviewPanel(QWidget):
+    ''' Draws the trajectory of the beam (sine against cosine) and the camera TTL and laser timelines of the output buffer.
+    A new buffer is only reduced to points (see preview.py) when the panel is next painted, so buffers which arrive faster
+    than the screen is redrawn are skipped, and nothing is drawn when the buffer doesn't change.'''
+    colors={'camera_ttl':Qt.black,'blue_laser':Qt.blue,'green_laser':Qt.darkGreen}
+    labels={'camera_ttl':'Camera','blue_laser':'Blue','green_laser':'Green'}
+    def __init__(self,galvoDriver,parent=None):
+        QWidget.__init__(self,parent)
+        self.galvoDriver=galvoDriver
+        self.data=None
+        self.preview=None
+        self.preview_width=None
+        self.reduce_ms=0
+        self.setMinimumHeight(160)
+    def setData(self,data):
+        self.data=data
+        self.preview=None
+        self.update()
+    def polygon(self,xs,ys,rect,xmin,xmax,ymin,ymax):
+        px=rect.left()+(xs-xmin)*(rect.width()/(xmax-xmin))
+        py=rect.bottom()-(ys-ymin)*(rect.height()/(ymax-ymin))
+        return QPolygonF([QPointF(x,y) for x,y in zip(px,py)])
+    def paintEvent(self,event):
+        if self.data is None:
+            return
+        import numpy as np
+        from preview import Preview # imported once the window is drawn, not before it appears
+        if self.preview is None or self.preview_width!=self.width():
+            start=clock()
+            coefficients=self.galvoDriver.coefficients if self.data.dtype==np.int16 else None
+            self.preview=Preview(self.data,self.galvoDriver.channel_map,coefficients,bins=max(1,self.width()//2))
+            self.preview_width=self.width()
+            self.reduce_ms=(clock()-start)*1000
+        p=self.preview
+        painter=QPainter(self)
+        painter.setRenderHint(QPainter.Antialiasing)
+        side=self.height()-20
+        square=QRectF(0,0,side,side)
+        painter.setPen(QPen(Qt.lightGray))
+        painter.drawRect(square)
+        painter.drawLine(QPointF(side/2,0),QPointF(side/2,side))
+        painter.drawLine(QPointF(0,side/2),QPointF(side,side/2))
+        if len(p.x):
+            limit=max(np.abs(p.x).max(),np.abs(p.y).max(),.05)*1.1 # the same scale on both axes, so a circle looks round
+            painter.setPen(QPen(Qt.red))
+            painter.drawPolyline(self.polygon(p.x,p.y,square,-limit,limit,-limit,limit))
+        left=side+10
+        strips=[role for role in ('camera_ttl','blue_laser','green_laser') if role in p.timelines]
+        height=side/max(1,len(strips))
+        for i,role in enumerate(strips):
+            rect=QRectF(left+50,i*height+2,self.width()-left-52,height-4)
+            x,y=p.timelines[role]
+            painter.setPen(QPen(Qt.lightGray))
+            painter.drawRect(rect)
+            painter.setPen(QPen(Qt.black))
+            painter.drawText(QRectF(left,rect.top(),50,rect.height()),Qt.AlignVCenter,self.labels[role])
+            painter.setPen(QPen(self.colors[role]))
+            painter.drawPolyline(self.polygon(x,y,rect,0,max(1,p.samples-1),-.5,max(5.5,y.max()+.5)))
+        painter.setPen(QPen(Qt.black))
+        painter.drawText(QRectF(0,side,self.width(),20),Qt.AlignLeft|Qt.AlignVCenter,'{} samples, reduced in {:.1f} ms'.format(p.samples,self.reduce_ms))
+        painter.end()
+
 class MainGui(QWidget):
     ''' This class creates and controls the GUI '''
-    changeSignal=Signal()
-    def __init__(self):
+    finished_acquire_sig=Signal() # the driver finishes acquisitions from the DAQ's thread, so this passes the event to the GUI thread
+    plan_sig=Signal(object) # the driver is refreshed from the scheduler's thread, so this passes each new WaveformPlan to the GUI thread
+    data_sig=Signal(object) # and this passes each new output buffer to the preview
+    def __init__(self,backend=None,worker=False):
+        ''' If worker is True, the galvoDriver runs in a process of its own (see driver_worker.py), and backend is a function which creates the backend there.'''
         QWidget.__init__(self)
         self.setWindowTitle('Shadowless TIRF Galvo Driver')
         
         formlayout=QFormLayout()
         self.settings=Settings()
-        self.galvoDriver=GalvoDriver(self.settings)
+        if worker:
+            from driver_worker import DriverProcess # and multiprocessing, which only the worker needs
+            self.galvoDriver=DriverProcess(self.settings,backend)
+        else:
+            self.galvoDriver=GalvoDriver(self.settings,backend)
+        startup_report.mark('first waveform output')
         frequency=FrequencySlider(3); frequency.setRange(0,500)
         radius=SliderLabel(3); radius.setRange(0,.6)
         ellipticity=SliderLabel(3); ellipticity.setRange(0,2.5)
@@ -369,6 +226,16 @@ class MainGui(QWidget):
         for item in self.items:
             formlayout.addRow(item['string'],item['object'])
             item['object'].setValue(self.settings[item['name']])
+        self.planLabel=QLabel() # shows the frequency which is actually output and the size of the buffer
+        formlayout.addRow(self.planLabel)
+        if self.galvoDriver.plan is not None:
+            self.showPlan(self.galvoDriver.plan)
+        self.galvoDriver.plan_callbacks.append(self.plan_sig.emit)
+        self.plan_sig.connect(self.showPlan)
+        self.previewPanel=PreviewPanel(self.galvoDriver)
+        self.previewPanel.setData(self.galvoDriver.data)
+        self.galvoDriver.data_callbacks.append(self.data_sig.emit)
+        self.data_sig.connect(self.previewPanel.setData)
             
         
         
@@ -391,52 +258,61 @@ class MainGui(QWidget):
         self.stopButton=QPushButton('Stop'); self.stopButton.setStyleSheet("background-color: red"); self.stopButton.clicked.connect(self.startstop)
         self.acquireButton=QPushButton('Acquire'); self.acquireButton.setStyleSheet("background-color: green"); self.acquireButton.clicked.connect(self.acquire)
         self.acquireButton.hide() 
-        self.galvoDriver.finished_acquire_sig.connect(self.finished_acquire)
+        self.galvoDriver.finished_acquire_callbacks.append(self.finished_acquire_sig.emit)
+        self.finished_acquire_sig.connect(self.finished_acquire)
         stopacquirebox=QGridLayout()
         stopacquirebox.addWidget(self.stopButton,0,0)
         stopacquirebox.addWidget(self.acquireButton,0,1)
         
         self.layout=QVBoxLayout()
         self.layout.addLayout(formlayout)
+        self.layout.addWidget(self.previewPanel)
         self.layout.addWidget(membox)
         self.layout.addSpacing(100)
         self.layout.addLayout(stopacquirebox)
         self.setLayout(self.layout)
+        self.scheduler=UpdateScheduler(self.galvoDriver)
+        self.posting=True
         self.connectToChangeSignal()
-        self.changeSignal.connect(self.updateValues)
         self.setGeometry(QRect(488, 390, 704, 376))
         self.show()
+        startup_report.mark('window shown')
     def connectToChangeSignal(self):
+        ''' Finds, once, the signal each widget emits when it changes and the method which reads its value, and connects the signal so that the change is posted to the scheduler.'''
         for item in self.items:
             methods=[method for method in dir(item['object']) if callable(getattr(item['object'], method))]
+            if 'value' in methods:
+                item['getter']=item['object'].value
+            elif 'currentText' in methods:
+                item['getter']=item['object'].currentText
+            elif 'isChecked' in methods:
+                item['getter']=item['object'].isChecked
             if 'valueChanged' in methods:
-                item['object'].valueChanged.connect(self.changeSignal)
+                item['object'].valueChanged.connect(partial(self.itemChanged,item))
             elif 'stateChanged' in methods:
-                item['object'].stateChanged.connect(self.changeSignal)
+                item['object'].stateChanged.connect(partial(self.itemChanged,item))
             elif 'currentIndexChanged' in methods:
-                item['object'].currentIndexChanged.connect(self.changeSignal)
+                item['object'].currentIndexChanged.connect(partial(self.itemChanged,item))
+    def itemChanged(self,item,*args):
+        if self.posting:
+            self.scheduler.post({item['name']:item['getter']()})
     def updateValues(self):
-        for item in self.items:
-            methods=[method for method in dir(item['object']) if callable(getattr(item['object'], method))]
-            if 'value' in methods:
-                item['value']=item['object'].value()
-            elif 'currentText' in methods:
-                item['value']=item['object'].currentText()
-            elif 'isChecked' in methods:
-                item['value']=item['object'].isChecked()
-            self.settings[item['name']]=item['value']
-        self.galvoDriver.refresh()
+        ''' Applies the value of every widget to the current setting and waits for the galvoDriver to be refreshed.'''
+        self.scheduler.post(dict((item['name'],item['getter']()) for item in self.items))
+        self.scheduler.flush()
+    def showPlan(self,plan):
+        self.planLabel.setText(plan.describe())
     def memrecall(self,i):
         '''i is the setting number we are recalling'''
-        self.changeSignal.disconnect(self.updateValues)
+        self.posting=False # the whole setting is posted at once below
         s=self.settings
-        s.d[0]=s.d[i].copy()
         for item in self.items:
-            item['object'].setValue(s.d[0][item['name']])
-        self.changeSignal.connect(self.updateValues)
-        self.galvoDriver.refresh()
+            item['object'].setValue(s.d[i][item['name']])
+        self.posting=True
+        self.scheduler.post(s.d[i].copy())
     def memstore(self,i):
         '''i is the setting number we are storing.  settings.d[0] is always the current setting.'''
+        self.scheduler.flush()
         self.settings.d[i]=self.settings.d[0].copy()
         self.settings.save()
     def acquire(self):
@@ -472,6 +348,26 @@ class MainGui(QWidget):
     
 if __name__ == '__main__':
     app = QApplication(sys.argv)
-    maingui=MainGui()
+    startup_report.mark('QApplication')
+    worker='--worker' in sys.argv # run the driver in a process of its own
+    if '--simulate' in sys.argv: # run without the NI card
+        from daq_backend import SimulatedBackend
+        maingui=MainGui(partial(SimulatedBackend,record_data=False) if worker else SimulatedBackend(record_data=False),worker)
+    else:
+        maingui=MainGui(worker=worker)
+    if '--raw' in sys.argv: # write int16 DAC codes instead of float64 volts
+        maingui.galvoDriver.setRaw(True)
+    if '--transitions' in sys.argv: # move the galvos smoothly from one setting to the next
+        from transitions import Transitions
+        maingui.galvoDriver.setTransitions(Transitions())
+    if '--event-log' in sys.argv: # log every change and camera trigger to the file which follows
+        filename=sys.argv[sys.argv.index('--event-log')+1]
+        from event_log import EventLog
+        maingui.galvoDriver.setEventLog(filename if worker else EventLog(filename))
+    if '--startup-report' in sys.argv:
+        def print_startup_report():
+            startup_report.mark('event loop running')
+            print(startup_report.report())
+        QTimer.singleShot(0,print_startup_report) # runs once the event loop has drawn the window
     sys.exit(app.exec_())
     
\ No newline at end of file
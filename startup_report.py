@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+Times the stages of starting the program.  shadowlessTIRF.py marks each stage as it reaches it, and
+python shadowlessTIRF.py --startup-report prints the times once the window is up.
+
+This module only imports the standard library, so it can be imported first and time everything after it.
+"""
+from __future__ import print_function
+import time
+
+clock=getattr(time,'perf_counter',time.time)
+start=clock()
+marks=[]
+
+
+def mark(name):
+    ''' Records that the stage called name has just finished.'''
+    marks.append((name,clock()))
+
+
+def report():
+    ''' Returns the report as a string: how long each stage took, and when it finished, in ms.'''
+    lines=['{:<28}{:>10}{:>10}'.format('stage','ms','total ms')]
+    previous=start
+    for name,t in marks:
+        lines.append('{:<28}{:>10.1f}{:>10.1f}'.format(name,(t-previous)*1000,(t-start)*1000))
+        previous=t
+    return '\n'.join(lines)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Streams the output buffer to the DAQ in small blocks instead of letting the DAQ regenerate it.
+
+When the DAQ regenerates a buffer, the only way to change the output is to stop the task, write a new buffer and start it
+again, which halts the sample clock and makes the galvos jump.  With regeneration disabled, the DAQ keeps only a few
+blocks queued ahead of the hardware, and each time a block has been transferred the driver writes the next one.  The
+blocks are cut from an endless repetition of the current period, and a new period buffer takes over at the next period
+boundary, so a change of settings reaches the hardware within (depth x block_size) samples plus the rest of the period
+being output, without interrupting the sample clock.
+
+Instead of repeating one buffer, the stream can also take its periods from an iterator (see sequence_player.py).  When
+the iterator runs out, the stream goes back to repeating the newest buffer given to setData().
+
+A new buffer can come with a lead-in (see transitions.py), which is played once between the period being left and the
+first period of the new buffer.  It is only played if the period being left is the one it was made for.
+"""
+from __future__ import division
+import threading
+import numpy as np
+
+
+class PeriodStream:
+    ''' Cuts an endless repetition of a (channels x samples) period buffer into blocks of block_size samples.
+    The block returned by nextBlock() is reused by the next call.  dtype is the type of the period buffers: float64 volts,
+    or int16 DAC codes.'''
+    def __init__(self,block_size,n_channels=5,dtype=np.float64):
+        self.block_size=block_size
+        self.block=np.zeros((n_channels,block_size),dtype=dtype)
+        self.data=None # the period being cut into blocks
+        self.repeating=None # the period which is repeated when there is no source
+        self.pending=None # (data, lead_in) given to setData() and not taken yet
+        self.lock=threading.Lock() # protects self.pending, which is set from another thread
+        self.source=None # an iterator of period buffers which, while it lasts, takes precedence over self.data
+        self.position=0 # where in self.data the next block starts
+        self.periods=0 # how many periods have been started
+        self.samples=0 # how many samples have been cut into blocks
+        self.on_period=None # if set, this is called with the period buffer and the sample it starts at every time a period is started
+    def setData(self,data,lead_in=None):
+        ''' Queues data to replace the current period at the next period boundary.  The array must not be modified afterwards.
+        This can be called from another thread than the one calling nextBlock().
+        lead_in is (period, buffer): buffer is played before data if the period which ends is period.'''
+        with self.lock:
+            self.pending=(data,lead_in)
+    def setSource(self,source):
+        ''' Plays the period buffers from the iterator source, one after another, starting at the next period boundary.
+        Pass None to go back to repeating the data given to setData().'''
+        self.source=source
+    def reset(self):
+        ''' Restarts at the beginning of a period, taking the newest data.  Used when the task is (re)started.'''
+        with self.lock:
+            pending=self.pending
+            self.pending=None
+        if pending is not None:
+            self.repeating=pending[0]
+        self.data=self.repeating
+        self.position=0
+    def nextBlock(self):
+        filled=0
+        while filled<self.block_size:
+            if self.position==0:
+                source=self.source
+                data=None
+                if source is not None:
+                    data=next(source,None)
+                    if data is None and self.source is source: # the source has run out
+                        self.source=None
+                if data is None:
+                    with self.lock: # taken together, so a setData() in between is neither lost nor split from its lead-in
+                        pending=self.pending
+                        self.pending=None
+                    if pending is not None:
+                        pending,lead_in=pending
+                        if lead_in is not None and lead_in[0] is self.data and lead_in[1].shape[1]>0:
+                            data=lead_in[1] # the pending data starts after it
+                        self.repeating=pending
+                    if data is None:
+                        data=self.repeating
+                self.data=data
+                self.periods+=1
+                if self.on_period is not None:
+                    self.on_period(self.data,self.samples+filled)
+            length=self.data.shape[1]
+            n=min(self.block_size-filled,length-self.position)
+            self.block[:,filled:filled+n]=self.data[:,self.position:self.position+n]
+            filled+=n
+            self.position=(self.position+n)%length
+        self.samples+=self.block_size
+        return self.block
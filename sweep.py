@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Calibration sweeps: every point of a grid of settings, one after another, for a fixed dwell each.
+
+Finding the TIRF angle and a round ring used to mean dragging the radius, ellipticity, phase and shift sliders and
+looking at the camera.  A Sweep takes a grid instead, like
+    Sweep({'radius': np.linspace(.5, 1, 11), 'ellipticity': [.45, .5, .55]}, dwell=.1)
+which holds every combination of the values (the last parameter changes fastest) for dwell seconds, starting from the
+current setting.  Every point has the same frequency, so it has the same number of samples per period, and the whole
+grid is rendered at once as a (points x channels x samples) array by a few broadcast numpy operations.  The sweep is
+then played like an acquisition (see acquisition_timeline.py): the stream steps through the points on its own, and the
+output stops on the stop setting at the end.  Nothing goes through the GUI.
+
+The camera is triggered as usual, and since every point lasts the same number of periods, frame f of the sweep is taken
+at point f // frames_per_point.  writeIndex() saves that as a tab separated file with one line per frame: the frame
+number, the point number and the parameters of the point.  Galvo compensation and transitions are not applied to sweeps.
+
+The array takes points x channels x samples x 8 bytes: 100 points of 5000 samples on 5 channels are 20 MB.
+
+    python sweep.py
+runs a sweep against the SimulatedBackend, reports how long it took to render and to play, and fails if the points or the
+index are wrong.
+"""
+from __future__ import division
+from __future__ import print_function
+import itertools
+import numpy as np
+from waveform_engine import WaveformEngine, SIN, COS, CAMERA_TTL, BLUE_LASER, GREEN_LASER, N_CHANNELS
+from acquisition_timeline import CompiledTimeline, render_event, DEFAULT_TIMELINE
+from dac_codes import to_codes
+
+SWEEP_KEYS=('radius','ellipticity','phase','x_shift','y_shift','blue_laser_power','green_laser_power')
+STOP=DEFAULT_TIMELINE[-1][2] # the setting the output stops on, as at the end of an acquisition
+
+
+class Sweep:
+    ''' grid is a dict of {setting name: values}, for the names in SWEEP_KEYS.  dwell is how long each point is held, in
+    seconds.  It is rounded to a whole number of periods.'''
+    def __init__(self,grid,dwell):
+        unknown=set(grid)-set(SWEEP_KEYS)
+        if unknown:
+            raise ValueError('These settings can not be swept: {}'.format(', '.join(sorted(unknown))))
+        if len(grid)==0 or any(len(values)==0 for values in grid.values()):
+            raise ValueError('The grid is empty')
+        if not dwell>0:
+            raise ValueError('The dwell has to be above 0')
+        self.names=[name for name in SWEEP_KEYS if name in grid]
+        self.points=np.array(list(itertools.product(*[grid[name] for name in self.names])),dtype=np.float64) # (points x names)
+        self.dwell=dwell
+        self.periods=None # how many periods each point is held. These are set by render()
+        self.frames_per_point=None
+        self.sample_rate=None
+        self.samples=None # the number of samples of one period
+    def __len__(self):
+        return len(self.points)
+    def parameters(self,base):
+        ''' Returns {name: array of the value at every point} for every name in SWEEP_KEYS, from the grid or from base.'''
+        values=dict((name,np.full(len(self.points),float(base[name]))) for name in SWEEP_KEYS)
+        for i,name in enumerate(self.names):
+            values[name]=self.points[:,i]
+        return values
+    def settings(self,base):
+        ''' The setting of every point: base with the point's values.'''
+        return [dict(base,**dict(zip(self.names,point))) for point in self.points]
+    def render(self,base,sample_rate,plan=None,camera=None):
+        ''' Returns the (points x N_CHANNELS x samples) buffers of one period of every point, which is base with the
+        point's values.  plan is a WaveformPlan of base's frequency at sample_rate, or None to use sample_rate as it is.'''
+        engine=WaveformEngine(sample_rate)
+        template,n=engine.render([base],plan=plan,camera=camera) # every point shares its length, angles and camera pulses
+        setting,revolutions,triggers=engine.contents[0]
+        values=self.parameters(base)
+        out=np.empty((len(self.points),N_CHANNELS,n))
+        if base['frequency']==0:
+            angle=np.zeros(n)
+        elif revolutions is None:
+            angle=np.arange(n)*(base['frequency']*2*np.pi/sample_rate)
+        else:
+            angle=np.arange(n)*(revolutions*2*np.pi/n)
+        radius=values['radius'][:,None]
+        np.multiply(radius,np.sin(angle),out=out[:,SIN])
+        out[:,SIN]+=values['x_shift'][:,None]/1000
+        np.add(angle,values['phase'][:,None]*(2*np.pi/360),out=out[:,COS])
+        np.cos(out[:,COS],out=out[:,COS])
+        out[:,COS]*=values['ellipticity'][:,None]*radius
+        out[:,COS]+=values['y_shift'][:,None]/1000
+        out[:,CAMERA_TTL]=template[CAMERA_TTL]
+        for row,name in ((BLUE_LASER,'blue_laser'),(GREEN_LASER,'green_laser')):
+            out[:,row]=values[name+'_power'][:,None] if base[name] else template[row]
+        self.sample_rate=sample_rate
+        self.samples=n
+        self.periods=max(1,int(round(self.dwell*sample_rate/n)))
+        self.frames_per_point=self.periods*triggers
+        return out
+    def duration(self):
+        return len(self.points)*self.periods*self.samples/self.sample_rate
+    def frames(self):
+        ''' The number of camera frames of the whole sweep.'''
+        return len(self.points)*self.frames_per_point
+    def writeIndex(self,filename):
+        ''' Writes one line per camera frame: frame number, point number, then the value of every swept parameter.'''
+        frame=np.arange(self.frames())
+        point=frame//self.frames_per_point
+        with open(filename,'w') as f:
+            f.write('\t'.join(['frame','point']+self.names)+'\n')
+            for i,j in zip(frame,point):
+                f.write('\t'.join([str(i),str(j)]+['{:.9g}'.format(v) for v in self.points[j]])+'\n')
+
+
+def compile_sweep(galvoDriver,sweep):
+    ''' Renders every point of sweep, from the current setting of galvoDriver, and returns a CompiledTimeline which plays
+    them and stops.'''
+    s=galvoDriver.settings
+    base=dict(s.d[s.i])
+    base['alternate12']=False
+    base['alternate123']=False
+    plan=None
+    sample_rate=galvoDriver.sample_rate
+    if galvoDriver.planner is not None:
+        plan=galvoDriver.planner.plan([base['frequency']],camera=galvoDriver.camera,preferred_rate=galvoDriver.preferredRate())
+        sample_rate=plan.sample_rate
+    stop_data=render_event(galvoDriver,STOP,sample_rate)[0]
+    batch=sweep.render(base,sample_rate,plan,galvoDriver.camera)
+    batch=np.take(batch,galvoDriver.channel_map.rows,axis=1)
+    if galvoDriver.raw:
+        codes=np.empty(batch.shape,dtype=np.int16)
+        for point,data in enumerate(batch):
+            to_codes(data,galvoDriver.coefficients,codes[point])
+        batch=codes
+    names=['point {}'.format(i) for i in range(len(sweep))]
+    return CompiledTimeline(names,list(batch),[sweep.periods]*len(sweep),stop_data,sample_rate,sweep.settings(base))
+
+
+def check(dwell=.01):
+    ''' Checks the batch against the WaveformEngine, then plays an 11 x 3 sweep on the SimulatedBackend and checks its
+    index.  Returns True if both are right.'''
+    import os
+    import tempfile
+    import time
+    from settings import Settings, default_setting
+    from galvo_driver import GalvoDriver
+    from daq_backend import SimulatedBackend
+    from instrumentation import clock
+    sweep=Sweep({'radius':np.linspace(.5,1,11),'ellipticity':[.45,.5,.55]},dwell)
+    base=default_setting()
+    start=clock()
+    batch=sweep.render(base,1000000)
+    print('Rendered {} points of {} samples in {:.1f} ms'.format(len(sweep),sweep.samples,(clock()-start)*1000))
+    worst=0
+    engine=WaveformEngine(1000000)
+    for point in (0,len(sweep)//2,len(sweep)-1):
+        setting=dict(base,**dict(zip(sweep.names,sweep.points[point])))
+        data,n=engine.render([setting])
+        worst=max(worst,np.abs(data-batch[point]).max())
+    print('Largest difference from the WaveformEngine: {:.2g} V'.format(worst))
+    settings=Settings()
+    settings.d=[default_setting() for i in range(4)]
+    driver=GalvoDriver(settings,SimulatedBackend(record_data=False))
+    index=os.path.join(tempfile.gettempdir(),'sweep_index.txt')
+    start=clock()
+    driver.sweep(sweep,index)
+    compiled=clock()-start
+    driver.timeline.finished.wait(60)
+    print('Compiled in {:.1f} ms, played {} frames in {:.3f} s (expected {:.3f} s), index in {}'.format(compiled*1000,sweep.frames(),clock()-start,sweep.duration(),index))
+    while driver.acquiring: # the driver stops the output once the sweep has played
+        time.sleep(.01)
+    with open(index) as f:
+        lines=[line.rstrip('\n').split('\t') for line in f]
+    rows=np.array(lines[1:],dtype=np.float64)
+    frame=np.arange(sweep.frames())
+    indexed=(lines[0]==['frame','point']+sweep.names and rows.shape==(sweep.frames(),2+len(sweep.names)) and
+             np.array_equal(rows[:,0],frame) and np.array_equal(rows[:,1],frame//sweep.frames_per_point) and
+             np.allclose(rows[:,2:],sweep.points[frame//sweep.frames_per_point]))
+    print('Index of {} frames, {} per point: {}'.format(len(lines)-1,sweep.frames_per_point,'right' if indexed else 'wrong'))
+    return worst<1e-9 and indexed
+
+
+if __name__=='__main__':
+    if not check():
+        raise SystemExit('The sweep does not match the WaveformEngine or its index is wrong')
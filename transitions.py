@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Smooth transitions between the settings of a sequence.
+
+When alternate12 or alternate123 output one setting after another, or a recalled setting takes over, the sine and the
+cosine jump from one radius, shift and phase to the next.  The galvos can't follow a step: they ring and overshoot, and
+the frames taken while they settle are lost.  Transitions inserts a short segment between consecutive settings, in
+which the galvos move from where the first setting leaves them (position, velocity and acceleration) to where the next
+one starts, along a quintic polynomial whose speed stays under max_slew (V/s) and whose acceleration stays under
+max_acceleration (V/s^2).  Both galvos take the same time, the shortest for which neither exceeds the limits.  The
+limits are raised to what the settings themselves need at their ends, since the ring can't be slower than the setting.
+During a transition the camera TTL is low, so no frame starts while the beam moves, and the lasers keep the values of
+the setting being left.
+
+A transition only depends on the state of the galvos at the end of one setting and the start of the next, so it is
+cached on those: alternating between two settings computes each of the two transitions once.  times holds how long each
+transition of the last buffer takes, in seconds, which is the price of switching smoothly.  The transitions lengthen the
+buffer, so the camera frame rate of a sequence drops a little.
+
+    python transitions.py
+prints the time of the transition between two settings for a few limits, and fails if the output is faster than a limit.
+"""
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+from waveform_cache import WaveformCache
+from waveform_engine import SIN, COS, CAMERA_TTL, N_CHANNELS
+
+GALVO_ROWS=(SIN,COS)
+MAX_TRANSITION=.05 # in seconds. The longest transition considered
+POINTS=64 # how many points of each candidate trajectory are checked against the limits
+HERMITE=np.array([ # the coefficients of s**0 to s**5 of the quintic through (p0, T*v0, T*T*a0) at s=0 and (p1, T*v1, T*T*a1) at s=1
+    [1,0,0,-10,15,-6], # p0
+    [0,1,0,-6,8,-3], # T*v0
+    [0,0,.5,-1.5,1.5,-.5], # T*T*a0
+    [0,0,0,10,-15,6], # p1
+    [0,0,0,-4,7,-3], # T*v1
+    [0,0,0,.5,-1,.5]]) # T*T*a1
+
+
+def edges(data):
+    ''' The columns of a periodic (N_CHANNELS x samples) buffer which its state at the start and at the end depends on.'''
+    return data[:,[0,1,-2,-1]].copy() if data.shape[1]>=2 else np.repeat(data[:,:1],4,axis=1)
+
+
+def end_state(edge,sample_rate):
+    ''' (position, velocity, acceleration) of every row at the end of a periodic buffer with these edges.  The buffer
+    starts over after its last sample, so its first sample is the one which would come next.'''
+    first,second,before_last,last=edge.T
+    return last,(first-before_last)*(sample_rate/2),(first-2*last+before_last)*sample_rate**2
+
+
+def start_state(edge,sample_rate):
+    first,second,before_last,last=edge.T
+    return first,(second-last)*(sample_rate/2),(second-2*first+last)*sample_rate**2
+
+
+class Transitions:
+    def __init__(self,max_slew=2000.,max_acceleration=2e7,max_bytes=16*2**20):
+        if max_slew<=0 or max_acceleration<=0:
+            raise ValueError('The slew rate and the acceleration limits have to be above 0')
+        self.max_slew=float(max_slew)
+        self.max_acceleration=float(max_acceleration)
+        self.cache=WaveformCache(max_bytes)
+        self.times=[] # the time of every transition of the last buffer, in seconds
+    def key(self):
+        return (self.max_slew,self.max_acceleration)
+    def samples(self,start,end,sample_rate):
+        ''' The number of samples of the shortest transition from start to end, two (position, velocity, acceleration)
+        tuples of arrays of one value per galvo.  Every candidate length is checked at once.'''
+        (p0,v0,a0),(p1,v1,a1)=start,end
+        max_slew=np.maximum(self.max_slew,np.maximum(np.abs(v0),np.abs(v1)))*(1+1e-9)
+        max_acceleration=np.maximum(self.max_acceleration,np.maximum(np.abs(a0),np.abs(a1)))*(1+1e-9)
+        candidates=np.unique(np.round(np.logspace(0,np.log10(MAX_TRANSITION*sample_rate),200)).astype(np.int64))-1 # 0 means the settings already join smoothly
+        T=((candidates+1)/sample_rate)[:,None] # from the last sample of one setting to the first of the next
+        boundary=np.dstack([p0+0*T,T*v0,T*T*a0,p1+0*T,T*v1,T*T*a1]) # (candidates x galvos x 6)
+        T=T[:,:,None]
+        c=boundary.dot(HERMITE) # the coefficients of s**0 to s**5
+        s=np.linspace(0,1,POINTS)
+        powers=s**np.arange(5)[:,None]
+        velocity=(c[...,1:]*np.arange(1,6)).dot(powers)/T # (candidates x galvos x points)
+        acceleration=(c[...,2:]*np.array([2,6,12,20])).dot(powers[:4])/(T*T)
+        ok=np.all(np.abs(velocity)<=max_slew[:,None],axis=(1,2))&np.all(np.abs(acceleration)<=max_acceleration[:,None],axis=(1,2))
+        return int(candidates[np.argmax(ok)]) if ok.any() else int(candidates[-1])
+    def segment(self,before,after,sample_rate):
+        ''' Returns the (N_CHANNELS x samples) transition from the end of the buffer with edges before to the start of the
+        buffer with edges after.  It may have no samples.  It is shared with the cache, so it must not be modified.'''
+        start=[x[list(GALVO_ROWS)] for x in end_state(before,sample_rate)]
+        end=[x[list(GALVO_ROWS)] for x in start_state(after,sample_rate)]
+        key=(sample_rate,tuple(np.round(np.concatenate(start+end),9)),tuple(before[:,-1]))
+        cached=self.cache.get(key)
+        if cached is None:
+            m=self.samples(start,end,sample_rate)
+            T=(m+1)/sample_rate
+            s=np.arange(1,m+1)/(m+1)
+            boundary=np.column_stack([start[0],T*start[1],T*T*start[2],end[0],T*end[1],T*T*end[2]]) # (galvos x 6)
+            out=np.empty((N_CHANNELS,m))
+            out[:]=before[:,-1:] # the lasers keep the values of the setting being left
+            out[list(GALVO_ROWS)]=boundary.dot(HERMITE).dot(s**np.arange(6)[:,None])
+            out[CAMERA_TTL]=0
+            cached=(out,)
+            self.cache.put(key,cached)
+        return cached[0]
+    def insert(self,data,lengths,sample_rate):
+        ''' Returns a new buffer with a transition after each of the consecutive segments of data, which are lengths long,
+        including from the last one back to the first.  Returns (buffer, the lengths of its segments, transitions included).'''
+        starts=np.cumsum([0]+list(lengths))
+        segments=[data[:,a:b] for a,b in zip(starts[:-1],starts[1:])]
+        pieces=[]
+        self.times=[]
+        for i,segment in enumerate(segments):
+            pieces.append(segment)
+            transition=self.segment(edges(segment),edges(segments[(i+1)%len(segments)]),sample_rate)
+            pieces.append(transition)
+            self.times.append(transition.shape[1]/sample_rate)
+        return np.concatenate(pieces,axis=1),[piece.shape[1] for piece in pieces]
+
+
+def check(sample_rate=250000):
+    ''' Inserts transitions between two settings with three sets of limits.  Returns the largest slew rate or
+    acceleration of the output, from the differences of its samples, as a fraction of its limit.'''
+    from settings import default_setting
+    from waveform_engine import WaveformEngine
+    a=default_setting()
+    b=default_setting()
+    b['radius']=.5
+    b['x_shift']=300
+    engine=WaveformEngine(sample_rate)
+    data,n=engine.render([a,b])
+    print('Jump without a transition: {:.3f} V'.format(np.abs(np.diff(data[list(GALVO_ROWS)],axis=1)).max()))
+    worst=0 # the largest slew rate or acceleration, as a fraction of its limit
+    for max_slew,max_acceleration in [(1e4,1e8),(5e3,2e7),(2e3,5e6)]:
+        transitions=Transitions(max_slew,max_acceleration)
+        out,lengths=transitions.insert(data,engine.lengths,sample_rate)
+        galvos=out[list(GALVO_ROWS)]
+        galvos=np.hstack([galvos,galvos[:,:2]]) # the buffer is repeated, so it also has to join its own start
+        slew=np.abs(np.diff(galvos,axis=1)).max()*sample_rate
+        acceleration=np.abs(np.diff(galvos,2,axis=1)).max()*sample_rate**2
+        print('{:g} V/s, {:g} V/s^2: transitions of {} ms, largest step {:.4f} V, slew {:.4g} V/s, acceleration {:.4g} V/s^2'.format(max_slew,max_acceleration,', '.join('{:.3f}'.format(t*1000) for t in transitions.times),np.abs(np.diff(out[list(GALVO_ROWS)],axis=1)).max(),slew,acceleration))
+        worst=max(worst,slew/max_slew,acceleration/max_acceleration)
+    return worst
+
+
+if __name__=='__main__':
+    worst=check()
+    if worst>1.01: # differences of samples are only estimates of the derivatives, so allow 1%
+        raise SystemExit('A transition is {:.0%} of its slew rate or acceleration limit'.format(worst))
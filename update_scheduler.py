@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Coalesces setting changes from the GUI into as few hardware updates as possible.
+
+Dragging a slider emits dozens of valueChanged signals a second.  Instead of rebuilding the waveform and reconfiguring the
+DAQ for every one of them on the Qt main thread, each change is posted here as a {name: value} delta.  A background
+thread merges all the deltas which arrive while it waits (the latest value of each setting wins) and applies them to the
+current setting with a single GalvoDriver.refresh(), at most once per interval.
+"""
+from __future__ import division
+import threading
+import time
+from daq_backend import clock
+
+
+class UpdateScheduler:
+    ''' Applies posted setting changes to galvoDriver.settings and refreshes the galvoDriver, at most once every interval seconds.'''
+    def __init__(self,galvoDriver,interval=.02):
+        self.galvoDriver=galvoDriver
+        self.interval=interval
+        self.pending=dict()
+        self.lock=threading.Lock() # protects self.pending
+        self.apply_lock=threading.Lock() # makes sure deltas are applied in the order they were taken
+        self.event=threading.Event()
+        self.last_apply=0
+        self.posted=0 # how many deltas have been posted
+        self.applied=0 # how many hardware updates they were coalesced into
+        self.closed=False
+        self.thread=threading.Thread(target=self.run)
+        self.thread.daemon=True
+        self.thread.start()
+    def post(self,changes):
+        ''' changes is a dict of {setting name: value}.  This returns immediately.'''
+        with self.lock:
+            self.pending.update(changes)
+            self.posted+=1
+        self.event.set()
+    def flush(self):
+        ''' Applies everything that has been posted before returning.  Call this before anything that needs the settings to be current, like starting an acquisition.'''
+        self.apply()
+    def apply(self):
+        with self.apply_lock:
+            with self.lock:
+                changes=self.pending
+                self.pending=dict()
+            if not changes:
+                return
+            with self.galvoDriver.lock:
+                for name,value in changes.items():
+                    self.galvoDriver.settings[name]=value
+                self.galvoDriver.refresh()
+            self.last_apply=clock()
+            self.applied+=1
+    def run(self):
+        while True:
+            self.event.wait()
+            self.event.clear()
+            if self.closed:
+                return
+            wait=self.last_apply+self.interval-clock()
+            if wait>0:
+                time.sleep(wait) # changes posted while sleeping are merged into this update
+            self.apply()
+    def close(self):
+        self.closed=True
+        self.event.set()
+        self.thread.join()
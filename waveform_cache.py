@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+A small least-recently-used cache for finished output buffers.
+
+Computing the sine, cosine and TTL arrays for a setting is the expensive part of a refresh, especially at low frequencies
+where a single period is millions of samples.  The GalvoDriver stores every buffer it computes here, keyed on the
+normalized parameters that produced it, so recalling a setting or dragging a slider back to a value that was used a
+moment ago costs nothing.
+"""
+from __future__ import division
+from collections import OrderedDict
+
+WAVEFORM_KEYS=('frequency','radius','ellipticity','phase','x_shift','y_shift','blue_laser','green_laser','blue_laser_power','green_laser_power')
+
+
+def normalize_setting(setting):
+    ''' Returns a hashable tuple of the values in a setting dict that change the output waveform.
+    Floats are rounded so that values which only differ by floating point noise from the spin boxes share an entry,
+    and the power of a laser which is switched off is ignored because it has no effect on the output.'''
+    values=[]
+    for key in WAVEFORM_KEYS:
+        value=setting[key]
+        if key in ('blue_laser','green_laser'):
+            value=bool(value)
+        elif key=='blue_laser_power' and not setting['blue_laser']:
+            value=None
+        elif key=='green_laser_power' and not setting['green_laser']:
+            value=None
+        else:
+            value=round(float(value),9)
+        values.append(value)
+    return tuple(values)
+
+
+class WaveformCache:
+    ''' Maps a key to a finished (data, sampsPerPeriod, ...) tuple.  When the total size of the cached arrays exceeds
+    max_bytes, the least recently used entries are evicted.  The cached arrays are shared with the caller, so they must
+    not be modified in place.'''
+    def __init__(self,max_bytes=256*2**20):
+        self.max_bytes=max_bytes
+        self.entries=OrderedDict()
+        self.nbytes=0
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+    def get(self,key):
+        try:
+            value=self.entries.pop(key)
+        except KeyError:
+            self.misses+=1
+            return None
+        self.entries[key]=value # reinserting moves the entry to the most recently used end
+        self.hits+=1
+        return value
+    def put(self,key,value):
+        data=value[0]
+        if key in self.entries:
+            self.nbytes-=self.entries.pop(key)[0].nbytes
+        if data.nbytes>self.max_bytes: # this buffer would evict everything else and still not fit
+            return
+        self.entries[key]=value
+        self.nbytes+=data.nbytes
+        while self.nbytes>self.max_bytes:
+            oldest_key,oldest_value=self.entries.popitem(last=False)
+            self.nbytes-=oldest_value[0].nbytes
+            self.evictions+=1
+    def clear(self):
+        self.entries.clear()
+        self.nbytes=0
+    def __len__(self):
+        return len(self.entries)
+    def __contains__(self,key):
+        return key in self.entries
+    def stats(self):
+        return {'entries':len(self.entries),'bytes':self.nbytes,'max_bytes':self.max_bytes,'hits':self.hits,'misses':self.misses,'evictions':self.evictions}
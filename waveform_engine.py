@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Synthesizes the output buffer for a sequence of settings.
+
+The output has one row per analog output channel and one column per sample:
+- row 0 (SIN) drives the x galvo
+- row 1 (COS) drives the y galvo
+- row 2 (CAMERA_TTL) is high for the first sample of every period and triggers the camera, unless a CameraTrigger
+  from camera_trigger.py says otherwise
+- row 3 (BLUE_LASER) and row 4 (GREEN_LASER) hold the laser control voltages
+
+Each setting in the sequence gets one period, one after another.  Every channel is written in place into a single
+preallocated buffer which is reused between calls, so refreshing doesn't allocate temporary arrays and the peak memory
+is the size of the output no matter how many settings are in the sequence.
+
+The engine remembers which settings the buffer holds.  When the next sequence has the same layout (the same number of
+samples for every setting), only the channels of the settings whose parameters changed are rewritten: toggling a laser
+rewrites one constant row, and changing the ellipticity rewrites the cosine without touching the sine.
+"""
+from __future__ import division
+import numpy as np
+from waveform_cache import WAVEFORM_KEYS, normalize_setting
+from camera_trigger import CameraTrigger
+
+SIN,COS,CAMERA_TTL,BLUE_LASER,GREEN_LASER=range(5)
+N_CHANNELS=5
+ZERO_FREQUENCY_PERIOD=.005 # in seconds. How long a setting with a frequency of 0 is held if no other setting sets the period.
+CAMERA_TTL_VOLTAGE=5
+LASER_OFF_VOLTAGE=-.08
+ALL_CHANNELS=(SIN,COS,CAMERA_TTL,BLUE_LASER,GREEN_LASER)
+CHANNELS_AFFECTED_BY={ # which rows of the output depend on each parameter
+    'frequency':ALL_CHANNELS, # the frequency sets the length of the period, which every channel shares
+    'radius':(SIN,COS),
+    'ellipticity':(COS,),
+    'phase':(COS,),
+    'x_shift':(SIN,),
+    'y_shift':(COS,),
+    'blue_laser':(BLUE_LASER,),
+    'blue_laser_power':(BLUE_LASER,),
+    'green_laser':(GREEN_LASER,),
+    'green_laser_power':(GREEN_LASER,)}
+
+
+def num_samples(period,sample_rate):
+    ''' The number of samples in one period.  This matches len(np.arange(0,period,1/sample_rate)).'''
+    return int(np.ceil(period/(1/sample_rate)))
+
+
+def dirty_channels(old,new):
+    ''' old and new are settings normalized with normalize_setting().  Returns the set of channels which differ between them.'''
+    channels=set()
+    for key,old_value,new_value in zip(WAVEFORM_KEYS,old,new):
+        if old_value!=new_value:
+            channels.update(CHANNELS_AFFECTED_BY[key])
+    return channels
+
+
+def sequence_periods(settings):
+    ''' Returns the period of every setting in the sequence.  A setting with a frequency of 0 doesn't have a period of
+    its own, so it adopts the period of the first setting in the sequence that does, or ZERO_FREQUENCY_PERIOD if none do.'''
+    frequencies=[setting['frequency'] for setting in settings]
+    nonzero=[f for f in frequencies if f!=0]
+    if nonzero:
+        default_period=1/nonzero[0]
+    else:
+        default_period=ZERO_FREQUENCY_PERIOD
+    return [1/f if f!=0 else default_period for f in frequencies]
+
+
+class WaveformEngine:
+    ''' Writes the waveforms for a sequence of settings into a (N_CHANNELS x samples) buffer.  The buffer returned by
+    render() is overwritten by the next call to render(), so copy it if it needs to outlive that.'''
+    def __init__(self,sample_rate):
+        self.sample_rate=sample_rate
+        self.buffer=np.empty(0)
+        self.lengths=None # the number of samples of each setting in the buffer
+        self.contents=None # the normalized settings in the buffer
+        self.pulse=None # the width of the camera pulses in the buffer, in samples
+        self.rows_written=0 # how many (setting, channel) rows have been computed
+        self.rows_skipped=0 # how many were already in the buffer and were left alone
+        self.ramp=np.arange(0,dtype=np.float64) # 0,1,2,... shared by every setting to build the angle of each sample
+    def outputBuffer(self,nSamples):
+        ''' Returns a contiguous (N_CHANNELS x nSamples) view into the preallocated buffer, growing it if needed.'''
+        size=N_CHANNELS*nSamples
+        if self.buffer.size<size:
+            self.buffer=np.empty(size)
+            self.lengths=None
+        return self.buffer[:size].reshape(N_CHANNELS,nSamples)
+    def setSampleRate(self,sample_rate):
+        ''' Changes the rate settings are rendered at without a plan.  The next render() rewrites every row.'''
+        if sample_rate!=self.sample_rate:
+            self.sample_rate=sample_rate
+            self.lengths=None
+    def sampleIndex(self,nSamples):
+        if self.ramp.size<nSamples:
+            self.ramp=np.arange(nSamples,dtype=np.float64)
+        return self.ramp[:nSamples]
+    def render(self,settings,periods=None,plan=None,camera=None):
+        ''' settings is the ordered list of setting dicts to output, one period each.  Returns (data, sampsPerPeriod)
+        where sampsPerPeriod is the length of the whole sequence.  periods overrides the period of each setting, which
+        otherwise comes from sequence_periods().  If a WaveformPlan from waveform_planner.py is given instead, setting i
+        gets exactly plan.revolutions[i] revolutions in plan.lengths[i] samples, with plan.triggers[i] camera triggers.
+        Without a plan, a CameraTrigger other than the default stretches each setting to a whole number of frames.'''
+        if camera is None:
+            camera=CameraTrigger()
+        if plan is not None:
+            lengths=plan.lengths
+            revolutions=plan.revolutions
+            triggers=plan.triggers
+        else:
+            if periods is None:
+                periods=sequence_periods(settings)
+            frequencies=[setting['frequency'] for setting in settings]
+            steps=[camera.revolutionStep(f) for f in frequencies]
+            if camera.mode=='frame_rate': # whole revolutions at the frequencies the camera chooses
+                periods=[m/f for f,m in zip(camera.galvoFrequencies(frequencies),steps)]
+                revolutions=steps
+            else:
+                periods=[period*m for period,m in zip(periods,steps)]
+                revolutions=[None]*len(settings)
+            lengths=[num_samples(period,self.sample_rate) for period in periods]
+            triggers=[camera.triggers(m,f) for f,m in zip(frequencies,steps)]
+        pulse=camera.pulseSamples(self.sample_rate if plan is None else plan.sample_rate) # a plan may run slower than the engine
+        contents=[(normalize_setting(setting),m,t) for setting,m,t in zip(settings,revolutions,triggers)]
+        sampsPerPeriod=sum(lengths)
+        data=self.outputBuffer(sampsPerPeriod)
+        same_layout=lengths==self.lengths and pulse==self.pulse
+        start=0
+        for i,(setting,n) in enumerate(zip(settings,lengths)):
+            if same_layout and contents[i][1:]==self.contents[i][1:]:
+                channels=dirty_channels(self.contents[i][0],contents[i][0])
+            else:
+                channels=ALL_CHANNELS
+            if channels:
+                self.writeSetting(data[:,start:start+n],setting,channels,revolutions[i],triggers[i],pulse)
+            self.rows_written+=len(channels)
+            self.rows_skipped+=N_CHANNELS-len(channels)
+            start+=n
+        self.lengths=lengths
+        self.contents=contents
+        self.pulse=pulse
+        return data,sampsPerPeriod
+    def writeSetting(self,out,setting,channels=ALL_CHANNELS,revolutions=None,triggers=None,pulse=1):
+        ''' Writes one period of a single setting into out, which is a (N_CHANNELS x samples) view.  Only the rows in channels are written.
+        If revolutions is given, the sine and cosine make exactly that many revolutions over the samples of out, instead of
+        following the frequency at the sample rate.  triggers camera pulses of pulse samples are spread evenly over out,
+        by default one per revolution.'''
+        frequency=setting['frequency']
+        radius=setting['radius']
+        phase=setting['phase']*(2*np.pi/360)
+        x_offset=setting['x_shift']/1000
+        y_offset=setting['y_shift']/1000
+        sinwave=out[SIN]
+        coswave=out[COS]
+        if frequency==0: # the beam stays still
+            if SIN in channels:
+                sinwave.fill(x_offset)
+            if COS in channels:
+                coswave.fill(setting['ellipticity']*radius*np.cos(phase)+y_offset)
+        else:
+            if revolutions is None:
+                angle_step=frequency*2*np.pi/self.sample_rate
+            else:
+                angle_step=revolutions*2*np.pi/out.shape[1]
+            if SIN in channels:
+                np.multiply(self.sampleIndex(out.shape[1]),angle_step,out=sinwave) # the angle of each sample
+                if COS in channels:
+                    np.add(sinwave,phase,out=coswave)
+                np.sin(sinwave,out=sinwave)
+                sinwave*=radius
+                sinwave+=x_offset
+            elif COS in channels:
+                np.multiply(self.sampleIndex(out.shape[1]),angle_step,out=coswave)
+                coswave+=phase
+            if COS in channels:
+                np.cos(coswave,out=coswave)
+                coswave*=setting['ellipticity']*radius
+                coswave+=y_offset
+        if CAMERA_TTL in channels:
+            n=out.shape[1]
+            if triggers is None:
+                triggers=1 if revolutions is None else revolutions
+            starts=(np.arange(triggers)*n)//triggers
+            width=max(1,min(pulse,n//triggers-1)) # the TTL has to go low between pulses
+            out[CAMERA_TTL].fill(0)
+            if width==1:
+                out[CAMERA_TTL,starts]=CAMERA_TTL_VOLTAGE
+            else:
+                out[CAMERA_TTL,(starts[:,None]+np.arange(width)).ravel()]=CAMERA_TTL_VOLTAGE
+        if BLUE_LASER in channels:
+            out[BLUE_LASER].fill(setting['blue_laser_power'] if setting['blue_laser'] else LASER_OFF_VOLTAGE)
+        if GREEN_LASER in channels:
+            out[GREEN_LASER].fill(setting['green_laser_power'] if setting['green_laser'] else LASER_OFF_VOLTAGE) # 0V is on and 5V is off for the green laser
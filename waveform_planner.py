@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Chooses the sample rate and the length of the buffer for each setting.
+
+A buffer is repeated end to end, so the frequency which is actually output is revolutions*sample_rate/samples, where
+samples is a whole number.  At a fixed 1MHz with one revolution per buffer, a period which isn't a whole number of
+samples is truncated and the galvos and the camera trigger run slightly off the requested frequency.  At low
+frequencies, one revolution at 1MHz is millions of samples, which costs memory and DMA bandwidth for no optical benefit.
+
+The planner searches the sample rates the card can make (its 20MHz timebase divided by a whole number, up to 1MHz) from
+the fastest down, together with the number of revolutions in the buffer, for a buffer which:
+- outputs every requested frequency within tolerance_ppm
+- has at most max_samples samples per channel
+- has at least min_samples_per_revolution samples in each revolution, so the circle stays smooth
+- lasts at most max_duration seconds, unless a single revolution is longer.  A streamed buffer is only replaced at its
+  end, so this bounds how long a change of settings waits
+If no buffer is within the tolerance, the fastest rate is used, where the error is at most half a sample per setting,
+and a warning is printed.
+When streaming, a change of rate restarts the task, which is the glitch streaming avoids.  So the rate the output runs
+at is passed as preferred_rate, and it is kept whenever it is within the tolerance.  Otherwise the search runs as usual,
+and the task restarts at the rate it finds.
+
+With a CameraTrigger (see camera_trigger.py), each setting's revolutions are a whole number of camera frames, and in the
+frame_rate mode the frequencies planned for are the galvo frequencies the camera trigger chooses.
+"""
+from __future__ import division
+import numpy as np
+from waveform_engine import N_CHANNELS, ZERO_FREQUENCY_PERIOD
+from camera_trigger import CameraTrigger
+
+
+class WaveformPlan:
+    ''' The result of planning.  lengths[i] is the number of samples of setting i, which holds revolutions[i] revolutions
+    and triggers[i] camera frames.  frame_rate is the resulting number of frames per second.'''
+    def __init__(self,sample_rate,frequencies,lengths,revolutions,camera=None):
+        self.sample_rate=sample_rate
+        self.requested=list(frequencies)
+        self.lengths=list(lengths)
+        self.revolutions=list(revolutions)
+        self.achieved=[m*sample_rate/n if f!=0 else 0 for f,n,m in zip(frequencies,lengths,revolutions)]
+        self.errors_ppm=[abs(a-f)/f*1e6 if f!=0 else 0 for f,a in zip(frequencies,self.achieved)]
+        self.error_ppm=max(self.errors_ppm)
+        self.samples=sum(lengths)
+        self.nbytes=self.samples*N_CHANNELS*8
+        if camera is None:
+            camera=CameraTrigger()
+        self.triggers=[camera.triggers(m,f) for f,m in zip(frequencies,revolutions)]
+        self.frame_rate=sum(self.triggers)*sample_rate/self.samples
+        self.revolutions_per_frame=[m/t for m,t in zip(revolutions,self.triggers)]
+    def describe(self):
+        achieved=', '.join('{:.4f}'.format(a) for a in self.achieved)
+        per_frame=', '.join('{:g}'.format(r) for r in self.revolutions_per_frame)
+        return 'Output: {} Hz ({:.2f} ppm)   Buffer: {} samples, {:.0f} kB at {:.0f} Hz   Camera: {:.2f} frames/s, {} revolutions/frame'.format(achieved,self.error_ppm,self.samples,self.nbytes/1024,self.sample_rate,self.frame_rate,per_frame)
+
+
+class WaveformPlanner:
+    def __init__(self,max_sample_rate=1000000,timebase=20000000,min_sample_rate=10000,tolerance_ppm=10,max_samples=250000,min_samples_per_revolution=1000,max_revolutions=100,max_duration=None):
+        self.max_sample_rate=max_sample_rate
+        self.timebase=timebase # the sample clock is this divided by a whole number
+        self.min_sample_rate=min_sample_rate
+        self.tolerance_ppm=tolerance_ppm
+        self.max_samples=max_samples
+        self.min_samples_per_revolution=min_samples_per_revolution
+        self.max_revolutions=max_revolutions # only used when there is a single setting. In a sequence, every setting gets one revolution.
+        self.max_duration=max_duration # in seconds, or None. The longest a buffer of several revolutions may last
+    def key(self):
+        ''' Everything that changes the plans this planner makes, for use in cache keys.'''
+        return (self.max_sample_rate,self.timebase,self.min_sample_rate,self.tolerance_ppm,self.max_samples,self.min_samples_per_revolution,self.max_revolutions,self.max_duration)
+    def sampleRates(self):
+        first=int(np.ceil(self.timebase/self.max_sample_rate))
+        last=int(self.timebase//self.min_sample_rate)
+        return [self.timebase/divisor for divisor in range(first,last+1)]
+    def plan(self,frequencies,sample_rate=None,camera=None,preferred_rate=None):
+        ''' frequencies is the frequency of each setting in the sequence, in Hz.  If sample_rate is given, only that rate is
+        considered.  preferred_rate is the rate the streamed output runs at, or None if changing it costs nothing.'''
+        if camera is not None and camera.mode=='frame_rate':
+            frequencies=camera.galvoFrequencies(frequencies)
+        if sample_rate is None:
+            sample_rates=self.sampleRates()
+        else:
+            sample_rates=[sample_rate]
+        if sample_rate is None and preferred_rate in sample_rates:
+            plan=self.fit(frequencies,preferred_rate,camera=camera)
+            if plan is not None and plan.error_ppm<=self.tolerance_ppm:
+                return plan
+        best=None
+        for rate in sample_rates:
+            plan=self.fit(frequencies,rate,camera=camera)
+            if plan is None:
+                continue
+            if plan.error_ppm<=self.tolerance_ppm:
+                return plan
+            if best is None: # the fastest rate which fits
+                best=plan
+        if best is None: # nothing fits in the budget, so use the slowest rate
+            best=self.fit(frequencies,sample_rates[-1],budget=False,camera=camera)
+        if best.error_ppm>self.tolerance_ppm:
+            print('No sample rate outputs {} Hz within {} ppm: {:.1f} ppm at {:.0f} Hz'.format(', '.join('{:g}'.format(f) for f in frequencies),self.tolerance_ppm,best.error_ppm,best.sample_rate))
+        return best
+    def fit(self,frequencies,rate,budget=True,camera=None):
+        ''' Returns the best plan at this sample rate, or None if there isn't one within the budget.'''
+        if camera is None:
+            camera=CameraTrigger()
+        steps=[camera.revolutionStep(f) for f in frequencies] # every setting holds a multiple of this many revolutions
+        nonzero=[f for f in frequencies if f!=0]
+        if budget and nonzero and rate/max(nonzero)<self.min_samples_per_revolution:
+            return None
+        if len(frequencies)==1 and nonzero:
+            frequency=nonzero[0]
+            best=None
+            for revolutions in range(steps[0],max(self.max_revolutions,steps[0])+1,steps[0]):
+                n=int(round(revolutions*rate/frequency))
+                if budget and n>self.max_samples:
+                    break
+                if self.max_duration is not None and revolutions>steps[0] and n>self.max_duration*rate:
+                    break
+                error=abs(revolutions*rate/n-frequency)
+                if best is None or error<best[0]:
+                    best=(error,n,revolutions)
+                if error/frequency*1e6<=self.tolerance_ppm:
+                    break
+            if best is None:
+                return None
+            return WaveformPlan(rate,frequencies,[best[1]],[best[2]],camera)
+        if nonzero:
+            zero_length=int(round(rate/nonzero[0])) # as in calculate(), a setting with a frequency of 0 adopts the period of the first setting which has one
+        else:
+            zero_length=int(round(rate*ZERO_FREQUENCY_PERIOD))
+        lengths=[int(round(m*rate/f)) if f!=0 else m*zero_length for f,m in zip(frequencies,steps)]
+        if budget and sum(lengths)>self.max_samples:
+            return None
+        return WaveformPlan(rate,frequencies,lengths,steps,camera)